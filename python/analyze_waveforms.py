@@ -7,7 +7,7 @@ Creates charge histograms from hdf5 files made from `wavedump` or
 from __future__ import print_function, division
 import h5py
 import numpy as np
-from scipy import signal
+from functools import partial
 import os
 import sys
 from enum import Enum
@@ -15,6 +15,12 @@ from array import array
 
 canvas = []
 
+# Integration window (a, b) for each channel of the source group being
+# integrated. It's only known after the worker processes are started, so it's
+# passed to `integrate_block()` with every block. Channels without a window
+# look for it in every block.
+windows = {}
+
 # How much does the attenuator attenuate the signal relative to the no
 # attenuation path. This can be calculated using the pi_pad_calculator.py
 # script.
@@ -24,6 +30,9 @@ ATTENUATION_FACTOR = 5.85
 # signal to charge.
 CAEN_R = 50.0
 
+# Per event timing quantities we keep for the source events.
+TIMING_KEYS = ('rise_time', 'fall_time', 'hit_time')
+
 # Radioactive sources with their gamma energies in keV. 'lyso' maps to `None`
 # because we fit more than one gamma line.
 SOURCES = {'lyso': None, 'sodium': 511, 'cesium': 662, 'cobalt': 122}
@@ -127,14 +136,19 @@ def get_spe_window(x, start, integration_time):
         sys.exit(1)
     return (a,b)
 
-def integrate(x, data, a, b):
+def integrate(x, data, a, b, good=None):
     """
-    Integrate all waveforms in `data` with times `x`.
+    Integrate all waveforms in `data` with times `x`. If `good` is given, the
+    charge is set to NaN for the events where `good` is False so that the
+    charges stay aligned with the events.
     """
     # i = v/r
     # divide by `CAEN_R` to convert to a charge
     if np.ndim(data) == 2:
-        return -np.trapz(data[:,a:b],x=x[a:b])*1000/CAEN_R
+        charge = -np.trapz(data[:,a:b],x=x[a:b])*1000/CAEN_R
+        if good is not None:
+            charge[~good] = np.nan
+        return charge
     else:
         return -np.trapz(data[a:b],x=x[a:b])*1000/CAEN_R
 
@@ -142,7 +156,29 @@ def get_bins(x, cutoff=None):
     """
     Returns bins for the data `x` using the Freedman Diaconis rule. See
     https://en.wikipedia.org/wiki/Freedman%E2%80%93Diaconis_rule.
+
+    `x` can also be a ChargeHistogram of the data. Its percentiles are within
+    `resolution/2` of those of the data, so the first edge is too and the
+    bin width is within `resolution/len(x)**(1/3)`. With the default
+    resolution all the edges are within about 0.5 fC of the edges for the
+    data itself.
     """
+    if hasattr(x, 'percentile'):
+        if cutoff is not None:
+            raise ValueError("can't apply a cutoff to a ChargeHistogram")
+
+        if x.count() == 0:
+            return np.arange(0,100,1)
+
+        bin_width = 0.5*x.iqr()/(x.count()**(1/3.0))
+
+        if bin_width == 0:
+            print('Zero bin width! Quitting...', file=sys.stderr)
+            sys.exit(1)
+
+        first, last = x.percentile([1,99])
+        return np.arange(first,last,bin_width)
+
     x = np.asarray(x)
 
     orig_x = x.copy()
@@ -170,131 +206,51 @@ def chunks(lst, n):
     for i in range(0, len(lst), n):
         yield (i,i + n)
 
-def convert_data(f, group, channel, start, stop):
-    """
-    Reads data from opened hdf5 file `f`. Gets the events from `start` to
-    `stop` in the dataset `channel`.
-    """    
-    if 'data_source' in f[group].attrs:
-        if f[group].attrs['data_source'] == b'CAEN':
-            
-            xinc = 1/(f[group].attrs['drs4_frequency'] * 10**6)
-            points = f[group].attrs['record_length']
-            x = np.linspace(0, xinc * points, int(points)) - xinc * points * (1 - f[group].attrs['post_trigger']/100)
-            
-            # While `y` is measured in volts, it's only relatively. We could
-            # use the DC offset to determine the absolute voltage, but the
-            # DC offset isn't well defined. Setting it to about 22000 (DAC
-            # units) means approximately no offset is added, but not
-            # exactly. This shouldn't matter much because we use a baseline
-            # subtraction method anyways.
-            y = f[group][channel][start:stop]/2**12
-    elif 'yinc' in dict(f[channel].attrs):
-        # FIXME: All of the code below assumes that the datasets are in no
-        # group. `acquire-waveforms` should be updated first if we want to
-        # be able to use this function for oscilloscope data. 
-        x = f[channel].attrs['xorg'] + np.linspace(0,f[channel].attrs['xinc']*f[channel].attrs['points'],int(f[channel].attrs['points']))
-        # FIXME: I believe the else block in this if/else statement was for
-        # a type of hdf5 format that we no longer use.
-        if True: # ':WAVeform:FORMat' in dict(f['settings'].attrs) and f['settings'].attrs[':WAVeform:FORMat'] != 'ASC':
-            # convert word values -> voltages if the data was saved in a non-ascii format
-            y = f[channel][start:stop]*f[channel].attrs['yinc'] + f[channel].attrs['yorg']
-        else:
-            y = f[channel][start:stop]
-    else:
-        # In older versions of the code, I stored xorg, xinc, etc.
-        # in the main HDF5 group and not on a per channel basis
-        x = f.attrs['xorg'] + np.linspace(0,f.attrs['xinc']*f.attrs['points'],int(f.attrs['points']))
-
-        if ':WAVeform:FORMat' in dict(f['settings'].attrs) and f['settings'].attrs[':WAVeform:FORMat'] != 'ASC':
-            # convert word values -> voltages if the data was saved in a non-ascii format
-            y = f[channel][start:stop]*f.attrs['yinc'] + f.attrs['yorg']
-        else:
-            y = f[channel][start:stop]
-    return x*1e9, y
-
-def low_filter_SPE(x, y):
-    """
-    Returns `y` through a low pass filter. Edit the cutoff frequency by
-    modifying the filter defined below.
+def integrate_block(group, channels, x, block, windows=None):
     """
-    filter_order = 2
-    nyquist = (0.5 * (x[1] - x[0]))**(-1)
-    cutoff = 5**(-1)
-    b, a = signal.butter(filter_order, min(1, cutoff/nyquist), btype='lowpass', output='ba')
-    filter_data = signal.lfilter(b, a, y)
-    return filter_data
-
-def high_filter_SPE(x, y):
+    Integrates a block of waveforms for all the channels in `channels`.
+    `block` has shape (len(channels), number of events, number of samples).
+
+    Returns a dictionary mapping each channel to a dictionary with the charges,
+    the integration window, the rise, fall and hit times and, for the source groups, a
+    PulseAccumulator for the block which is merged into the average pulse.
+    `windows` is the integration window for each channel of a source group
+    which has one. This is a top level function so that it can be run in the
+    worker processes when using `--jobs`.
     """
-    Returns `y` through a high pass filter. Edit the cutoff frequency by
-    modifying the filter defined below.
-    """
-    filter_order = 2
-    nyquist = (0.5 * (x[1] - x[0]))**(-1)
-    cutoff = 5**(-1)  # Cut off frequency for the filter measured in inverse nanoseconds
-    b, a = signal.butter(filter_order, min(1, cutoff/nyquist), btype='highpass', output='ba')
-    filter_data = signal.lfilter(b, a, y)
-    return filter_data
-
-def spe_baseline_subtraction(x, y, a, b, method=1):
-    """ 
-    INTEGRATION METHODS
-    0: Only per event median subtraction (preformed in every method).
-
-    1: Cut events where the voltage is more than two standard
-       devations below the baseline at the start or end of the integration
-       window to avoid half pulses.
-
-    2: Per sample median subtraction. This method is not good because the SPE
-       signal gets diminished.
-
-    3: Delete all trials that have an SPE between `ma` and `mb`. Subtract off
-       the median between `ma` and `mb` on a per event basis.
-
-    4: Same as 3, except no trials are deleted. Trials that have an SPE between
-       `ma` and `mb` get reduced by the total median between `ma` and `mb` of
-       events that don't have an SPE in this range.
-    """ 
-    high_filter_y = high_filter_SPE(x, y)
-    
-    # Integration Method 0, per event median subtraction:
-    y -= np.median(y[:,x < args.start_time], axis=-1)[:, np.newaxis]
-
-    # Get a rough approximation of the standard deviation of the noise.
-    std = np.std(y[:,x < args.start_time])
-
-    if args.integration_method == 1:  # Default 
-        # Cut events where the voltage signal is more than 2 standard
-        # deviations away at the start or stop of the integration window.
-        y = y[(y[:,a] > -2*std) & (y[:,b] > -2*std)]
-    elif args.integration_method == 2:
-        # `s` for samples
-        s = y.T
-        s_mask = s > -10*iqr(high_filter_y.flatten())
-        good_s = [s[i, s_mask[i]] for i in range(len(s))]
-        print('average number of good samples: %.2f' % np.mean([len(sub) for sub in good_s]))
-        sample_medians = np.array([np.median(sub) for sub in good_s])
-        y -= sample_medians
-    elif args.integration_method == 3:
-        ma = -25
-        mb = 200
-        SPE_trials = np.min(y[:, np.logical_and(x >= ma, x < mb)], axis=-1) < -2 * iqr(high_filter_y[:, np.logical_and(x >= ma, x < mb)].flatten())
-        SPE_trials_idx = [i for i in range(len(y)) if SPE_trials[i]]
-        y = np.delete(y, SPE_trials_idx, axis=0)
-        # Subtract off the median between `ma` and `mb` per event
-        y -= np.median(y[:, np.logical_and(x >= ma, x < mb)], axis=-1)[:, np.newaxis]  # per event median subtraction
-        if len(y) == 0:
-            print('All trials were removed')
-    elif args.integration_method == 4:
-        ma = -25
-        mb = 200
-        m_mask = np.logical_and(x>=ma, x<mb)
-        no_SPE_trials_mask = np.min(y[:, m_mask], axis=-1) > -2 * iqr(high_filter_y[:, m_mask].flatten())
-        y -= np.array([np.median(y[i, m_mask]) if no_SPE_trials_mask[i] else np.median((y[no_SPE_trials_mask, :])[:, m_mask]) for i in range(len(y))])[:, np.newaxis]
-    elif args.integration_method != 0:
-        print('Not a valid integration method. Defaulting to integration method 0')
-    return y
+    if windows is None:
+        windows = {}
+    results = {}
+    for j, channel in enumerate(channels):
+        y = block[j]
+        result = {}
+        if group in SOURCES:
+            # The window, baseline, charge and rise and fall times are all
+            # computed in a single pass without modifying `y`.
+            features = pulse_features(x, y, window=windows.get(channel), left=50, right=350)
+            a, b = features['window']
+            baseline = features['baseline']
+            result['charge'] = features['charge']
+            result['rise_time'] = features['rise_time']
+            result['fall_time'] = features['fall_time']
+            result['hit_time'] = features['t40']
+            result['pulse'] = PulseAccumulator(x).add(y, baseline)
+            if args.plot or args.print_pdfs:
+                result['y'] = y[:100] - baseline[:100,np.newaxis]
+        elif group == 'spe':
+            a, b = get_spe_window(x, args.start_time, args.integration_time)
+            y, good = spe_baseline_subtraction(x, y, a, b, method=args.integration_method, start_time=args.start_time)
+            # Cut events get a NaN charge so that the charges stay aligned
+            # with the events of the other channels.
+            result['charge'] = integrate(x, y, a, b, good)
+            result['good'] = good
+            result['mean'] = np.mean(y[good], axis=0)
+            if args.plot or args.print_pdfs:
+                result['y'] = y[np.flatnonzero(good)[:100]]
+
+        result['window'] = (a, b)
+        results[channel] = result
+    return results
 
 def plot_time_volt(x, y, channel, data_type, a, b, avg_y=None, pdf=False, filename=None):
     plt.figure()
@@ -338,6 +294,86 @@ def plot_hist(h, pdf=False, filename=None):
             root, ext = os.path.splitext(filename)
             c.Print(os.path.join(args.print_pdfs, "%s_%s.pdf" % (root, h.GetName())))
 
+def fit_channel(channel, source, hspe, hoffset, hsource, spe_fitter='root', spe_fit_pars=None, fit_cache=None, gradient=False, priors=None):
+    """
+    Fits the SPE histogram `hspe`, the pedestal histogram `hoffset` and the
+    `source` charge histogram `hsource` of `channel`, any of which can be
+    None. With `spe_fitter` 'numpy' the SPE fit has already been done by
+    `fit_spe_batch()` and `spe_fit_pars` is its result, which is only
+    written out. If `fit_cache` is the path of a fit cache directory, the
+    fits of histograms which haven't changed since they were cached aren't
+    redone. If `gradient` is True, the SPE and LYSO fits use the analytic
+    derivatives of their models. `priors` is a dictionary of the parameters
+    of earlier fits of this channel to start the fits from, keyed by 'spe'
+    and `source` (see `FitPriors`). They only seed fits which aren't in the
+    cache.
+
+    Returns the SPE, pedestal and source fit results (None for the fits
+    which failed or weren't done), the fitted `hspe` and `hsource` and the
+    set of the names ('spe' and `source`) of the fits which came from the
+    cache, whose results shouldn't be stored as priors again. This
+    runs in the worker processes of `map_fits()`, so it only depends on its
+    arguments.
+    """
+    ch = int(channel[2:])
+    cache = FitCache(fit_cache) if fit_cache is not None else None
+    if priors is None:
+        priors = {}
+    spe_prior = priors.get('spe')
+    source_prior = priors.get(source)
+    cached = set()
+    if hspe is not None:
+        model = fit_spe_funcs.vinogradov_model()
+        if spe_fitter == 'numpy':
+            if spe_fit_pars is not None:
+                fit_spe_funcs.write_spe_fit(hspe, model, *spe_fit_pars)
+        else:
+            print('Fitting SPE %s!' % channel)
+            spe_fit_pars = cached_fit(cache, fit_spe_funcs.fit_spe, hspe, model, gradient=gradient, prior=spe_prior,
+                                      version=fit_spe_funcs.FIT_VERSION, key=(gradient,))
+            if cache is not None and cache.last_hit:
+                cached.add('spe')
+    else:
+        spe_fit_pars = None
+
+    offset_pars = cached_fit(cache, fit_gamma_funcs.fit_offset, hoffset, version=fit_gamma_funcs.FIT_VERSION) if hoffset is not None else None
+    if offset_pars is not None:
+        offset = offset_pars[0][0]
+        offset_sigma = offset_pars[0][1]
+    else:
+        print(f'WARNING: Could not measure the pedestal in ch{ch}. Defaulting to zero pedestal.')
+        offset = 0
+        offset_sigma = 10
+
+    source_fit_pars = None
+    if hsource is not None:
+        if source == 'lyso':
+            print(f'Fitting LYSO {ch}')
+            if spe_fit_pars is not None:
+                model = fit_lyso_funcs.lyso_spectrum(spe_charge=spe_fit_pars[0][3]/ATTENUATION_FACTOR, offset=offset)
+            else:
+                model = fit_lyso_funcs.lyso_spectrum(offset=offset)
+
+            if hsource.GetEntries() != 0:
+                # These channels are in the middle of a module and next to an
+                # unpowered bar so we can't cut coincidences properly, i.e.
+                # the charge distribution will have both crosstalk and gammas
+                # from neighboring unpowered bars. Therefore, we don't fix the
+                # gamma peak parameters when doing these fits.
+                fix_pars = ch not in (7,8,23,24)
+                source_fit_pars = cached_fit(cache, fit_lyso_funcs.fit_lyso, hsource, model, fix_pars=fix_pars, gradient=gradient, prior=source_prior,
+                                             version=fit_lyso_funcs.FIT_VERSION, key=(model.spe_charge, model.offset, fix_pars, gradient))
+                if cache is not None and cache.last_hit:
+                    cached.add(source)
+        else:
+            print(f'Fitting {source} {ch}!')
+            source_fit_pars = cached_fit(cache, fit_gamma_funcs.fit_gamma, hsource, SOURCES[source], offset=offset, offset_sigma=offset_sigma, prior=source_prior,
+                                         version=fit_gamma_funcs.FIT_VERSION, key=(SOURCES[source], offset, offset_sigma))
+            if cache is not None and cache.last_hit:
+                cached.add(source)
+
+    return spe_fit_pars, offset_pars, source_fit_pars, hspe, hsource, cached
+
 if __name__ == '__main__':
     from argparse import ArgumentParser
     import ROOT
@@ -347,13 +383,26 @@ if __name__ == '__main__':
     import psycopg2.extensions
     from btl import fit_spe_funcs
     from btl import fit_lyso_funcs
+    from btl.spe_baseline import spe_baseline_subtraction
     from btl import fit_gamma_funcs
+    from btl.waveforms import WaveformSource, split_trigger_groups, map_blocks
+    from btl.workers import WorkerPool
+    from btl.pulses import pulse_features, estimate_windows
+    from btl.integrals import read_windows, read_integrals, read_pulses, check_integrals
+    from btl.accumulators import EventAccumulator, PulseAccumulator, ChargeHistogram
+    from btl.histograms import fill_histogram
+    from btl.fit_spe_batch import fit_spe_batch
+    from btl.fit_scheduler import map_fits, fit_pool
+    from btl.fit_cache import FitCache, cached_fit
+    from btl.fit_priors import FitPriors, barcode_and_voltage, fit_quality
+    from btl import fit_results
 
     parser = ArgumentParser(description='Analyze SPE and source (LYSO or external source) charges')
     parser.add_argument('filename',help='input filename (hdf5 format)')
     parser.add_argument('-o','--output', default='delete_me.root', help='output file name')
     parser.add_argument('--plot', default=False, action='store_true', help='plot the waveforms and charge integral')
     parser.add_argument('--chunks', default=10000, type=int, help='number of waveforms to process at a time')
+    parser.add_argument('-j', '--jobs', default=1, type=int, help='number of processes to use when integrating the waveforms and fitting the histograms')
     parser.add_argument('-t', '--integration-time', default=150, type=float, help='SPE integration length in nanoseconds.')
     parser.add_argument('-s', '--start-time',  default=50, type=float, help='start time of the SPE integration in nanoseconds.')
     parser.add_argument('--integration-method', type=int, default=1, help='Select a method of integration. Methods described in __main__')
@@ -361,13 +410,35 @@ if __name__ == '__main__':
     parser.add_argument('-u','--upload', default=False, action='store_true', help='upload results to the database')
     parser.add_argument('-i','--institution', default=None, type=Institution, choices=list(Institution), help='name of institution')
     parser.add_argument('--channel-mask', type=lambda x: int(x,0), default=0xffffffff, help='channel mask')
+    parser.add_argument('--prescan', default=5000, type=int, help='number of events used to find the integration window for each channel before integrating. If 0, the window is found separately for every chunk.')
+    parser.add_argument('--windows', default=None, help='read the integration windows from an integrate-waveforms output file instead of finding them')
     parser.add_argument('-g', '--group', type=str, default=None, help='which group to analyze')
+    parser.add_argument('--integrals', default=None, help='integrate-waveforms output file with the charges. Defaults to <filename>_integrals.hdf5. It is only used if it is up to date with the input file and the integration options.')
+    parser.add_argument('--spe-fitter', default='root', choices=['root','numpy'], help='fit the SPE histograms one at a time with ROOT or all at once with NumPy')
+    parser.add_argument('--save-fit-functions', default=False, action='store_true', help='store the fitted functions with full resolution curves in the output file, which is slow for the LYSO and SPE models')
+    parser.add_argument('--analytic-gradients', default=False, action='store_true', help='give Minuit the analytic derivatives of the SPE and LYSO models instead of letting it compute them with finite differences')
+    parser.add_argument('--fit-cache', default=None, help='directory of a cache of the fits, so that only the histograms which changed since the last time are refit')
+    parser.add_argument('--fit-priors', default=None, help='directory of the fit parameters of earlier runs, used to start the fits of a module from the last run at the same voltage')
+    parser.add_argument('--reintegrate', default=False, action='store_true', help='always integrate the waveforms, even if there is an up to date integrals file')
     args = parser.parse_args()
 
+    if args.save_fit_functions:
+        fit_results.SAVE_FIT_FUNCTIONS = True
+
+    fit_priors = FitPriors(args.fit_priors) if args.fit_priors else None
+
+    if args.integrals is None:
+        args.integrals = '%s_integrals.hdf5' % os.path.splitext(args.filename)[0]
+
     if not args.plot:
         # Disables the canvas from ever popping up
         gROOT.SetBatch()
 
+    # The workers which integrate the waveforms and fit the histograms are
+    # forked before any files are opened. See `btl.workers`.
+    pool = WorkerPool(args.jobs)
+    fits = fit_pool(args.jobs)
+
     if args.upload:
         if 'BTL_DB_HOST' not in os.environ:
             print("need to set BTL_DB_HOST environment variable!",file=sys.stderr)
@@ -398,6 +469,11 @@ if __name__ == '__main__':
         # If there is no source in the data set, then we can still analyze SPE
         # data.
 
+        barcode, voltage = barcode_and_voltage(f)
+        if fit_priors is not None and barcode is None:
+            print("No barcode or voltage in %s! Not using the fit priors." % args.filename, file=sys.stderr)
+            fit_priors = None
+
         root_f = ROOT.TFile(args.output, "recreate")
                 
         if args.upload:
@@ -455,6 +531,19 @@ if __name__ == '__main__':
             result = cursor.fetchone()
             run = result[0]
         
+        # Maximum source charge in each trigger group for every event. Filled
+        # in while integrating the source waveforms.
+        trigger_charge = np.full(4, None)
+
+        # Rise, fall and hit time of every source event for each channel.
+        timing = {}
+        # Average source pulse for each channel.
+        pulses = {}
+        # Histogram of the good SPE charges of each channel. The SPE charges
+        # are only ever histogrammed, so they're added block by block instead
+        # of being kept for every event.
+        spe_charges = {}
+
         for group in f:
             if args.group is not None and group != args.group:
                 continue
@@ -462,63 +551,155 @@ if __name__ == '__main__':
             if group not in SOURCES and group != 'spe':
                 print("Unknown group name: \"%s\". Skipping..." % group)
                 continue
-            for channel in f[group]:
-                # All relevant channels from the scope and digitizer should
-                # be in this format: 'ch<channel number>'.
-                if not channel.startswith('ch'):
+
+            waveforms = WaveformSource(f, group, args.chunks)
+            # All relevant channels from the scope and digitizer should be in
+            # this format: 'ch<channel number>'.
+            channels = [channel for channel in waveforms.channels() if args.channel_mask & (1 << int(channel[2:]))]
+
+            if group == 'spe' and len(channels) > 0:
+                # Check the SPE integration window here so that we quit before
+                # integrating any blocks.
+                get_spe_window(waveforms.time(channels[0]), args.start_time, args.integration_time)
+
+            windows.clear()
+            if group == source and args.windows:
+                windows.update(read_windows(args.windows, group))
+
+            # Use the charges from integrate-waveforms if they were integrated
+            # from this file in the same way as we would. The waveforms are
+            # still needed for plotting.
+            integrals = None
+            if not (args.reintegrate or args.plot or args.print_pdfs) and len(channels) > 0:
+                if group == source:
+                    # The prescan always finds the same windows in the same
+                    # file, so if the integrals were prescanned with as many
+                    # events their windows are the ones we'd find and the
+                    # prescan is skipped.
+                    try:
+                        stored = read_windows(args.integrals, group)
+                    except (OSError, ValueError):
+                        stored = {}
+                    expected = {channel: windows.get(channel, stored.get(channel, (-1, -1))) for channel in channels}
+                    params = {}
+                    if any(channel not in windows for channel in channels):
+                        params['prescan'] = args.prescan
+                        if args.prescan == 0:
+                            params['chunks'] = args.chunks
+                else:
+                    expected = {channel: get_spe_window(waveforms.time(channel), args.start_time, args.integration_time) for channel in channels}
+                    params = {'integration_method': args.integration_method, 'start_time': args.start_time, 'window_start': args.start_time, 'integration_time': args.integration_time}
+                problem = check_integrals(args.integrals, f, group, channels, params, expected)
+                if problem is None:
+                    integrals = read_integrals(args.integrals, group)
+                    if group == source:
+                        windows.update({channel: window for channel, window in expected.items() if window != (-1, -1)})
+                else:
+                    print("Not using the integrals: %s" % problem)
+
+            if group == source and integrals is None and args.prescan > 0:
+                for trigger_channels in split_trigger_groups([channel for channel in channels if channel not in windows]):
+                    if len(trigger_channels) > 0:
+                        windows.update(estimate_windows(waveforms, trigger_channels, args.prescan, left=50, right=350))
+
+            # Read the same block of events for all the channels in a trigger
+            # group at once so that the trigger charge can be computed in the
+            # same pass.
+            trigger_groups = split_trigger_groups(channels)
+            charges = {}
+            for i, trigger_channels in enumerate(trigger_groups):
+                if len(trigger_channels) == 0:
                     continue
 
-                ch = int(channel[2:])
+                for channel in trigger_channels:
+                    if channel not in ch_data:
+                        ch_data[channel] = {'channel': int(channel[2:])}
+
+                    if args.upload:
+                        ch_data[channel]['run'] = run
+                        ch_data[channel]['barcode'] = data['barcode']
+
+                n = waveforms.n_events(trigger_channels[0])
+                if group == source:
+                    charges[i] = np.empty((len(trigger_channels), n))
+                    trigger_charge[i] = np.empty(n)
+                    for channel in trigger_channels:
+                        timing[channel] = {key: EventAccumulator(n) for key in TIMING_KEYS}
+                        pulses[channel] = PulseAccumulator(waveforms.time(channel))
+                else:
+                    for channel in trigger_channels:
+                        spe_charges[channel] = ChargeHistogram()
 
-                if not args.channel_mask & (1 << ch):
-                    continue
-                
-                if channel not in ch_data:
-                    ch_data[channel] = {'channel': ch}
-                
-                if args.upload:
-                    ch_data[channel]['run'] = run
-                    ch_data[channel]['barcode'] = data['barcode']
-                 
-                charge = []
-                
-                ##################
-                # Integrations
-                ##################
-                print(f'Integrating {group} {channel}...')
-                for i in range(0, len(f[group][channel]), args.chunks):
-                    x, y = convert_data(f, group, channel, i, i+args.chunks)
-                    if group == source:
-                        a, b = get_window(x,y, left=50, right=350)
-                        y -= np.median(y[:,x < x[0] + 100],axis=-1)[:,np.newaxis]
-                        if 'avg_pulse_y' in ch_data[channel]:
-                            ch_data[channel]['avg_pulse_y'] = (ch_data[channel]['avg_pulse_count']*ch_data[channel]['avg_pulse_y'] + len(y)*np.mean(y, axis=0)) / (ch_data[channel]['avg_pulse_count'] + len(y))
-                            ch_data[channel]['avg_pulse_count'] += len(y)
-                            np.append(ch_data[channel][f'{group}_rise_time'], get_rise_time(x, y))
-                            np.append(ch_data[channel][f'{group}_fall_time'], get_fall_time(x, y))
+                if integrals is None:
+                    print(f'Integrating {group} {" ".join(trigger_channels)}...')
+                else:
+                    print(f'Reading {group} {" ".join(trigger_channels)} from {args.integrals}...')
+
+            # Last block of results for each channel. Only used for plotting.
+            last = {}
+
+            ##################
+            # Integrations
+            ##################
+            if integrals is not None:
+                stored = read_pulses(integrals)
+                for i, trigger_channels in enumerate(trigger_groups):
+                    for j, channel in enumerate(trigger_channels):
+                        k = integrals['channels'].index(channel)
+                        n = integrals['n_events'][channel]
+                        if group == source:
+                            charges[i][j] = integrals['charge'][:n,k]
+                            pulses[channel] = stored[channel]
+                            timing[channel]['rise_time'].fill(0, n, integrals['t90'][:n,k] - integrals['t10'][:n,k])
+                            timing[channel]['fall_time'].fill(0, n, integrals['fall_time'][:n,k])
+                            timing[channel]['hit_time'].fill(0, n, integrals['t40'][:n,k])
                         else:
-                            ch_data[channel]['avg_pulse_y'] = np.mean(y, axis=0)
-                            ch_data[channel]['avg_pulse_count'] = len(y)
-                            ch_data[channel]['avg_pulse_x'] = x
-                            ch_data[channel][f'{group}_rise_time'] = get_rise_time(x, y)
-                            ch_data[channel][f'{group}_fall_time'] = get_fall_time(x, y)
-                        
-                    elif group == 'spe':
-                        a, b = get_spe_window(x, args.start_time, args.integration_time)
-                        y = spe_baseline_subtraction(x, y, a, b, method=args.integration_method)
-
-                    charge.extend(integrate(x,y, a, b))
-
-                ch_data[channel]['%s_charge' % group] = np.array(charge)
-                if args.plot or args.print_pdfs:
+                            # Only the events kept by the SPE baseline
+                            # subtraction.
+                            spe_charges[channel].add(integrals['charge'][:n,k][integrals['good'][:n,k] != 0])
+
+                    if group == source and len(trigger_channels) > 0:
+                        trigger_charge[i] = np.max(charges[i], axis=0)
+            else:
+                # The blocks are returned in order, so the results are the
+                # same no matter how many jobs we use.
+                for trigger_channels, start, stop, results in map_blocks(partial(integrate_block, windows=dict(windows)), waveforms, trigger_groups, pool):
+                    i = int(trigger_channels[0][2:])//8
+                    for j, channel in enumerate(trigger_channels):
+                        result = results[channel]
+                        if group == source:
+                            pulses[channel].merge(result['pulse'])
+                            for key in TIMING_KEYS:
+                                timing[channel][key].fill(start, stop, result[key])
+                            charges[i][j,start:stop] = result['charge']
+                        else:
+                            spe_charges[channel].add(result['charge'][result['good']])
+
+                        last[channel] = result
+
                     if group == source:
-                        avg_y = ch_data[channel]['avg_pulse_y']
-                    else:
-                        # avg_y for the spe waveform is only used for
-                        # plotting
-                        avg_y = np.mean(y, axis=0)
-                    plot_time_volt(x, y, channel, group, a, b, avg_y=avg_y, pdf=args.print_pdfs)
-        
+                        trigger_charge[i][start:stop] = np.max(charges[i][:,start:stop], axis=0)
+
+            for i, trigger_channels in enumerate(trigger_groups):
+                for j, channel in enumerate(trigger_channels):
+                    if group == source:
+                        ch_data[channel]['%s_charge' % group] = charges[i][j]
+                        ch_data[channel]['avg_pulse_x'] = pulses[channel].x
+                        ch_data[channel]['avg_pulse_y'] = pulses[channel].mean
+
+                    if (args.plot or args.print_pdfs) and channel in last:
+                        a, b = last[channel]['window']
+                        if group == source:
+                            avg_y = ch_data[channel]['avg_pulse_y']
+                        else:
+                            # avg_y for the spe waveform is only used for
+                            # plotting
+                            avg_y = last[channel]['mean']
+                        plot_time_volt(waveforms.time(channel), last[channel]['y'], channel, group, a, b, avg_y=avg_y, pdf=args.print_pdfs)
+
+        # All the waveforms have been integrated.
+        pool.close()
+
         neighbors = {}
         for i in range(32):
             neighbors[i] = []
@@ -526,18 +707,15 @@ if __name__ == '__main__':
                 if j != i and j//8 == i//8:
                     neighbors[i].append(j)
         
-        group_charges = np.full(4, None)
-        trigger_charge = np.full(4, None)
-        # Loop over each trigger group
-        # 0: ch0-7
-        # 1: ch8-15
-        # 2: ch16-23
-        # 3: ch24-31
-        for i in range(4):
-            group_charges[i] = np.array([ch_data[f'ch{ch}'][f'{source}_charge'] for ch in range(8*i, 8*(i+1)) if f'ch{ch}' in ch_data])
-            if len(group_charges[i]) > 0:
-                trigger_charge[i] = np.max(group_charges[i], axis=0)
-        
+        spe_fits = {}
+        if args.spe_fitter == 'numpy':
+            # Fit all the SPE histograms at once.
+            spe_channels = [channel for channel in ch_data if channel in spe_charges]
+            print('Fitting SPE %s!' % ', '.join(spe_channels))
+            spe_fits = dict(zip(spe_channels, fit_spe_batch([spe_charges[channel].values for channel in spe_channels], [get_bins(spe_charges[channel]) for channel in spe_channels], [spe_charges[channel].counts for channel in spe_channels])))
+
+        histograms = {}
+        selections = {}
         for channel in sorted(ch_data, key=lambda channel: int(channel[2:])):
             ch = int(channel[2:])
             ##################
@@ -552,8 +730,7 @@ if __name__ == '__main__':
                 event_charges = ch_data[channel][f'{source}_charge'][selection]
                 source_bins = get_bins(event_charges)
                 hsource = ROOT.TH1D(f"{source}_{channel}", f"{source.capitalize()} Charge Integral for {channel}", len(source_bins), source_bins[0], source_bins[-1])
-                for x in event_charges:
-                    hsource.Fill(x)
+                fill_histogram(hsource, event_charges)
                 hsource.GetXaxis().SetTitle("Charge (pC)")
                 hsource.Write()
                 
@@ -566,16 +743,22 @@ if __name__ == '__main__':
                 offset_selection = no_events & no_neighbor_events
                 offset_bins = get_bins(ch_data[channel][f'{source}_charge'][offset_selection])
                 hoffset = ROOT.TH1D(f"{source}_{channel}_pedestal", f"Pedestal {source.capitalize()} Charge Integral for {channel}", len(offset_bins), offset_bins[0], offset_bins[-1])
-                for x in ch_data[channel][f"{source}_charge"][offset_selection]:
-                    hoffset.Fill(x)
+                fill_histogram(hoffset, ch_data[channel][f"{source}_charge"][offset_selection])
                 hoffset.GetXaxis().SetTitle("Charge (pC)")
                 hoffset.Write()
 
-            if 'spe_charge' in ch_data[channel]:
-                spe_bins = get_bins(ch_data[channel]['spe_charge'])
+                # Average pulse with the standard deviation of each sample as
+                # the error.
+                pulse = pulses[channel]
+                gpulse = ROOT.TGraphErrors(len(pulse.x), array('d',pulse.x), array('d',pulse.mean), array('d',np.zeros(len(pulse.x))), array('d',np.nan_to_num(pulse.std())))
+                gpulse.SetName(f"{source}_{channel}_avg_pulse")
+                gpulse.SetTitle(f"Average {source.capitalize()} Pulse for {channel}; Time (ns); Voltage (V)")
+                gpulse.Write()
+
+            if channel in spe_charges:
+                spe_bins = get_bins(spe_charges[channel])
                 hspe = ROOT.TH1D("spe_%s" % channel, "SPE Charge Integral for %s" % channel, len(spe_bins), spe_bins[0], spe_bins[-1])
-                for x in ch_data[channel]['spe_charge']:
-                    hspe.Fill(x)
+                fill_histogram(hspe, spe_charges[channel].values, spe_charges[channel].counts)
                 hspe.GetXaxis().SetTitle("Charge (pC)")
                 hspe.Write()
 
@@ -585,8 +768,8 @@ if __name__ == '__main__':
             if args.upload:
                 # Assume lyso data if uploading because of earlier checks.
                 if 'lyso_charge' in ch_data[channel]:
-                    ch_data[channel]['lyso_rise_time'] = float(np.nanmedian(ch_data[channel]['lyso_rise_time']))
-                    ch_data[channel]['lyso_fall_time'] = float(np.nanmedian(ch_data[channel]['lyso_rise_time']))
+                    ch_data[channel]['lyso_rise_time'] = timing[channel]['rise_time'].median()
+                    ch_data[channel]['lyso_fall_time'] = timing[channel]['fall_time'].median()
                     ch_data[channel]['avg_pulse_x'] = list(map(float,ch_data[channel]['avg_pulse_x']))
                     ch_data[channel]['avg_pulse_y'] = list(map(float,ch_data[channel]['avg_pulse_y']))
                     source_bincenters = (source_bins[1:] + source_bins[:-1])/2
@@ -599,21 +782,38 @@ if __name__ == '__main__':
                     ch_data[channel]['avg_pulse_y'] = None
                     ch_data[channel]['lyso_charge_histogram_y'] = None
                     ch_data[channel]['lyso_charge_histogram_x'] = None
-                if 'spe_charge' in ch_data[channel]:
+                if channel in spe_charges:
                     spe_bincenters = (spe_bins[1:] + spe_bins[:-1])/2
-                    ch_data[channel]['spe_charge_histogram_y'] = list(map(float,np.histogram(ch_data[channel]['spe_charge'],bins=spe_bins)[0]))
+                    ch_data[channel]['spe_charge_histogram_y'] = list(map(float,np.histogram(spe_charges[channel].values,bins=spe_bins,weights=spe_charges[channel].counts)[0]))
                     ch_data[channel]['spe_charge_histogram_x'] = list(map(float,spe_bincenters))
                 else:
                     ch_data[channel]['spe_charge_histogram_y'] = None
                     ch_data[channel]['spe_charge_histogram_x'] = None
 
-            ##################
-            # Fitting Histogram
-            ##################
-            if 'spe_charge' in ch_data[channel]:
-                print('Fitting SPE %s!' % channel)
-                model = fit_spe_funcs.vinogradov_model()
-                spe_fit_pars = fit_spe_funcs.fit_spe(hspe, model)
+            histograms[channel] = (hspe if channel in spe_charges else None,
+                                   hoffset if f'{source}_charge' in ch_data[channel] else None,
+                                   hsource if f'{source}_charge' in ch_data[channel] else None)
+            selections[channel] = selection if f'{source}_charge' in ch_data[channel] else None
+
+        ##################
+        # Fitting Histograms
+        ##################
+        # The fits of each channel are independent, so they're done by a pool
+        # of `args.jobs` processes. The fitted objects are written to the
+        # output file in channel order either way.
+        channels = sorted(ch_data, key=lambda channel: int(channel[2:]))
+        priors = {}
+        if fit_priors is not None:
+            for channel in channels:
+                priors[channel] = {name: fit_priors.get(barcode, channel, name, voltage) for name in ('spe', source) if name is not None}
+        tasks = [(channel, source, *histograms[channel], args.spe_fitter, spe_fits.get(channel), args.fit_cache, args.analytic_gradients, priors.get(channel)) for channel in channels]
+        for channel, (spe_fit_pars, offset_pars, source_fit_pars, hspe, hsource, cached) in zip(channels, map_fits(fit_channel, tasks, fits)):
+            ch = int(channel[2:])
+            if fit_priors is not None:
+                for name, result, h in (('spe', spe_fit_pars, hspe), (source, source_fit_pars, hsource)):
+                    if result is not None and name not in cached:
+                        fit_priors.put(barcode, channel, name, voltage, result[0], fit_quality(h))
+            if channel in spe_charges:
                 if spe_fit_pars is not None:
                     ch_data[channel]['spe_fit_pars'] = spe_fit_pars[0]
                     ch_data[channel]['spe_fit_par_errors'] = spe_fit_pars[1]
@@ -623,38 +823,12 @@ if __name__ == '__main__':
                     ch_data[channel]['spe_fit_par_errors'] = None
                     ch_data[channel]['spe'] = None
                 plot_hist(hspe, pdf=args.print_pdfs, filename=args.filename)
-            
-            offset_pars = fit_gamma_funcs.fit_offset(hoffset) 
+
             if offset_pars is not None:
                 offset = offset_pars[0][0]
-                offset_sigma = offset_pars[0][1]
             else:
-                print(f'WARNING: Could not measure the pedestal in ch{ch}. Defaulting to zero pedestal.')
                 offset = 0
-                offset_sigma = 10
-            source_fit_pars = None
             if f'{source}_charge' in ch_data[channel]:
-                if source == 'lyso':
-                    print(f'Fitting LYSO {ch}')
-                    if 'spe_charge' in ch_data[channel] and spe_fit_pars is not None:
-                        model = fit_lyso_funcs.lyso_spectrum(spe_charge=spe_fit_pars[0][3]/ATTENUATION_FACTOR, offset=offset)
-                    else:
-                        model = fit_lyso_funcs.lyso_spectrum(offset=offset)
-
-                    if hsource.GetEntries() != 0:
-                        if ch in (7,8,23,24):
-                            # These channels are in the middle of a module and next
-                            # to an unpowered bar so we can't cut coincidences
-                            # properly, i.e. the charge distribution will have both
-                            # crosstalk and gammas from neighboring unpowered bars.
-                            # Therefore, we don't fix the gamma peak parameters
-                            # when doing these fits.
-                            source_fit_pars = fit_lyso_funcs.fit_lyso(hsource, model, fix_pars=False)
-                        else:
-                            source_fit_pars = fit_lyso_funcs.fit_lyso(hsource, model)
-                else:
-                    print(f'Fitting {source} {ch}!')
-                    source_fit_pars = fit_gamma_funcs.fit_gamma(hsource, SOURCES[source], offset=offset, offset_sigma=offset_sigma)
                 if source_fit_pars is not None:
                     ch_data[channel][f'{source}_fit_pars'] = source_fit_pars[0]
                     ch_data[channel][f'{source}_fit_par_errors'] = source_fit_pars[1]
@@ -664,7 +838,7 @@ if __name__ == '__main__':
                     ch_data[channel][f'{source}_fit_par_errors'] = None
                     ch_data[channel]['pc_per_kev'] = None
                 plot_hist(hsource, pdf=args.print_pdfs, filename=args.filename)
-            
+
             ##################
             # Finding Crosstalk
             ##################
@@ -676,8 +850,10 @@ if __name__ == '__main__':
                     # Here, we subtract the offset with the intention to make
                     # the crosstalk ratio positive. Note: later in the code we
                     # gain calibrate using the SPE charges.
-                    ch_data[channel]['ct'][f'ch{ct_ch}'] = ch_data[f'ch{ct_ch}'][f'{source}_charge'][selection] - offset
-                    ch_data[channel]['ct_ratio'][f'ch{ct_ch}'] = ch_data[channel]['ct'][f'ch{ct_ch}'] / (event_charges - offset)
+                    ch_data[channel]['ct'][f'ch{ct_ch}'] = ch_data[f'ch{ct_ch}'][f'{source}_charge'][selections[channel]] - offset
+                    ch_data[channel]['ct_ratio'][f'ch{ct_ch}'] = ch_data[channel]['ct'][f'ch{ct_ch}'] / (ch_data[channel][f'{source}_charge'][selections[channel]] - offset)
+
+        fits.close()
                 
             
     ##################
@@ -1,8 +1,11 @@
 import ROOT
+import multiprocessing
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 from scipy.optimize import curve_fit
 import matplotlib.pyplot as plt
 from pathlib import Path
+from btl.histograms import bin_centers, bin_contents
 
 def bi_modal(x, a1, m1, s1, a2, m2, s2, m, c):
     return (
@@ -13,204 +16,218 @@ def bi_modal(x, a1, m1, s1, a2, m2, s2, m, c):
     )
 
 def find_main_peak(hist, move_param):
-    for i in range(3):
-        if i == 0:
-            # bin = 0;       underflow bin
-            # bin = 1;       first bin with low-edge xlow INCLUDED
-            # bin = nbins;   last bin with upper-edge xup EXCLUDED
-            # bin = nbins+1; overflow bin
-            centers = np.array([hist.GetBinCenter(ibin) for ibin in range(1, hist.GetNbinsX())])
-            content = np.array([hist.GetBinContent(ibin) for ibin in range(1, hist.GetNbinsX())])
-            step=10
-            content = np.convolve(content, np.ones(step), "same") / step
-            A, mu = 0, 0
-            for ic, (ce, co) in enumerate(zip(centers[::-1], content[::-1])):
-                if ic < 10:
-                    continue
-                # co_ave10, ce_ave10 = np.mean(content[::-1][ic-5:ic+5]), np.mean(centers[::-1][ic-5:ic+5])
-                # co_ave10, ce_ave10 = np.mean(content[::-1][ic-10:ic+10]), np.mean(centers[::-1][ic-10:ic+10])
-                # if co_ave10 > A and co_ave10 > np.mean(content):
-                #     mu, A = ce_ave10, co_ave10
-                # if mu and co_ave10 < A*3/4:
-                #     break
-                left = np.mean(content[::-1][ic:ic+move_param])
-                right = np.mean(content[::-1][ic-move_param:ic])
-                center = np.mean(content[::-1][ic-3:ic+3])
-                if center > left and center > right and center > np.mean(content) and abs(left-right)*2/(left+right) < 0.1:# and center > A:
-                    mu, A = ce, co
-                    # print(hist.GetName(), mu, A)
-                    return mu, A
+    # bin = 0;       underflow bin
+    # bin = 1;       first bin with low-edge xlow INCLUDED
+    # bin = nbins;   last bin with upper-edge xup EXCLUDED
+    # bin = nbins+1; overflow bin
+    nbins = hist.GetNbinsX()
+    return _find_main_peak(bin_centers(hist)[1:nbins], bin_contents(hist)[1:nbins], move_param)
+
+def _window_means(y, width):
+    """
+    Returns the mean of y[i:i+width] for every i, which for the last
+    `width - 1` values are the means of the shorter slices up to the end.
+    """
+    if width > len(y):
+        return np.array([np.mean(y[i:]) for i in range(len(y))])
+    # np.mean() of each row sums the same way as np.mean() of each slice, so
+    # the means are exactly the same.
+    means = sliding_window_view(y, width).mean(axis=1)
+    return np.concatenate((means, [np.mean(y[i:]) for i in range(len(y) - width + 1, len(y))]))
+
+def _find_main_peak(centers, content, move_param):
+    """
+    Looks for the main peak going from the right to the left, i.e. the first
+    bin (at least 10 bins from the right edge) where the smoothed content is
+    above the mean and the average of the 6 bins around it is above the
+    averages of the `move_param` bins on either side, which are within 10%
+    of each other. Returns its center and smoothed content or (0, 0) if
+    there's none.
+    """
+    step=10
+    content = np.convolve(content, np.ones(step), "same") / step
+    reverse = content[::-1]
+    n = len(reverse)
+    if n <= 10:
         return 0,0
+    ic = np.arange(10, n)
+    # left is the mean of reverse[ic:ic+move_param], right of
+    # reverse[ic-move_param:ic] and center of reverse[ic-3:ic+3].
+    means = _window_means(reverse, move_param)
+    left = means[ic]
+    right = np.full(len(ic), np.nan)
+    inside = ic >= move_param
+    right[inside] = means[ic[inside]-move_param]
+    # A slice starting at a negative index, which is empty unless move_param
+    # is longer than the histogram.
+    right[~inside] = [np.mean(y) if len(y) else np.nan for y in (reverse[i-move_param:i] for i in ic[~inside])]
+    center = _window_means(reverse, 6)[ic-3]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        peak = (center > left) & (center > right) & (center > np.mean(content)) & (abs(left-right)*2/(left+right) < 0.1)
+    if not peak.any():
+        return 0,0
+    i = ic[np.argmax(peak)]
+    return centers[::-1][i], reverse[i]
 
-def fit_modified(file_path, CHANNEL, source):
-    fit_info = {}
-    fit_info[CHANNEL] = {}
-    #plt.figure(figsize=(8, 6))
-    # Open the ROOT file
-    file = ROOT.TFile.Open(file_path)
+def histogram_arrays(hist):
+    """
+    Returns a dictionary with the bin centers and contents of the histogram
+    `hist` for all the bins including the underflow and overflow bins, and
+    its binning. This is everything fit_histogram() needs, so it can be sent
+    to other processes.
+    """
+    n = hist.GetNbinsX() + 2
+    axis = hist.GetXaxis()
+    return {
+        'centers': bin_centers(hist),
+        'content': bin_contents(hist).astype(np.float64),
+        'nbins': axis.GetNbins(),
+        'xmin': axis.GetXmin(),
+        'xmax': axis.GetXmax(),
+    }
 
-    # Retrieve the "sodium_ch0" tree from the file
-    sodium_tree = file.Get(f"{source}_ch{CHANNEL}")
-    bin_width = sodium_tree.GetBinWidth(30)
-
-    # Get the number of entries in the tree
-    num_entries = len(sodium_tree)
-
-    sodium_tree = file.Get(f"{source}_ch{CHANNEL};1")
-    num_entries = len(sodium_tree)
-    sodium_data = np.zeros(num_entries)
-    bins = np.zeros(num_entries)
-
-    hard_edge = sodium_tree.GetBinCenter(0)
-    for i in range(num_entries):
-        sodium_data[i] = sodium_tree.GetBinContent(i)
-        bins[i] = sodium_tree.GetBinCenter(i)
-    
-    #idx_start = sodium_tree.FindBin(200)
-    # Close the ROOT file
+def _find_bin(x, nbins, xmin, xmax):
+    """
+    Returns the bin of `x` like TAxis::FindBin() for equal bins.
+    """
+    if x < xmin:
+        return 0
+    if not x < xmax:
+        return nbins + 1
+    return 1 + int(nbins*(x-xmin)/(xmax-xmin))
+
+def _smooth_slice(y, smooth, start, step=10):
+    """
+    Returns np.convolve(y[start:-1], np.ones(step), "same") / step where
+    `smooth` is the same for all of `y`. Away from the ends of the slice the
+    two are the same, so only the first and last few values are computed
+    again.
+    """
+    n = len(y) - 1 - start
+    if n <= 2*step:
+        return np.convolve(y[start:-1], np.ones(step), "same") / step
+    left = step//2
+    right = step - left - 1
+    rv = smooth[start:start+n].copy()
+    rv[:left] = (np.convolve(y[start:start+2*step], np.ones(step), "same") / step)[:left]
+    if right:
+        rv[n-right:] = (np.convolve(y[start+n-2*step:start+n], np.ones(step), "same") / step)[2*step-right:]
+    return rv
+
+def fit_histogram(hist, CHANNEL=None, warm_start=False):
+    """
+    Fits the bimodal function to the histogram `hist` returned by
+    histogram_arrays() for each starting point of the sweep over the lower
+    cutoff, and returns the parameters and chi-squared per point of the fit
+    with the lowest chi-squared.
+
+    If `warm_start` is True, each fit in the sweep starts from the
+    parameters of the previous one instead of the guesses from the
+    histogram, which needs fewer iterations but can end up in a different
+    minimum.
+    """
+    fit_info = {}
     found_fit = False
 
+    sodium_data = hist['content']
+    bins = hist['centers']
+    nbins, xmin, xmax = hist['nbins'], hist['xmin'], hist['xmax']
+    hard_edge = bins[0]
+    # Smooth the data for the fitting. This is the same for every point of
+    # the sweep except at the ends of the fit range.
+    step = 10
+    smooth = np.convolve(sodium_data, np.ones(step), "same") / step
+    last = None
+
     #to set the upper bound that we sweep over, determine maximum after 100, then divide by two, and add buffer
     #sweep in increments of 10, starting from 50 lower than upper bound
     peak_distance_param = 2
-    #print(sodium_tree.FindBin(100)+1)
     for move_param in [5,10]:
-        mu, A = find_main_peak(sodium_tree, move_param)
-        #print(mu,A)
-        initial_cuts = np.arange(100, 200, 10)
+        mu, A = _find_main_peak(bins[1:nbins], sodium_data[1:nbins], move_param)
         peak_position = np.argmin(abs(bins-mu))
-        #for initial_cut in initial_cuts:
-            #maxPosition = np.argmax(sodium_data[sodium_tree.FindBin(initial_cut)+1:])+sodium_tree.FindBin(initial_cut)+1
-            #print("maxPosition: ", maxPosition)
-            #print("max X Position: ", sodium_tree.GetBinCenter(int(maxPosition)))
-            #print(sodium_tree.GetBinCenter(int(maxPosition)))
-        end_sweep = sodium_tree.GetBinCenter(int(peak_position))/peak_distance_param
-        #print("end_sweep: ", end_sweep)
+        end_sweep = bins[int(peak_position)]/peak_distance_param
         back_param = 50; buffer = 0
         if end_sweep-back_param < hard_edge:
             back_param = end_sweep - hard_edge
         if end_sweep < hard_edge:
             end_sweep = hard_edge; back_param = 0; buffer=10
-            #print("back_Param =0")
         for start_bin in np.arange(end_sweep-back_param, end_sweep+buffer, 10):
-            fit_info[CHANNEL][(start_bin, move_param)] = {}
-            idx_start = sodium_tree.FindBin(start_bin)
-            #file.Close()
-            
-            x = bins
-            y = sodium_data
-            x_original = bins
-            y_original = sodium_data
-        
-            # smooth the data
-            '''
-            step = 100
-            y_smooth = np.convolve(y, np.ones(step), "same") / step
-            # plt.plot(x, y, label="Smoothed data")
-        
-            # find the first local minimum for the cutoff
-            
-            idx_min_1 = 0
-            for i in range(idx_start, len(y_smooth)):
-                if y_smooth[i] < y_smooth[i - 1] and y_smooth[i] < y_smooth[i + 1]:
-                    idx_min_1 = i
-                    break
-            #print("idx_min_1", idx_min_1)
-            
-            '''
-            #idx_min_1=0
-            #list local maxima
-            step = 40
-            y_smooth_max = np.convolve(y, np.ones(step), "same") / step
-            # plt.plot(x, y, label="Smoothed data")
-            
-            # find the first local minimum for the cutoff
-            '''
-            maxima = []
-            for i in range(1, len(y_smooth_max)):
-                if y_smooth_max[i] > y_smooth_max[i - 1] and y_smooth_max[i] > y_smooth_max[i + 1]:
-                    maxima.append(i*bin_width*len(y_smooth_max)/num_entries)
-                    
-            #print(maxima)
-            '''
-            idx_end = -1
-            
-            
-             # smooth the data
-            step = 30
-            y_smooth = np.convolve(y, np.ones(step), "same") / step
-        
-            
+            fit_info[(start_bin, move_param)] = {}
+            idx_start = _find_bin(start_bin, nbins, xmin, xmax)
+
             idx_max_2 = peak_position
             idx_max_1 = int((idx_max_2 - idx_start) / peak_distance_param + idx_start)
-        
-            #idx_start = idx_max_1 - 10
-            '''
-            plt.axvline(x=x[idx_start], color="black", linestyle="--", label="Lower cutoff")
-            plt.axvline(x=x[idx_max_1], color="blue", linestyle="--", label="Peak 1 Guess")
-            plt.axvline(x=x[idx_max_2], color="red", linestyle="--", label="Peak 2 Guess")
-            plt.axvline(x=x[idx_end], color="black", linestyle="--", label="Upper cutoff")
-            '''
-        
-        
+
             # cut the data
-            x = x[idx_start:idx_end]
-            y = y[idx_start:idx_end]
+            x = bins[idx_start:-1]
+            y = _smooth_slice(sodium_data, smooth, idx_start, step)
             idx_max_2 -= idx_start
             idx_max_1 -= idx_start
-        
-            # smooth the data for the fitting (need more details)
-            # step = 10
-            step = 10
-            y = np.convolve(y, np.ones(step), "same") / step
-            #if y[idx_max_2]<num_events/1000: print("continuing"); continue;
+
             # Initial guess for the parameters
-            #print(y[idx_max_2], x[idx_max_2])
             p0_bi = [
                 # a, mean, sigma
-                y[idx_max_1], x[idx_max_1], 10, 
-                y[idx_max_2], x[idx_max_2], 10, 
+                y[idx_max_1], x[idx_max_1], 10,
+                y[idx_max_2], x[idx_max_2], 10,
                 # m, c
                 -0.01, 10]
-            #print(y[idx_max_2])
             low = -10000; high = 10000
-            #bounds = ([low, low, low, num_events/1000, low, low, -0.1, low],[high, high, high, high, high, high, 0, high])
             bounds = ([y[idx_max_1]/5, low, low, low, low, low, -0.01, low],[y[idx_max_1]*5, high, high, high, high, high, 0, high])
+            if warm_start and last is not None:
+                p0_bi = np.clip(last, bounds[0], bounds[1])
             # Perform the curve fitting
             x = x[5:]
             y = y[5:]
             try:
                 popt, pcov = curve_fit(bi_modal, x, y, p0=p0_bi, bounds=bounds)
                 found_fit = True
-            
             except RuntimeError:
-                continue 
-            a1, m1, s1, a2, m2, s2, m, c = popt
-        
+                continue
+            last = popt
+
             chi2 = np.sum((bi_modal(x, *popt) - y) ** 2)
-    
-            
-            fit_info[CHANNEL][(start_bin, move_param)]["Param_List"] = [a1, m1, s1, a2, m2, s2, m, c]
-            fit_info[CHANNEL][(start_bin, move_param)]["Chi-Squared"] = chi2/len(x)
+
+            fit_info[(start_bin, move_param)]["Param_List"] = list(popt)
+            fit_info[(start_bin, move_param)]["Chi-Squared"] = chi2/len(x)
 
     if not found_fit:
         print(f"Fit does not converge for channel {CHANNEL}")
         return 0,0,0,0,0,0,0,0,0
-        
+
     min_chi2 = 100000000; bestKey = 0
-    for key, value in fit_info[CHANNEL].items():
+    for key, value in fit_info.items():
         if "Chi-Squared" not in list(value.keys()): continue;
         if value["Chi-Squared"] < min_chi2:
             min_chi2 = value["Chi-Squared"]
             bestKey = key
-    
-    #print(bestKey)
-
-    #print("Best Key: ", bestKey)
-    # Generate points for the fitted curve
-    x_fit = np.linspace(bestKey[0], np.max(x), 1000)
-    #y_fit = bi_modal(x_fit, a1, m1, s1, a2, m2, s2, m, c)
-    #print(x_fit)
-    y_fit = bi_modal(x_fit, *fit_info[CHANNEL][bestKey]["Param_List"])
-    #print(ch, ": ",fit_info[CHANNEL][bestKey]["Param_List"])
-    return fit_info[CHANNEL][bestKey]["Param_List"],fit_info[CHANNEL][bestKey]["Chi-Squared"]
+
+    return fit_info[bestKey]["Param_List"],fit_info[bestKey]["Chi-Squared"]
+
+def _fit_histogram(task):
+    return fit_histogram(*task)
+
+def fit_modified_batch(file_path, channels, source, jobs=1, warm_start=False):
+    """
+    Returns a dictionary mapping each channel in `channels` to the same
+    result as fit_modified(file_path, channel, source), but only opens the
+    file once. If `jobs` is greater than one, the channels are fit by a pool
+    of `jobs` processes.
+    """
+    file = ROOT.TFile.Open(file_path)
+    hists = [histogram_arrays(file.Get(f"{source}_ch{channel};1")) for channel in channels]
+    file.Close()
+
+    tasks = [(hist, channel, warm_start) for hist, channel in zip(hists, channels)]
+    if jobs <= 1:
+        results = list(map(_fit_histogram, tasks))
+    else:
+        with multiprocessing.get_context('fork').Pool(jobs) as pool:
+            results = pool.map(_fit_histogram, tasks)
+    return dict(zip(channels, results))
+
+def fit_modified(file_path, CHANNEL, source):
+    # Open the ROOT file
+    file = ROOT.TFile.Open(file_path)
+    hist = histogram_arrays(file.Get(f"{source}_ch{CHANNEL};1"))
+    file.Close()
+    return fit_histogram(hist, CHANNEL)
@@ -0,0 +1,214 @@
+"""
+Accumulators for per channel quantities which are filled block by block
+while integrating the waveforms.
+
+Example:
+
+    rise_time = EventAccumulator(waveforms.n_events(channel))
+    for start, stop, x, y in waveforms.iter_blocks([channel]):
+        rise_time.fill(start, stop, pulse_features(x, y[0])['rise_time'])
+    print(rise_time.median())
+"""
+from __future__ import print_function, division
+import numpy as np
+
+class EventAccumulator(object):
+    """
+    Stores a single float32 value for each of the `n` events of a channel,
+    e.g. the rise time. The values are written into a preallocated array, so
+    memory use is fixed at 4 bytes per event no matter how the events are
+    split into blocks. Events which were never filled are NaN and are ignored
+    by the summaries.
+    """
+    def __init__(self, n):
+        self.values = np.full(n, np.nan, dtype=np.float32)
+
+    def fill(self, start, stop, values):
+        """
+        Sets the values for the events from `start` to `stop`.
+        """
+        self.values[start:stop] = values
+
+    def count(self):
+        """
+        Returns the number of events with a value.
+        """
+        return int(np.count_nonzero(~np.isnan(self.values)))
+
+    def percentile(self, q):
+        """
+        Returns the `q`th percentile(s) of the values, or NaN if there are
+        none.
+        """
+        if self.count() == 0:
+            return np.full(np.shape(q), np.nan) if np.ndim(q) else np.nan
+        return np.nanpercentile(self.values, q)
+
+    def median(self):
+        return float(self.percentile(50))
+
+    def iqr(self):
+        q25, q75 = self.percentile([25, 75])
+        return float(q75 - q25)
+
+    def summary(self):
+        """
+        Returns a dictionary with the number of events, the median, the
+        interquartile range and the 10th and 90th percentiles.
+        """
+        p10, p25, p50, p75, p90 = map(float, self.percentile([10, 25, 50, 75, 90]))
+        return {'count': self.count(), 'median': p50, 'iqr': p75 - p25, 'p10': p10, 'p90': p90}
+
+class PulseAccumulator(object):
+    """
+    Running mean, variance and percentile bands of the waveforms of a
+    channel with sample times `x`, e.g. for the average pulse.
+
+    The mean and variance are accumulated in double precision with Welford's
+    algorithm (merging whole blocks at a time), so they don't lose precision
+    however many events are added. The `percentiles` bands of each sample are
+    the percentiles within each block averaged over the blocks weighted by the
+    number of events, which is a good approximation as long as the blocks are
+    large.
+
+    Accumulators for different blocks (e.g. from different worker processes)
+    can be combined with `merge()`. The result only depends on the order in
+    which blocks are merged.
+    """
+    def __init__(self, x, percentiles=(10, 90)):
+        self.x = np.asarray(x)
+        self.percentiles = tuple(percentiles)
+        self.count = 0
+        self.mean = np.zeros(len(x))
+        self.m2 = np.zeros(len(x))
+        self.bands = np.zeros((len(self.percentiles), len(x)))
+
+    def add(self, y, baseline=None):
+        """
+        Adds the waveforms in `y`. If `baseline` is given, it is subtracted
+        from each waveform first. Returns self.
+        """
+        if len(y) == 0:
+            return self
+        if baseline is not None:
+            y = y - baseline[:,np.newaxis]
+        block = PulseAccumulator(self.x, self.percentiles)
+        block.count = len(y)
+        block.mean = np.mean(y, axis=0, dtype=np.float64)
+        block.m2 = np.var(y, axis=0, dtype=np.float64)*len(y)
+        block.bands = np.percentile(y, self.percentiles, axis=0)
+        return self.merge(block)
+
+    def merge(self, other):
+        """
+        Adds all the waveforms of the accumulator `other`. Returns self.
+        """
+        if other.count == 0:
+            return self
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta*other.count/count
+        self.m2 = self.m2 + other.m2 + delta**2*self.count*other.count/count
+        self.bands = (self.count*self.bands + other.count*other.bands)/count
+        self.count = count
+        return self
+
+    def variance(self):
+        """
+        Returns the sample variance of each sample.
+        """
+        if self.count < 2:
+            return np.full(len(self.x), np.nan)
+        return self.m2/(self.count - 1)
+
+    def std(self):
+        return np.sqrt(self.variance())
+
+    def band(self, q):
+        """
+        Returns the `q`th percentile of each sample. `q` must be one of
+        `percentiles`.
+        """
+        return self.bands[self.percentiles.index(q)]
+
+class ChargeHistogram(object):
+    """
+    Histogram of the charges of a channel with one bin for each multiple of
+    `resolution` (in pC), stored sparsely as the multiples which have been
+    seen and their counts. It is filled block by block with `add()`, so the
+    charges of the events don't have to be kept, and its memory use is
+    bounded by the range of the charges divided by `resolution` however many
+    events there are.
+
+    Each charge is rounded to the nearest multiple of `resolution`, so the
+    percentiles are within `resolution/2` of `np.percentile()` of the
+    charges, and histograms filled from `values` and `counts` only differ
+    from ones filled with the charges for charges within `resolution/2` of a
+    bin edge. Charges must be finite.
+    """
+    def __init__(self, resolution=1e-4):
+        self.resolution = resolution
+        self.keys = np.empty(0, dtype=np.int64)
+        self.counts = np.empty(0, dtype=np.int64)
+
+    def add(self, x):
+        """
+        Adds the charges in `x`. Returns self.
+        """
+        x = np.asarray(x, dtype=np.float64).ravel()
+        if len(x) == 0:
+            return self
+        block = ChargeHistogram(self.resolution)
+        block.keys, block.counts = np.unique(np.rint(x/self.resolution).astype(np.int64), return_counts=True)
+        return self.merge(block)
+
+    def merge(self, other):
+        """
+        Adds all the charges of the histogram `other`, which must have the
+        same `resolution`. Returns self.
+        """
+        if other.resolution != self.resolution:
+            raise ValueError("can't merge histograms with different resolutions")
+        keys, index = np.unique(np.concatenate((self.keys, other.keys)), return_inverse=True)
+        self.counts = np.bincount(index, weights=np.concatenate((self.counts, other.counts)), minlength=len(keys)).astype(np.int64)
+        self.keys = keys
+        return self
+
+    @property
+    def values(self):
+        """
+        The rounded charges in increasing order. Each one appears `counts`
+        times.
+        """
+        return self.keys*self.resolution
+
+    def count(self):
+        """
+        Returns the number of charges.
+        """
+        return int(np.sum(self.counts))
+
+    def percentile(self, q):
+        """
+        Returns the `q`th percentile(s) of the charges with the same linear
+        interpolation as `np.percentile()`, or NaN if there are none.
+        """
+        n = self.count()
+        if n == 0:
+            return np.full(np.shape(q), np.nan) if np.ndim(q) else np.nan
+        # Position of each percentile in the sorted charges and the values
+        # of the charges just below and above it.
+        rank = np.asarray(q, dtype=np.float64)/100*(n - 1)
+        lower = np.floor(rank)
+        cumulative = np.cumsum(self.counts)
+        values = self.values
+        below = values[np.searchsorted(cumulative, lower, side='right')]
+        above = values[np.searchsorted(cumulative, np.minimum(lower + 1, n - 1), side='right')]
+        return below + (rank - lower)*(above - below)
+
+    def median(self):
+        return float(self.percentile(50))
+
+    def iqr(self):
+        q25, q75 = self.percentile([25, 75])
+        return float(q75 - q25)
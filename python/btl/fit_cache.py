@@ -0,0 +1,208 @@
+"""
+A disk cache of histogram fits, so that reanalyzing the same data only refits
+the histograms which changed.
+
+A fit is looked up by a hash of the histogram (name, binning, bin contents,
+statistics and axis range), the name of the fit function, the `FIT_VERSION`
+of its module and a tuple of anything else the fit depends on, e.g. the
+pedestal. Each entry stores the fit parameters, errors, chi2 and status
+along with everything the fit wrote to the current ROOT directory and the
+functions it attached to the histogram. On a hit the fit isn't run: the
+stored objects are written again and the histogram is restored to how the
+fit left it, so the output file and plots are the same as when fitting.
+
+Entries are pickle files in a single directory. Reading an entry touches it,
+and whenever the directory grows past `max_bytes` the least recently used
+entries are deleted. Entries are written to a temporary file and then
+renamed, so several processes (e.g. the workers of `map_fits()`) can share a
+cache.
+
+Example:
+
+    cache = FitCache(expanduser('~/.cache/btl/fits'))
+    spe_fit_pars = cached_fit(cache, fit_spe, h, model, version=fit_spe_funcs.FIT_VERSION)
+"""
+from __future__ import print_function, division
+import hashlib
+import os
+import pickle
+import tempfile
+import numpy as np
+from .histograms import bin_contents
+from . import fit_results
+
+# Bump this whenever the format of the entries changes.
+CACHE_VERSION = 1
+
+def histogram_hash(h, name, version, key=()):
+    """
+    Returns the cache key for fitting the TH1 `h` with the function `name`
+    of version `version`, where `key` is a tuple of anything else the fit
+    depends on.
+    """
+    axis = h.GetXaxis()
+    nbins = h.GetNbinsX()
+    stats = np.zeros(4)
+    h.GetStats(stats)
+    sha = hashlib.sha1()
+    # What the fits write depends on SAVE_FIT_FUNCTIONS.
+    sha.update(repr((CACHE_VERSION, name, version, tuple(key), fit_results.SAVE_FIT_FUNCTIONS)).encode())
+    sha.update(repr((h.GetName(), nbins, axis.GetXmin(), axis.GetXmax(), axis.GetFirst(), axis.GetLast(), h.GetEntries())).encode())
+    sha.update(np.asarray(bin_contents(h), dtype=np.float64).tobytes())
+    sha.update(stats.tobytes())
+    return sha.hexdigest()
+
+class FitCache(object):
+    """
+    Fit cache in the directory `path`, which is created if it doesn't exist,
+    holding at most about `max_bytes` of entries. `last_hit` is True if the
+    result of the last call to `fit()` came from the cache.
+    """
+    def __init__(self, path, max_bytes=256*2**20):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.last_hit = False
+        os.makedirs(path, exist_ok=True)
+
+    def filename(self, key):
+        return os.path.join(self.path, key + '.pkl')
+
+    def get(self, key):
+        """
+        Returns the entry for `key`, or None if there isn't one.
+        """
+        filename = self.filename(key)
+        try:
+            with open(filename, 'rb') as f:
+                entry = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        try:
+            os.utime(filename)
+        except OSError:
+            pass
+        return entry
+
+    def put(self, key, entry):
+        """
+        Stores `entry` under `key` and evicts the least recently used entries
+        if the cache is too big.
+        """
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, self.filename(key))
+        except Exception:
+            os.unlink(tmp)
+            raise
+        self.evict()
+
+    def evict(self):
+        """
+        Deletes the least recently used entries until the cache holds at most
+        `max_bytes`.
+        """
+        entries = []
+        for entry in os.scandir(self.path):
+            if entry.name.endswith('.pkl'):
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for mtime, size, filename in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(filename)
+            except OSError:
+                pass
+            total -= size
+
+    def fit(self, func, h, *args, **kwargs):
+        """
+        Returns `func(h, *args, **kwargs)` for a fit function which returns
+        the fit parameters and errors or None if the fit fails, e.g.
+        `fit_spe()`.
+
+        The keyword arguments `version` (the `FIT_VERSION` of the module of
+        `func`) and `key` (a tuple of everything else besides `h` the fit
+        depends on, since the arguments themselves may not have a stable
+        representation) are used for the cache key and not passed to `func`.
+        Starting values, like the `prior` of the fit functions, should be left
+        out of `key`, so that the cache still hits when they change. They're
+        only used on a miss.
+        """
+        version = kwargs.pop('version', None)
+        key = histogram_hash(h, '%s.%s' % (func.__module__, func.__name__), version, kwargs.pop('key', ()))
+
+        entry = self.get(key)
+        self.last_hit = entry is not None
+        if entry is not None:
+            restore(h, entry)
+            return None if entry['status'] != 'ok' else (entry['pars'], entry['errors'])
+
+        # ROOT is only imported to fit or restore a fit, so the cache itself
+        # works without it.
+        from .fit_scheduler import capture_writes
+        result, objects = capture_writes(func, h, *args, **kwargs)
+        for name, obj in objects:
+            obj.Write(name)
+        self.put(key, make_entry(h, result, objects))
+        return result
+
+def cached_fit(cache, func, h, *args, **kwargs):
+    """
+    Returns `cache.fit(func, h, *args, **kwargs)`, or just calls `func(h,
+    *args, **kwargs)` without the `version` and `key` keyword arguments if
+    `cache` is None.
+    """
+    if cache is None:
+        kwargs.pop('version', None)
+        kwargs.pop('key', None)
+        return func(h, *args, **kwargs)
+    return cache.fit(func, h, *args, **kwargs)
+
+def make_entry(h, result, objects):
+    """
+    Returns the cache entry for the fit result `result` of the TH1 `h`, where
+    `objects` is the list of (name, object) written by the fit.
+    """
+    import ROOT
+    # Besides the fitted TF1s this includes e.g. the markers TSpectrum adds.
+    functions = [obj.Clone() for obj in h.GetListOfFunctions()]
+    fits = [f for f in functions if isinstance(f, ROOT.TF1)]
+    axis = h.GetXaxis()
+    return {
+        'status': 'ok' if result is not None else 'failed',
+        'pars': list(result[0]) if result is not None else None,
+        'errors': list(result[1]) if result is not None else None,
+        'chi2': fits[-1].GetChisquare() if fits else None,
+        'ndf': fits[-1].GetNDF() if fits else None,
+        'objects': objects,
+        'functions': functions,
+        'range': (axis.GetFirst(), axis.GetLast()),
+        'minimum': h.GetMinimumStored(),
+        'maximum': h.GetMaximumStored(),
+    }
+
+def restore(h, entry):
+    """
+    Writes the objects of the cache entry `entry` to the current directory
+    and restores the functions and axis range of the TH1 `h` as they were
+    after the fit.
+    """
+    import ROOT
+    for name, obj in entry['objects']:
+        obj.Write(name)
+    functions = h.GetListOfFunctions()
+    functions.Delete()
+    for obj in entry['functions']:
+        obj = obj.Clone()
+        ROOT.SetOwnership(obj, False)
+        functions.Add(obj)
+    h.GetXaxis().SetRange(*entry['range'])
+    h.SetMinimum(entry['minimum'])
+    h.SetMaximum(entry['maximum'])
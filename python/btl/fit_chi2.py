@@ -0,0 +1,159 @@
+"""
+Chi-square fits of histograms to models which evaluate all the bins at once.
+
+`fit_chi2()` does the same fit as `h.Fit(f,"S","",xmin,xmax)` for a TF1 `f`
+made from a Python model, but Minuit minimizes a chi-square function which
+evaluates the model for all the bins with a single call instead of calling
+`f` once for every bin. If the model also has a `gradient()` method, the fit
+can use the analytic derivatives instead of Minuit estimating them with
+finite differences, which costs two model evaluations per free parameter
+for every gradient.
+
+A model passed to `fit_chi2()` has the methods:
+
+    evaluate(x, p)  returns the model at each of the charges `x` for the
+                    parameters `p`
+    gradient(x, p)  returns the model and the (len(x) x len(p)) matrix of its
+                    derivatives with respect to the parameters (only needed
+                    with `gradient=True`)
+
+Example:
+
+    f = ROOT.TF1("%s_fit" % h.GetName(), model, 0, 1000, 9)
+    result = fit_chi2(h, f, model, 100, 800, gradient=True)
+    print(result.NCalls())
+"""
+from __future__ import print_function, division
+import ctypes
+import sys
+import numpy as np
+import ROOT
+from .histograms import bin_centers, bin_contents, bin_errors
+
+# Passes a GradFunctor to the overload of FitFCN() for gradient functions.
+# Left to PyROOT, the overload for functions without a gradient might be
+# picked since a GradFunctor is both.
+FIT_GRAD_FCN_CPP = """
+#include "Fit/Fitter.h"
+#include "Math/IFunction.h"
+
+namespace btl {
+
+bool fit_grad_fcn(ROOT::Fit::Fitter &fitter, const ROOT::Math::IMultiGradFunction &fcn, unsigned int size)
+{
+    return fitter.FitFCN(fcn, nullptr, size, true);
+}
+
+}
+"""
+
+def _grad_functor(chi2, gradient, npar):
+    """
+    Returns a GradFunctor for the chi-square function `chi2(p)` and its
+    derivative `gradient(p, i)` with respect to parameter i, or None if this
+    version of ROOT can't make one from Python functions.
+    """
+    if not hasattr(ROOT, 'btl') or not hasattr(ROOT.btl, 'fit_grad_fcn'):
+        if not ROOT.gInterpreter.Declare(FIT_GRAD_FCN_CPP):
+            return None
+    try:
+        return ROOT.Math.GradFunctor(chi2,gradient,npar)
+    except TypeError:
+        return None
+
+def fit_chi2(h, f, model, xmin, xmax, quiet=False, gradient=False):
+    """
+    Fits the TF1 `f`, which evaluates `model`, to the histogram `h` from
+    `xmin` to `xmax`. This is the same chi-square fit as
+    `h.Fit(f,"S","",xmin,xmax)` (the bins with centers in the range and in the
+    axis range, skipping empty bins), but the model is evaluated for all the
+    bins with a single call to `model.evaluate()`. If `gradient` is True,
+    Minuit is given the derivatives of the chi-square from
+    `model.gradient()`.
+
+    The starting values, limits and fixed parameters are taken from `f`, and
+    the fitted parameters and errors are set on `f` and a copy of it is
+    stored with the histogram like h.Fit() does. Returns the FitResult.
+    """
+    axis = h.GetXaxis()
+    bins = np.arange(axis.GetFirst(),axis.GetLast()+1)
+    x = bin_centers(h)[bins]
+    error = bin_errors(h)[bins]
+    selected = (xmin <= x) & (x <= xmax) & (error > 0)
+    bins = bins[selected]
+    x = x[selected]
+    y = bin_contents(h)[bins].astype(np.float64)
+    error = error[selected]
+
+    npar = f.GetNpar()
+
+    def chi2(p):
+        p = [p[i] for i in range(npar)]
+        return float(np.sum(((y - model.evaluate(x,p))/error)**2))
+
+    # Minuit asks for the derivatives one parameter at a time, so keep the
+    # gradient for the last parameters.
+    last = {}
+    def chi2_gradient(p, i):
+        p = tuple([p[j] for j in range(npar)])
+        if last.get('p') != p:
+            values, jacobian = model.gradient(x,p)
+            last['p'] = p
+            last['gradient'] = -2*np.dot((y - values)/error**2,jacobian)
+        return float(last['gradient'][i])
+
+    fcn = None
+    if gradient:
+        fcn = _grad_functor(chi2,chi2_gradient,npar)
+        if fcn is None:
+            print("Can't pass the gradient to Minuit! Fitting without it.", file=sys.stderr)
+    if fcn is None:
+        fcn = ROOT.Math.Functor(chi2,npar)
+
+    fitter = ROOT.Fit.Fitter()
+    config = fitter.Config()
+    config.SetParamsSettings(npar,np.array([f.GetParameter(i) for i in range(npar)]))
+    # Same parameter settings as h.Fit() makes from the TF1.
+    for i in range(npar):
+        settings = config.ParSettings(i)
+        settings.SetName(f.GetParName(i))
+        plow, pup = ctypes.c_double(), ctypes.c_double()
+        f.GetParLimits(i,plow,pup)
+        plow, pup = plow.value, pup.value
+        if plow*pup != 0 and plow >= pup:
+            settings.Fix()
+        elif plow < pup:
+            settings.SetLimits(plow,pup)
+            step = 0.1*(pup - plow)
+            if settings.Value() < pup and pup - settings.Value() < 2*step:
+                step = (pup - settings.Value())/2
+            elif settings.Value() > plow and settings.Value() - plow < 2*step:
+                step = (settings.Value() - plow)/2
+            settings.SetStepSize(step)
+        if f.GetParError(i) > 0:
+            settings.SetStepSize(f.GetParError(i))
+
+    if isinstance(fcn,ROOT.Math.Functor):
+        fitter.FitFCN(fcn,ROOT.nullptr,len(bins),True)
+    else:
+        ROOT.btl.fit_grad_fcn(fitter,fcn,len(bins))
+    # Copy the result since the fitter owns it.
+    result = ROOT.Fit.FitResult(fitter.Result())
+    if not quiet:
+        result.Print(ROOT.std.cout)
+
+    for i in range(npar):
+        f.SetParameter(i,result.Parameter(i))
+        f.SetParError(i,result.ParError(i))
+    f.SetChisquare(result.MinFcnValue())
+    f.SetNDF(result.Ndf())
+    f.SetNumberFitPoints(len(bins))
+
+    functions = h.GetListOfFunctions()
+    old = functions.FindObject(f.GetName())
+    if old:
+        functions.Remove(old)
+    copy = f.Clone()
+    ROOT.SetOwnership(copy,False)
+    functions.Add(copy)
+    return result
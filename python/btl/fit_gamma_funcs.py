@@ -2,9 +2,14 @@ from __future__ import print_function, division
 import numpy as np
 import sys
 import ROOT
+from .fit_results import write_fit_result
 
 FIT_OPTIONS = 'LSB' 
 
+# Version of the gamma and pedestal fits for the fit cache. Bump this whenever
+# a change to the fits changes their results.
+FIT_VERSION = 1
+
 def ROOT_peaks(h, width=10, height=0.05, npeaks=4, options="", sort=True):
     """
     Finds peaks in hisogram `h`. `height` is measured as a fraction of the
@@ -41,11 +46,17 @@ def ROOT_peaks(h, width=10, height=0.05, npeaks=4, options="", sort=True):
     x_pos = x_pos[ind]
     return (x_pos, highest_peak)
 
-def fit_gamma(h, eng, offset=0, offset_sigma=10):
+def fit_gamma(h, eng, offset=0, offset_sigma=10, prior=None):
     """
     Finds the full energy gamma peak (with energy `eng`) in the ROOT histogram
     `h`, and fits it with a Gausssian. Returns the fit parameters, with the
     first parameter being pC per keV.
+
+    If `prior` is the list of parameters of an earlier fit of the same
+    channel (see `fit_priors`), the pC per keV and width start from its
+    values if it puts the peak within the range of the first fit, and if
+    TSpectrum doesn't find a peak, the peak is assumed to be where the prior
+    puts it.
     """
     
     ## Use TSpectrum
@@ -53,7 +64,8 @@ def fit_gamma(h, eng, offset=0, offset_sigma=10):
 
     h.GetXaxis().SetRangeUser(offset+3*offset_sigma,h.GetBinCenter(h.GetNbinsX()-1))
     _ ,peak = ROOT_peaks(h,width=15,height=0.3,npeaks=nPeaks,options='nobackground')
-    if (peak == None): peak = 100
+    if (peak == None):
+        peak = offset+prior[0]*eng if prior is not None else 100
     
     # Now we find the full energy peak. We don't use `GetMaximumBin` because we
     # want our estimate of the full energy peak to be sufficiently far away
@@ -88,8 +100,12 @@ def fit_gamma(h, eng, offset=0, offset_sigma=10):
     sigma = h.GetRMS()
     f.SetNpx(10000)
     f.SetLineColor(ROOT.kRed)
-    f.SetParameter(0, (peak-offset)/eng)
-    f.SetParameter(1, 0.08*peak/eng)
+    if prior is not None and abs(offset+prior[0]*eng - peak) < 0.15*peak:
+        f.SetParameter(0, prior[0])
+        f.SetParameter(1, abs(prior[1]))
+    else:
+        f.SetParameter(0, (peak-offset)/eng)
+        f.SetParameter(1, 0.08*peak/eng)
     f.SetParameter(2, h.GetBinContent(h.FindBin(peak)))
     #f.SetParRange(1,0.,100.)
     r = h.Fit(f, 'QLSB+',  '', 0.85*peak, 1.15*peak)
@@ -106,7 +122,7 @@ def fit_gamma(h, eng, offset=0, offset_sigma=10):
     #f.SetParLimits(1, 0, 500/eng)
     #f.SetParLimits(2, 0, 2000000)
     r = h.Fit(f, 'QLSB+', '', offset+eng*f.GetParameter(0) - 0.75*eng*abs(f.GetParameter(1)), offset+eng*f.GetParameter(0) + 1.*eng*abs(f.GetParameter(1)))
-    f.Write()
+    write_fit_result(f, r)
 
     if int(r) == -1:
         return None
@@ -141,7 +157,7 @@ def fit_offset(h):
     
     # Secondary fit that we limit to +/-1 sigma. 
     r = h.Fit(f, 'QRLSB+', '', f.GetParameter(1) - abs(f.GetParameter(2)), f.GetParameter(1) + abs(f.GetParameter(2)))
-    f.Write()
+    write_fit_result(f, r)
     #h.Write()
     
     try:
@@ -5,6 +5,10 @@ import ROOT
 
 FIT_OPTIONS = 'LSB' 
 
+# Version of the gamma and pedestal fits for the fit cache. Bump this whenever
+# a change to the fits changes their results.
+FIT_VERSION = 1
+
 def ROOT_peaks(h, width=10, height=0.05, npeaks=4, options="", sort=True):
     """
     Finds peaks in hisogram `h`. `height` is measured as a fraction of the
@@ -14,8 +14,13 @@ from scipy.stats import norm
 from scipy import constants
 import ROOT
 from functools import lru_cache, wraps
+from collections import OrderedDict
 from scipy.special import erf
 import hashlib
+import os
+from btl.histograms import bin_centers, bin_contents
+from btl.fit_chi2 import fit_chi2
+from btl.fit_results import write_fit_result
 
 # Single photoelectron charge in attenuated mode (nominal SPE charge/4)
 # Here we just use an approximate value instead of trying to get the actual
@@ -28,10 +33,35 @@ SPE_CHARGE = 1.0 # pC
 SPE_ERROR = 0.01 # pC
 
 ES = np.linspace(1,1000,1000)
+# Weights for the trapezoid integral over ES, i.e. np.trapz(y,x=ES) is
+# np.dot(y,ES_WEIGHTS).
+ES_WEIGHTS = np.full(len(ES),ES[1]-ES[0])
+ES_WEIGHTS[[0,-1]] /= 2
+
+# Version of the LYSO fit for the fit cache. Bump this whenever a change to
+# the fit or the spectra changes its results.
+FIT_VERSION = 1
 
 # Small number to avoid divide by zeros
 EPSILON = 1e-10
 
+# Directory to cache the LYSO energy spectra in (see lyso_spectra()). If it
+# isn't set, the spectra are computed the first time they're needed.
+SPECTRUM_CACHE = os.environ.get('BTL_SPECTRUM_CACHE')
+
+# Energy (keV) and kind of each component of the LYSO energy spectrum, i.e.
+# the beta decay spectrum offset by the energy of the gammas absorbed with it
+# or a single gamma.
+COMPONENTS = (
+    (88, 'beta'),
+    (202, 'gamma'),
+    (290, 'beta'),
+    (307, 'gamma'),
+    (395, 'beta'),
+    (509, 'gamma'),
+    (597, 'beta'),
+)
+
 def memoize(fun):
     _cache = {}
 
@@ -55,13 +85,12 @@ def memoize(fun):
 
     return cached_fun
 
-@lru_cache(maxsize=None)
 def dn(E,Q,Z,A,forb=None):
     """
     This function, dn(E,Q,Z,forb) Calculates the branch antineutrino kinetic
     energy spectrum. It takes the following variables: Q, the branch endpoint;
     Z, the number of protons in the daughter nucleus; forb, the forbiddenness.
-    E the energy of the neutrino.
+    E the energy of the neutrino, which can be an array.
 
     From https://github.com/gzangakis/beta-spectrum/blob/master/BetaDecay.py
     """
@@ -72,34 +101,34 @@ def dn(E,Q,Z,A,forb=None):
     # https://www.nature.com/articles/s41598-018-35684-x. I don't *think* this
     # should be a big deal since our primary handle for the light yield comes
     # from the bump at around 300 keV, but should double check this.
-    e = E
-
-    if not 0 < E <= Q:
-        return 0
+    e = np.asarray(E,dtype=float)
 
     # Fermi Function approximation
-    if e < 613.2:
-        a = - 0.811 + (4.46e-2 * Z) + (1.08e-4 * (Z**2))
-        b = 0.673 - (1.82e-2 * Z) + (6.38e-5 * (Z**2))
-
-    if e >= 613.2:
-        a = - 8.46e-2 + (2.48e-2 * Z) + (2.37e-4*(Z**2))
-        b = 1.15e-2 + (3.58e-4 * Z) - (6.17e-5*(Z**2))
-
-    P = np.sqrt(np.power(e+511,2)-np.power(511,2))
-    F = ((e+511)/P) * np.exp( a + (b * np.sqrt(((e+511)/511)-1)))
-    # Define Forbiddenness correction
-    if forb=='1U':
-        forbiddenness = P**2+(Q-e)**2
-    elif forb=='2U':
-        forbiddenness=(Q-e)**4+(10/3)*P**2*(Q-e)**2+P**2
-    elif forb=='3U':
-        forbiddenness=(Q-e)**6+7*P**2*(Q-e)**4+7*P**4*(Q-e)**2+P**6
-    else: 
-        forbiddenness=1
-
-    # Branch Spectrum
-    return forbiddenness*F*(np.sqrt(np.power(e,2)+2*e*511)*np.power(Q-e,2)*(e+511))
+    a = np.where(e < 613.2,
+                 - 0.811 + (4.46e-2 * Z) + (1.08e-4 * (Z**2)),
+                 - 8.46e-2 + (2.48e-2 * Z) + (2.37e-4*(Z**2)))
+    b = np.where(e < 613.2,
+                 0.673 - (1.82e-2 * Z) + (6.38e-5 * (Z**2)),
+                 1.15e-2 + (3.58e-4 * Z) - (6.17e-5*(Z**2)))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        P = np.sqrt(np.power(e+511,2)-np.power(511,2))
+        F = ((e+511)/P) * np.exp( a + (b * np.sqrt(((e+511)/511)-1)))
+        # Define Forbiddenness correction
+        if forb=='1U':
+            forbiddenness = P**2+(Q-e)**2
+        elif forb=='2U':
+            forbiddenness=(Q-e)**4+(10/3)*P**2*(Q-e)**2+P**2
+        elif forb=='3U':
+            forbiddenness=(Q-e)**6+7*P**2*(Q-e)**4+7*P**4*(Q-e)**2+P**6
+        else:
+            forbiddenness=1
+
+        # Branch Spectrum
+        rv = forbiddenness*F*(np.sqrt(np.power(e,2)+2*e*511)*np.power(Q-e,2)*(e+511))
+
+    rv = np.where((0 < e) & (e <= Q), rv, 0)
+    return rv if rv.ndim else float(rv)
 
 def analytic_spectrum(T, offset):
     """
@@ -127,7 +156,7 @@ def spectrum(es, offset):
     Z = 72
     Q = 593
     A = 176 #Not sure if this is right?
-    rv = np.array([dn(e-offset, Q, Z, A) for e in es],dtype=float)
+    rv = dn(np.asarray(es,dtype=float)-offset, Q, Z, A)
     # Add small number here in case someone is evaluating things at low
     # energies where the higher energy distributions don't have any non-zero
     # values.
@@ -135,17 +164,49 @@ def spectrum(es, offset):
     rv /= np.trapz(rv,x=es)
     return rv
 
-SPECTRUM_88 = spectrum(ES,88)
-SPECTRUM_202 = norm.pdf(ES,202,1)
-SPECTRUM_290 = spectrum(ES,290)
-SPECTRUM_307 = norm.pdf(ES,307,1)
-SPECTRUM_395 = spectrum(ES,395)
-SPECTRUM_509 = norm.pdf(ES,509,1)
-SPECTRUM_597 = spectrum(ES,597)
+def build_lyso_spectra():
+    """
+    Returns the (len(COMPONENTS) x len(ES)) matrix with the energy spectrum
+    of each component evaluated at ES.
+    """
+    return np.array([spectrum(ES,energy) if kind == 'beta' else norm.pdf(ES,energy,1) for energy, kind in COMPONENTS])
 
 @lru_cache(maxsize=None)
+def lyso_spectra():
+    """
+    Returns the LYSO energy spectra from build_lyso_spectra(). They're only
+    computed the first time this is called so that importing this module is
+    fast. If SPECTRUM_CACHE is set, they're saved there and loaded from there
+    the next time, in a file named by a hash of everything they depend on.
+    """
+    if SPECTRUM_CACHE is None:
+        return build_lyso_spectra()
+
+    key = hashlib.sha1(repr((ES.tolist(), COMPONENTS, EPSILON)).encode())
+    with open(__file__,'rb') as f:
+        # The spectra also depend on the code.
+        key.update(f.read())
+    filename = os.path.join(SPECTRUM_CACHE, 'lyso_spectra_%s.npy' % key.hexdigest())
+    try:
+        return np.load(filename)
+    except (IOError, ValueError):
+        pass
+    spectra = build_lyso_spectra()
+    try:
+        os.makedirs(SPECTRUM_CACHE, exist_ok=True)
+        # Write to a temporary file first so other processes never see a
+        # partial file.
+        tmp = '%s.%i.tmp' % (filename, os.getpid())
+        with open(tmp,'wb') as f:
+            np.save(f, spectra)
+        os.replace(tmp, filename)
+    except OSError as e:
+        print("Unable to cache the LYSO spectra in %s: %s" % (SPECTRUM_CACHE, e))
+    return spectra
+
+@lru_cache(maxsize=128)
 def p_e_fast(p):
-    return p[0]*SPECTRUM_88 + p[1]*SPECTRUM_202 + p[2]*SPECTRUM_290 + p[3]*SPECTRUM_307 + p[4]*SPECTRUM_395 + p[5]*SPECTRUM_509 + p[6]*SPECTRUM_597
+    return np.dot(p,lyso_spectra())
 
 @memoize
 def p_e(es, p):
@@ -204,8 +265,12 @@ def likelihood(q,avg_y,dy,p):
     # Here, we assume p(y) = constant
     return np.trapz(p_e(es,p)*np.trapz(p_q(q,ys,es)/(2*dy),x=ys,axis=0),x=es,axis=0)
 
-@memoize
 def integral_fast(q,avg_y,dy,spe_charge):
+    """
+    Returns the integral over the light yield in likelihood() for each energy
+    in ES. If `q` is an array of charges, returns a (len(q) x len(ES)) matrix.
+    """
+    q = np.asarray(q,dtype=float)[...,np.newaxis]
     integral = -erf((q+avg_y*(1-dy)*ES)/np.sqrt(2*avg_y*(1-dy)*ES*spe_charge)) \
                +erf((q+avg_y*(1+dy)*ES)/np.sqrt(2*avg_y*(1+dy)*ES*spe_charge))
     # Take the log, add 2*q/spe_charge and then exponentiate to avoid overflows
@@ -218,6 +283,36 @@ def integral_fast(q,avg_y,dy,spe_charge):
     integral *= 1/(2*ES)
     return integral
 
+def integral_fast_gradient(q,avg_y,dy,spe_charge):
+    """
+    Returns the derivatives of integral_fast() with respect to `avg_y` and
+    `dy`, each a (len(q) x len(ES)) matrix like integral_fast().
+
+    These are the derivatives of integral_fast() as it's computed rather than
+    of the exact integral: the erf() difference multiplying
+    np.exp(2*q/spe_charge) is usually rounded to zero, and then so is its
+    derivative.
+    """
+    q = np.asarray(q,dtype=float)[...,np.newaxis]
+    y1 = avg_y*(1-dy)*ES
+    y2 = avg_y*(1+dy)*ES
+    width1 = np.sqrt(2*y1*spe_charge)
+    width2 = np.sqrt(2*y2*spe_charge)
+    a1 = (q+y1)/width1
+    a2 = (q+y2)/width2
+    b1 = (-q+y1)/width1
+    b2 = (-q+y2)/width2
+    # Derivatives of the erf() terms with respect to y1 and y2.
+    with np.errstate(divide='ignore',invalid='ignore'):
+        diff = erf(a2) - erf(a1)
+        term = np.exp(np.log(diff) + 2*q/spe_charge)
+        scale = np.where(term > 0,term/diff,0)
+    d1 = -(scale*np.exp(-a1**2)*(y1-q) + np.exp(-b1**2)*(y1+q))/(y1*width1)
+    d2 = (scale*np.exp(-a2**2)*(y2-q) + np.exp(-b2**2)*(y2+q))/(y2*width2)
+    d1 *= 1/(2*np.sqrt(np.pi)*ES)
+    d2 *= 1/(2*np.sqrt(np.pi)*ES)
+    return (d1*(1-dy) + d2*(1+dy))*ES, (d2 - d1)*avg_y*ES
+
 def likelihood_fast(q,avg_y,dy,p,spe_charge=SPE_CHARGE):
     """
     Returns P(q|avg_y,dy,p) just like the function above, but is much faster
@@ -227,9 +322,66 @@ def likelihood_fast(q,avg_y,dy,p,spe_charge=SPE_CHARGE):
     return np.trapz(p_e_fast(p)*integral,dx=ES[1]-ES[0],axis=-1)/(2*dy*avg_y)
 
 class lyso_spectrum(object):
-    def __init__(self, spe_charge=SPE_CHARGE, offset=0):
+    """
+    The LYSO spectrum as a function of the charge with the parameters
+    described in __call__().
+
+    Calling the model from a TF1 evaluates it one bin at a time. When fitting
+    with fit_chi2(), evaluate() is called instead with all the bins at once.
+    The integrals over the light yield only depend on the charges, p[0] and
+    p[1], so the last `cache_size` of them are kept and fits which only
+    change the normalizations only do a single matrix vector product per
+    evaluation.
+    """
+    def __init__(self, spe_charge=SPE_CHARGE, offset=0, cache_size=8):
         self.spe_charge = spe_charge
         self.offset = offset
+        self.cache_size = cache_size
+        self._integrals = OrderedDict()
+
+    def integrals(self, q, avg_y, dy):
+        """
+        Returns integral_fast() for the charges `q`, from the cache if
+        possible.
+        """
+        key = (q.tobytes(), avg_y, dy)
+        if key in self._integrals:
+            self._integrals.move_to_end(key)
+        else:
+            self._integrals[key] = integral_fast(q,avg_y,dy,self.spe_charge)
+            if len(self._integrals) > self.cache_size:
+                self._integrals.popitem(last=False)
+        return self._integrals[key]
+
+    def evaluate(self, x, p):
+        """
+        Returns the LYSO spectrum at each of the charges `x` with the
+        parameters `p`.
+        """
+        q = np.asarray(x,dtype=float) - self.offset
+        integral = self.integrals(q,p[0],p[1])
+        ps = tuple([float(p[i]) for i in range(2,9)])
+        return np.dot(integral,p_e_fast(ps)*ES_WEIGHTS)/(2*p[1]*p[0])
+
+    def gradient(self, x, p):
+        """
+        Returns the LYSO spectrum at each of the charges `x` with the
+        parameters `p` and the (len(x) x 9) matrix of its derivatives with
+        respect to the parameters.
+        """
+        q = np.asarray(x,dtype=float) - self.offset
+        integral = self.integrals(q,p[0],p[1])
+        ps = tuple([float(p[i]) for i in range(2,9)])
+        weights = p_e_fast(ps)*ES_WEIGHTS
+        norm = 2*p[1]*p[0]
+        value = np.dot(integral,weights)/norm
+        d_avg_y, d_dy = integral_fast_gradient(q,p[0],p[1],self.spe_charge)
+        jacobian = np.empty((len(q),9))
+        jacobian[:,0] = np.dot(d_avg_y,weights)/norm - value/p[0]
+        jacobian[:,1] = np.dot(d_dy,weights)/norm - value/p[1]
+        # The spectrum is linear in the constants.
+        jacobian[:,2:] = np.dot(integral,(lyso_spectra()*ES_WEIGHTS).T)/norm
+        return value, jacobian
 
     def __call__(self, x, p):
         """
@@ -250,12 +402,9 @@ class lyso_spectrum(object):
 
 def get_lyso(x, p, spe_charge=SPE_CHARGE):
     model = lyso_spectrum(spe_charge)
-    f = ROOT.TF1("flyso",model,0,1000,9)
-    for i in range(9):
-        f.SetParameter(i,p[i])
-    return np.array([f.Eval(e) for e in x])
+    return model.evaluate(x,p)
 
-def fit_lyso(h, model, fix_pars=True):
+def fit_lyso(h, model, fix_pars=True, gradient=False, prior=None):
     """
     Fit the internal LYSO radiation spectrum to the histogram `h`. LYSO has
     intrinsic radiation from the beta decay of 176Lu (see
@@ -276,65 +425,35 @@ def fit_lyso(h, model, fix_pars=True):
         p[8] - Constant for 597 keV spectrum
 
     Otherwise, returns None.
+
+    If `gradient` is True, Minuit uses the analytic derivatives of the model
+    instead of finite differences (see `fit_chi2()`).
+
+    If `prior` is the list of parameters of an earlier fit of the same
+    channel (see `fit_priors`), the light yield and its spread start from
+    its values instead of being guessed from the highest bin. The fit range
+    is still found from `h`.
     """
     f = ROOT.TF1("%s_fit" % h.GetName(),model,0,1000,9)
-    xmax = None
-    ymax = 0
-    xmin = None
-    ymin = 0
-    for i in range(1,h.GetNbinsX()-1):
-        x = h.GetBinCenter(i)
-
-        if x > h.GetStdDev()*2:
-            break
-
-        value = h.GetBinContent(i)
-
-        if xmin is None or value < ymin:
-            xmin = x
-            ymin = value
-    if xmin is None:
+    centers = bin_centers(h)
+    contents = bin_contents(h)
+
+    # Look for the minimum between the pedestal and the spectrum, i.e. the
+    # lowest bin below twice the standard deviation.
+    below = centers[1:h.GetNbinsX()-1] <= h.GetStdDev()*2
+    # Only the bins before the first one above.
+    n = len(below) if below.all() else np.argmin(below)
+    if n == 0:
         return None
+    xmin = centers[1+np.argmin(contents[1:1+n])]
 
-    n = 0
-    for i in range(1,h.GetNbinsX()-1)[::-1]:
-        # We look for the peak by looping over the bins from the *right* to the
-        # *left* and then looking for a peak and then for the distribution to
-        # go below 80% of this peak (I just picked the 80% number as a guess
-        # and it seems to work well, but this could be tweaked). The reason for
-        # this is that channels 7, 8, 23, and 24 are in the middle of the
-        # module and next to a bar which is not powered, so we can't properly
-        # cut coincidences. This means that a beta decay event may happen in a
-        # neighboring unpowered bar and we trigger on crosstalk. These charge
-        # distributions often have a huge peak at the low end which is only
-        # from crosstalk, so by going from the right to the left and looking
-        # for a peak we avoid setting the 300 keV peak at this crosstalk which
-        # screws up the fit.
-        x = h.GetBinCenter(i)
-
-        if x > 800:
-            # Around 900 is where we saturate the CAEN digitizer, so we only
-            # ever fit up to 800 pC to be safe.
-            continue
-
-        value = h.GetBinContent(i)
-
-        if x > xmin and (xmax is None or value > ymax):
-            xmax = x
-            ymax = value
-
-        if value < ymax*0.8:
-            n += 1
-
-            if n >= 5:
-                break
-        else:
-            n = 0
-    xmax = h.GetBinCenter(h.GetMaximumBin())
-    if xmax is None:
-        return None
+    # There used to be a search for the peak going from the *right* to the
+    # *left* so as not to pick the crosstalk peak at the low end of the
+    # distributions of channels 7, 8, 23, and 24, which are next to an
+    # unpowered bar, but its result was always replaced by the highest bin.
+    xmax = centers[h.GetMaximumBin()]
 
-    dx = h.GetBinCenter(2) - h.GetBinCenter(1)
+    dx = centers[2] - centers[1]
 
     # Assume peak is somewhere around 300 keV
     # For most of the channels where we cut coincidences this peak occurs for
@@ -345,9 +464,14 @@ def fit_lyso(h, model, fix_pars=True):
     # good starting parameter for p[0]
     pc_per_kev = xmax/300
 
-    f.SetParameter(0,pc_per_kev)
+    avg_y, dy = pc_per_kev, 0.1
+    if prior is not None:
+        avg_y = min(max(prior[0],0.1),10)
+        dy = min(max(prior[1],0.01),0.2)
+
+    f.SetParameter(0,avg_y)
     f.SetParLimits(0,0.1,10)
-    f.SetParameter(1,0.1)
+    f.SetParameter(1,dy)
     f.SetParLimits(1,0.01,0.2)
     
     # Gamma + beta spectra
@@ -367,23 +491,20 @@ def fit_lyso(h, model, fix_pars=True):
         f.FixParameter(5,0)
 
     # Run the first fit only floating the normalization constants
-    f.FixParameter(0,xmax/300)
-    f.FixParameter(1,0.1)
-    fr = h.Fit(f,"S","",pc_per_kev*150,800)
+    f.FixParameter(0,avg_y)
+    f.FixParameter(1,dy)
+    fr = fit_chi2(h,f,model,pc_per_kev*150,800,gradient=gradient)
     h.GetXaxis().SetRangeUser(xmin,800)
     h.Write()
 
     # Now we float all the parameters
     f.ReleaseParameter(0)
     f.ReleaseParameter(1)
-    fr = h.Fit(f,"S","",pc_per_kev*150,800)
-    try:
-        if not fr.Get().IsValid():
-            return None
-    except Exception as e:
+    fr = fit_chi2(h,f,model,pc_per_kev*150,800,gradient=gradient)
+    if not fr.IsValid():
         return None
     h.GetXaxis().SetRangeUser(xmin,800)
-    f.Write()
+    write_fit_result(f,fr)
     h.Write()
     return [f.GetParameter(i) for i in range(9)], [f.GetParError(i) for i in range(9)]
 
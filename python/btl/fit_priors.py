@@ -0,0 +1,119 @@
+"""
+Starting values for the fits from earlier runs of the same module.
+
+The same module is tested at several overvoltages, and without priors every
+run starts its fits from crude guesses, e.g. an SPE charge of 4 pC or a light
+yield from the highest bin. A `FitPriors` store keeps the parameters of the
+converged fits keyed by the barcode of the module, the channel, the source
+('spe' for the SPE fits) and the voltage, so that a retest at the same
+voltage starts from the last fit. Fits at other voltages aren't used since
+the gain changes with the overvoltage. The fits only use the priors as
+starting values and to center the limits which were set around the guesses,
+but a fit which converged to the wrong minimum would lead the next one
+there too, so fits with a chi-square per degree of freedom above
+`max_chi2_ndf` aren't stored.
+
+The store is a directory with a JSON file for each barcode. Files are written
+to a temporary file and renamed so a reader never sees a partial file. Two
+runs of the same module at the same time can lose each other's updates,
+which only means a cold start next time.
+
+Example:
+
+    priors = FitPriors(expanduser('~/.cache/btl/priors'))
+    prior = priors.get(barcode, 'ch3', 'lyso', voltage)
+    result = fit_lyso(h, model, prior=prior)
+    if result is not None:
+        priors.put(barcode, 'ch3', 'lyso', voltage, result[0], fit_quality(h))
+"""
+from __future__ import print_function, division
+import json
+import os
+import tempfile
+
+def barcode_and_voltage(f):
+    """
+    Returns the barcode and voltage of the module from the attributes of the
+    hdf5 file `f`, or (None, None) if they aren't there.
+    """
+    # Data taken at Fermilab has them in the lyso group.
+    if 'lyso' in f and 'barcode' in f['lyso'].attrs:
+        attrs = f['lyso'].attrs
+    else:
+        attrs = f.attrs
+    if 'barcode' not in attrs or 'voltage' not in attrs:
+        return None, None
+    return int(attrs['barcode']), float(attrs['voltage'])
+
+def fit_quality(h):
+    """
+    Returns the chi-square per degree of freedom of the last fit
+    "<name>_fit" of the TH1 `h`, or None if it doesn't have one.
+    """
+    name = '%s_fit' % h.GetName()
+    fits = [f for f in h.GetListOfFunctions() if f.GetName() == name]
+    if len(fits) == 0 or fits[-1].GetNDF() <= 0:
+        return None
+    return fits[-1].GetChisquare()/fits[-1].GetNDF()
+
+class FitPriors(object):
+    """
+    Store of fit parameters in the directory `path`, which is created if it
+    doesn't exist. Fits with a chi-square per degree of freedom above
+    `max_chi2_ndf` aren't stored.
+    """
+    def __init__(self, path, max_chi2_ndf=10):
+        self.path = path
+        self.max_chi2_ndf = max_chi2_ndf
+        os.makedirs(path, exist_ok=True)
+
+    def filename(self, barcode):
+        return os.path.join(self.path, '%s.json' % barcode)
+
+    def load(self, barcode):
+        """
+        Returns the priors of the module `barcode` as a dictionary of
+        {channel: {source: [[voltage, pars], ...]}}.
+        """
+        try:
+            with open(self.filename(barcode)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def get(self, barcode, channel, source, voltage, tolerance=0.01):
+        """
+        Returns the parameters of the fit of `source` for `channel` of the
+        module `barcode` at the voltage closest to `voltage`, or None if
+        there isn't one within `tolerance`.
+        """
+        entries = self.load(barcode).get(channel, {}).get(source, [])
+        entries = [entry for entry in entries if abs(entry[0] - voltage) <= tolerance]
+        if len(entries) == 0:
+            return None
+        return min(entries, key=lambda entry: abs(entry[0] - voltage))[1]
+
+    def put(self, barcode, channel, source, voltage, pars, chi2_ndf=None):
+        """
+        Stores the parameters `pars` of the fit of `source` for `channel` of
+        the module `barcode` at `voltage`, replacing any from the same
+        voltage, unless its chi-square per degree of freedom `chi2_ndf` is
+        too large. Returns True if they were stored.
+        """
+        if chi2_ndf is not None and not chi2_ndf <= self.max_chi2_ndf:
+            return False
+        priors = self.load(barcode)
+        entries = priors.setdefault(channel, {}).setdefault(source, [])
+        entries[:] = [entry for entry in entries if entry[0] != voltage]
+        entries.append([voltage, [float(x) for x in pars]])
+        entries.sort()
+
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(priors, f)
+            os.replace(tmp, self.filename(barcode))
+        except Exception:
+            os.unlink(tmp)
+            raise
+        return True
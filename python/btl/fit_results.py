@@ -0,0 +1,52 @@
+"""
+Writing fit results to the output file.
+
+A TF1 which evaluates a Python model, like `vinogradov_model` or
+`lyso_spectrum`, can't be stored as a formula, so writing it (or a histogram
+it's attached to) evaluates the model at each of its `GetNpx()` points to
+store the curve, and so does drawing it. With 10000 points that's far more
+time than the fit itself.
+
+The fits therefore create these TF1s with `fit_npx()` points, which is a
+coarse `CURVE_NPX` unless `SAVE_FIT_FUNCTIONS` is set (by the
+BTL_SAVE_FIT_FUNCTIONS environment variable or the `--save-fit-functions`
+option of the analysis scripts), and write them with `write_fit_result()`.
+The TF1 in the output file still has the parameters, errors and chi-square,
+so readers don't change, and the covariance matrix is written next to it.
+
+Example:
+
+    f = ROOT.TF1("%s_fit" % h.GetName(), model, xmin, xmax, 7)
+    f.SetNpx(fit_npx())
+    r = h.Fit(f, 'QSR+')
+    write_fit_result(f, r)
+"""
+from __future__ import print_function, division
+import os
+
+# Number of points of the curves of Python models stored in the output file.
+CURVE_NPX = 500
+# Number of points with SAVE_FIT_FUNCTIONS.
+FULL_NPX = 10000
+
+SAVE_FIT_FUNCTIONS = bool(os.environ.get('BTL_SAVE_FIT_FUNCTIONS'))
+
+def fit_npx():
+    """
+    Returns the number of points to use for a TF1 evaluating a Python model.
+    """
+    return FULL_NPX if SAVE_FIT_FUNCTIONS else CURVE_NPX
+
+def write_fit_result(f, result=None):
+    """
+    Writes the fitted TF1 `f` to the current directory and, if the fit
+    result `result` (a FitResult or the TFitResultPtr returned by `Fit()`)
+    is given, its covariance matrix as the TMatrixDSym "<name>_cov".
+    """
+    f.Write()
+    if result is None:
+        return
+    if hasattr(result, 'Get'):
+        result = result.Get()
+    if result:
+        result.GetCovarianceMatrix().Write("%s_cov" % f.GetName())
@@ -0,0 +1,89 @@
+"""
+Runs independent ROOT fits, e.g. the fits of each channel, in a pool of
+worker processes.
+
+The fit functions in btl write the fitted TF1s and histograms to the current
+ROOT directory, which in the analysis scripts is the output file. A forked
+worker can't write to the parent's TFile, so `map_fits()` runs each task in a
+worker with a TMemFile as the current directory and sends everything written
+to it back to the parent, which writes it to its own current directory in
+the same order. The output file ends up with the same keys as when the fits
+are run one after another. `capture_writes()` does the capturing for a single
+call, e.g. for the fit cache.
+
+The pool from `fit_pool()` has to be created before the output file is
+opened, see `btl.workers`.
+
+Example:
+
+    pool = fit_pool(8)
+    root_f = ROOT.TFile(filename, "recreate")
+    for channel, result in zip(channels, map_fits(fit_channel, tasks, pool)):
+        print(channel, result)
+"""
+from __future__ import print_function, division
+import ROOT
+from .workers import WorkerPool
+
+def _init_worker():
+    # Histograms unpickled in the worker or read back from the TMemFile
+    # shouldn't belong to it, otherwise closing it would delete them.
+    ROOT.TH1.AddDirectory(False)
+    ROOT.gROOT.SetBatch(True)
+
+def capture_writes(func, *args, **kwargs):
+    """
+    Calls `func(*args, **kwargs)` with a TMemFile as the current directory.
+    Returns the result and the list of (name, object) written to the
+    TMemFile in the order they were written. The current directory is
+    restored afterwards.
+    """
+    directory = ROOT.gDirectory.GetDirectory('')
+    f = ROOT.TMemFile('capture_writes.root', 'RECREATE')
+    try:
+        result = func(*args, **kwargs)
+        objects = []
+        # Every Write() adds a new key (or cycle), and the keys are written
+        # one after another in the file.
+        for key in sorted(f.GetListOfKeys(), key=lambda key: key.GetSeekKey()):
+            obj = key.ReadObj()
+            if isinstance(obj, ROOT.TH1):
+                # Otherwise closing the TMemFile would delete it.
+                obj.SetDirectory(ROOT.nullptr)
+            objects.append((key.GetName(), obj))
+    finally:
+        f.Close()
+        directory.cd()
+    return result, objects
+
+def _fit_worker(task):
+    func, args = task
+    return capture_writes(func, *args)
+
+def fit_pool(jobs):
+    """
+    Returns a `btl.workers.WorkerPool` of `jobs` processes for `map_fits()`.
+    """
+    return WorkerPool(jobs, _init_worker)
+
+def map_fits(func, tasks, pool=None):
+    """
+    Calls `func(*args)` for each tuple `args` in `tasks` and yields the
+    results in the same order.
+
+    If `pool` is a pool from `fit_pool()` with more than one job, the calls
+    are done by its forked processes with at most two tasks per worker in
+    flight, so `func` must be a top level function and the arguments and
+    results must be picklable (ROOT objects are). Everything `func` writes to
+    the current ROOT directory is written to the current directory of the
+    parent just before its result is yielded.
+    """
+    if pool is None or pool.pool is None:
+        for args in tasks:
+            yield func(*args)
+        return
+
+    for result, objects in pool.imap(_fit_worker, ((func, args) for args in tasks)):
+        for name, obj in objects:
+            obj.Write(name)
+        yield result
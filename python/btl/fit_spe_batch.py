@@ -0,0 +1,357 @@
+"""
+Fits the SPE charge histograms of many channels at once without ROOT.
+
+`fit_spe_batch()` follows the same strategy as `fit_spe_funcs.fit_spe()`:
+
+    1. The offset is seeded from the highest bin below 1 pC and refined by
+       fitting a gaussian to the zero peak, first with the mean fixed and
+       then with it free. This also gives the noise spread.
+    2. The mean number of PEs `l` is estimated from the fraction of events
+       in the zero peak.
+    3. The vinogradov model (see `fit_spe_funcs.vinogradov_model`) is fit
+       with the offset, noise spread, SPE charge spread and crosstalk
+       probability fixed.
+    4. All the parameters are released within limits around the first fit
+       and the model is fit again.
+
+The fits are chi-square fits to the bin contents like ROOT's default fit,
+done with `scipy.optimize.least_squares()` for each channel. The model
+is evaluated for all the bins in the fit range at once as a (bins x peaks)
+array, and the vinogradov fits use its analytic derivatives.
+
+Example:
+
+    results = fit_spe_batch([charges[channel] for channel in channels], [get_bins(charges[channel]) for channel in channels])
+    for channel, result in zip(channels, results):
+        if result is not None:
+            pars, errors = result
+"""
+from __future__ import print_function, division
+import numpy as np
+from scipy.special import gamma
+from scipy.stats import poisson
+from scipy.optimize import least_squares
+from .histograms import histogram_counts, bin_numbers
+
+# Same defaults as fit_spe_funcs.
+D_LAMBDA = 0.5
+D_SPE_CHARGE_SPREAD = 0.05
+# Probability that a primary PE triggers a secondary PE used for the first
+# fit.
+PS = 0.05
+# Number of peaks in the vinogradov model.
+NUM_PEAKS = 20
+
+def fac(x):
+    return gamma(x+1)
+
+def _b_coefficients(n):
+    """
+    Returns the (n x n) matrix B[N,i] of the coefficients in the vinogradov
+    distribution. See `fit_spe_funcs.B_coeff_fast()`.
+    """
+    B = np.zeros((n, n))
+    B[0,0] = 1
+    for N in range(1, n):
+        i = np.arange(1, N+1)
+        B[N,1:N+1] = np.rint((fac(N)*fac(N-1))/(fac(i)*fac(i-1)*fac(N-i)))
+    return B
+
+B_COEFFICIENTS = _b_coefficients(NUM_PEAKS)
+
+def vinogradov_coefficients(l, ps):
+    """
+    Returns the (channels x NUM_PEAKS) probabilities of getting N PEs for
+    each channel with mean number of primary PEs `l` and crosstalk
+    probability `ps`. Peaks after the first one above N=1 with a probability
+    below 1e-3 are set to zero, like in `fit_spe_funcs.vinogradov_model`.
+    """
+    l = np.asarray(l, dtype=np.float64)
+    ps = np.asarray(ps, dtype=np.float64)
+    N = np.arange(NUM_PEAKS)
+    # Exponent of ps for each (N, i). Terms with i > N have a zero
+    # coefficient.
+    exponent = np.maximum(N[:,np.newaxis] - N, 0)
+    with np.errstate(invalid='ignore', over='ignore'):
+        primary = (l*(1 - ps))[:,np.newaxis]**N
+        secondary = ps[:,np.newaxis,np.newaxis]**exponent
+        coefficients = np.einsum('ni,cni,ci->cn', B_COEFFICIENTS, secondary, primary)
+        coefficients *= np.exp(-l)[:,np.newaxis]/fac(N)
+    keep = np.cumprod((N <= 1) | (coefficients >= 1e-3), axis=1)
+    return coefficients*keep
+
+def vinogradov_model(x, p):
+    """
+    Returns the vinogradov model with the (channels x 7) parameters `p`
+    evaluated at the (channels x bins) charges `x`. The parameters are the
+    same as for `fit_spe_funcs.vinogradov_model`.
+    """
+    i = np.arange(NUM_PEAKS)
+    coefficients = vinogradov_coefficients(p[:,2], p[:,6])
+    mean = p[:,1,np.newaxis] + i*p[:,3,np.newaxis]
+    sigma = np.sqrt(p[:,4,np.newaxis]**2 + i*p[:,5,np.newaxis]**2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        peaks = np.exp(-0.5*((x[:,:,np.newaxis] - mean[:,np.newaxis,:])/sigma[:,np.newaxis,:])**2)
+    # TMath::Gaus() returns 1e30 for a zero width.
+    peaks = np.where(sigma[:,np.newaxis,:] == 0, 1e30, peaks)
+    return p[:,0,np.newaxis]*np.einsum('cbn,cn->cb', peaks, coefficients)
+
+def vinogradov_coefficients_gradient(l, ps):
+    """
+    Returns the (channels x NUM_PEAKS) probabilities from
+    `vinogradov_coefficients()` and their derivatives with respect to `l` and
+    `ps`. The peaks which are set to zero have zero derivatives.
+    """
+    l = np.asarray(l, dtype=np.float64)
+    ps = np.asarray(ps, dtype=np.float64)
+    N = np.arange(NUM_PEAKS)
+    # Exponents of l*(1-ps) and ps for each (N, i) and the ones of their
+    # derivatives, whose coefficients are zero when the exponents are.
+    exponent = np.maximum(N[:,np.newaxis] - N, 0)
+    primary_exponent = np.maximum(N - 1, 0)
+    secondary_exponent = np.maximum(exponent - 1, 0)
+    u = l*(1 - ps)
+    with np.errstate(invalid='ignore', over='ignore', divide='ignore'):
+        primary = u[:,np.newaxis]**N
+        d_primary = N*u[:,np.newaxis]**primary_exponent
+        secondary = ps[:,np.newaxis,np.newaxis]**exponent
+        d_secondary = exponent*ps[:,np.newaxis,np.newaxis]**secondary_exponent
+        norm = np.exp(-l)[:,np.newaxis]/fac(N)
+        coefficients = norm*np.einsum('ni,cni,ci->cn', B_COEFFICIENTS, secondary, primary)
+        d_u = norm*np.einsum('ni,cni,ci->cn', B_COEFFICIENTS, secondary, d_primary)
+        d_ps = norm*np.einsum('ni,cni,ci->cn', B_COEFFICIENTS, d_secondary, primary)
+    d_l = d_u*(1 - ps)[:,np.newaxis] - coefficients
+    d_ps -= d_u*l[:,np.newaxis]
+    keep = np.cumprod((N <= 1) | (coefficients >= 1e-3), axis=1)
+    return coefficients*keep, d_l*keep, d_ps*keep
+
+def vinogradov_gradient(x, p):
+    """
+    Returns the vinogradov model with the (channels x 7) parameters `p`
+    evaluated at the (channels x bins) charges `x` like `vinogradov_model()`
+    and the (channels x bins x 7) derivatives with respect to the parameters.
+    """
+    i = np.arange(NUM_PEAKS)
+    coefficients, d_l, d_ps = vinogradov_coefficients_gradient(p[:,2], p[:,6])
+    mean = p[:,1,np.newaxis] + i*p[:,3,np.newaxis]
+    sigma2 = p[:,4,np.newaxis]**2 + i*p[:,5,np.newaxis]**2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        d = x[:,:,np.newaxis] - mean[:,np.newaxis,:]
+        peaks = np.exp(-0.5*d**2/sigma2[:,np.newaxis,:])
+        # Derivatives of the peaks with respect to the mean and the variance.
+        d_mean = peaks*d/sigma2[:,np.newaxis,:]
+        d_sigma2 = 0.5*d_mean*d/sigma2[:,np.newaxis,:]
+    # TMath::Gaus() returns 1e30 for a zero width.
+    zero = sigma2[:,np.newaxis,:] == 0
+    peaks = np.where(zero, 1e30, peaks)
+    d_mean = np.where(zero, 0, d_mean)
+    d_sigma2 = np.where(zero, 0, d_sigma2)
+
+    scale = p[:,0,np.newaxis]
+    weighted = coefficients*scale
+    model = np.einsum('cbn,cn->cb', peaks, coefficients)
+    J = np.empty(model.shape + (7,))
+    J[:,:,0] = model
+    J[:,:,1] = np.einsum('cbn,cn->cb', d_mean, weighted)
+    J[:,:,2] = scale*np.einsum('cbn,cn->cb', peaks, d_l)
+    J[:,:,3] = np.einsum('cbn,cn->cb', d_mean, weighted*i)
+    J[:,:,4] = np.einsum('cbn,cn->cb', d_sigma2, weighted)*2*p[:,4,np.newaxis]
+    J[:,:,5] = np.einsum('cbn,cn->cb', d_sigma2, weighted*i)*2*p[:,5,np.newaxis]
+    J[:,:,6] = scale*np.einsum('cbn,cn->cb', peaks, d_ps)
+    return scale*model, J
+
+def gaus_model(x, p):
+    """
+    Returns the (non normalized) gaussians p[0]*exp(-0.5*((x-p[1])/p[2])**2)
+    for each channel, like ROOT's "gaus".
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return p[:,0,np.newaxis]*np.exp(-0.5*((x - p[:,1,np.newaxis])/p[:,2,np.newaxis])**2)
+
+def fit_batch(model, x, y, w, p, lower=None, upper=None, fixed=None, jacobian=None):
+    """
+    Minimizes the chi-square sum(w*(y - model(x, p))**2) for every channel
+    (the first axis of all the arrays) with `scipy.optimize.least_squares()`.
+    `lower` and `upper` are the parameter limits (-inf and inf if not
+    given) and `fixed` is a boolean array of the parameters to keep fixed.
+    `jacobian` is a function which returns the model and its (channels x
+    bins x parameters) derivatives like `vinogradov_gradient()`. Without it
+    the derivatives are found by finite differences.
+
+    Each channel is fit on its own, only the bins with a nonzero weight are
+    evaluated. Stacking all the channels into one problem with a block
+    diagonal Jacobian doesn't work: the channels then share the trust region
+    and the stopping criteria, so steps which lower the total chi-square
+    are taken even if they make one channel worse, and channels stop before
+    they converge.
+
+    Returns the best fit parameters, their errors from the inverse of the
+    curvature matrix (zero for fixed parameters), the chi-square, and a
+    boolean array which is True for the channels where the fit converged.
+    """
+    p = np.array(p, dtype=np.float64)
+    n, m = p.shape
+    lower = np.full((n, m), -np.inf) if lower is None else np.broadcast_to(lower, (n, m)).astype(np.float64)
+    upper = np.full((n, m), np.inf) if upper is None else np.broadcast_to(upper, (n, m)).astype(np.float64)
+    fixed = np.zeros((n, m), dtype=bool) if fixed is None else np.broadcast_to(fixed, (n, m))
+    p = np.clip(p, lower, upper)
+
+    errors = np.zeros((n, m))
+    chi2 = np.full(n, np.nan)
+    converged = np.zeros(n, dtype=bool)
+    for c in range(n):
+        # A parameter whose limits leave it no room can't move either.
+        free = ~fixed[c] & (lower[c] < upper[c])
+        inside = w[c] > 0
+        xc = x[c,inside][np.newaxis]
+        sw = np.sqrt(w[c,inside])
+        yc = y[c,inside]
+        pc = p[c].copy()
+
+        def residuals(q):
+            pc[free] = q
+            return sw*(model(xc, pc[np.newaxis])[0] - yc)
+
+        def derivatives(q):
+            pc[free] = q
+            return sw[:,np.newaxis]*jacobian(xc, pc[np.newaxis])[1][0][:,free]
+
+        try:
+            result = least_squares(residuals, pc[free], jac='2-point' if jacobian is None else derivatives, bounds=(lower[c,free], upper[c,free]), method='dogbox', x_scale='jac')
+        except ValueError:
+            # The model isn't finite at the starting values.
+            continue
+        pc[free] = result.x
+        p[c] = pc
+        chi2[c] = 2*result.cost
+        # A parameter the chi-square doesn't depend on (e.g. a width stuck
+        # at zero) makes the curvature matrix singular, so use the pseudo
+        # inverse which gives it an error of zero.
+        covariance = np.linalg.pinv(np.dot(result.jac.T, result.jac))
+        errors[c,free] = np.sqrt(np.abs(np.diagonal(covariance)))
+        converged[c] = result.success and np.isfinite(chi2[c]) and np.all(np.isfinite(pc))
+    return p, errors, chi2, converged
+
+def _pad(arrays, fill=0):
+    """
+    Returns the list of 1D `arrays` as a single 2D array padded with `fill`.
+    """
+    out = np.full((len(arrays), max(len(a) for a in arrays)), fill, dtype=np.float64)
+    for i, a in enumerate(arrays):
+        out[i,:len(a)] = a
+    return out
+
+def fit_spe_batch(charges, bins, counts=None):
+    """
+    Fits the SPE charge histograms of several channels. `charges` is a list
+    with the charges of each channel and `bins` the list of bins for each
+    channel as returned by `get_bins()`, i.e. the histogram has `len(bins)`
+    equal bins from `bins[0]` to `bins[-1]` like the ROOT histograms in
+    `analyze_waveforms.py`. If `counts` is given, it is a list with the
+    number of times each charge of each channel was seen, e.g. the `values`
+    and `counts` of an `accumulators.ChargeHistogram`.
+
+    Returns a list with the result for each channel, which like
+    `fit_spe_funcs.fit_spe()` is None if the fit failed and otherwise the
+    list of the 7 fit parameters and the list of their errors.
+    """
+    n = len(charges)
+    results = [None]*n
+    if n == 0:
+        return results
+
+    if counts is None:
+        counts = [np.ones(len(x)) for x in charges]
+    charges = [np.asarray(x, dtype=np.float64) for x in charges]
+    counts = [np.asarray(w, dtype=np.float64) for w in counts]
+
+    centers, contents, entries, stddev = [], [], [], []
+    for x, w, b in zip(charges, counts, bins):
+        nbins, xmin, xmax = len(b), b[0], b[-1]
+        edges = np.linspace(xmin, xmax, nbins + 1)
+        centers.append((edges[1:] + edges[:-1])/2)
+        # Without the underflow and overflow bins from here on.
+        contents.append(histogram_counts(x, nbins, xmin, xmax, w)[1:-1])
+        entries.append(np.sum(w))
+        inside = (x >= xmin) & (x < xmax)
+        if np.sum(w[inside]) > 0:
+            mean = np.average(x[inside], weights=w[inside])
+            stddev.append(np.sqrt(np.average((x[inside] - mean)**2, weights=w[inside])))
+        else:
+            stddev.append(0)
+    entries = np.array(entries, dtype=np.float64)
+    stddev = np.array(stddev)
+    nbins = np.array([len(c) for c in contents])
+    # Padding bins are far away from everything with no entries, so they
+    # are never in a fit range.
+    x = _pad(centers, np.inf)
+    y = _pad(contents)
+
+    # Guess the offset from the highest bin below 1 pC, skipping the first
+    # and the last bin like `fit_spe()`.
+    index = np.arange(x.shape[1])
+    candidates = (x < 1) & (index < nbins[:,np.newaxis] - 2)
+    candidate_y = np.where(candidates, y, 0)
+    ok = candidate_y.max(axis=1) > 0
+    xmax = x[np.arange(n),np.argmax(candidate_y, axis=1)]
+    ok &= np.isfinite(xmax)
+    if not ok.any():
+        return results
+
+    c = np.flatnonzero(ok)
+    x, y, xmax, entries, stddev = x[c], y[c], xmax[c], entries[c], stddev[c]
+
+    def weights(xmin, xmax):
+        # ROOT skips empty bins and uses the bins with centers in the fit
+        # range.
+        inside = (x >= xmin[:,np.newaxis]) & (x <= xmax[:,np.newaxis]) & (y > 0)
+        with np.errstate(divide='ignore'):
+            return np.where(inside, 1/y, 0)
+
+    # Fit the zero peak with the mean fixed and then free.
+    w = weights(xmax - 0.5, xmax + 0.5)
+    height = np.max(np.where(w > 0, y, 0), axis=1)
+    p = np.stack([height, xmax, np.full(len(c), 0.1)], axis=1)
+    lower = np.array([-np.inf, -np.inf, 0.01])
+    upper = np.array([np.inf, np.inf, 10])
+    p = fit_batch(gaus_model, x, y, w, p, lower, upper, fixed=np.array([False, True, False]))[0]
+    p = fit_batch(gaus_model, x, y, w, p, lower, upper)[0]
+    offset = p[:,1]
+    raw_spread = p[:,2]
+
+    # Estimate `l` from the number of events in the zero peak, i.e. all the
+    # events up to and including the bin with `zero_peak_end`.
+    zero_peak_end = offset + 2*raw_spread
+    num_zero = np.empty(len(c))
+    for k, i in enumerate(c):
+        b = bins[i]
+        last = bin_numbers([zero_peak_end[k]], len(b), b[0], b[-1])[0]
+        num_zero[k] = np.sum(counts[i][bin_numbers(charges[i], len(b), b[0], b[-1]) <= last])
+    prob_zero = num_zero/entries
+    with np.errstate(divide='ignore', invalid='ignore'):
+        l = np.where((prob_zero <= 0) | (prob_zero >= 1), D_LAMBDA, -np.log(prob_zero))
+    num_peaks = np.minimum(20, np.maximum(4, poisson.ppf(0.95, l).astype(int)))
+
+    # First fit with most of the parameters fixed so that the peaks are
+    # distinguishable.
+    spe_charge = 4
+    xmin = offset - 1.5*raw_spread
+    w = weights(xmin, offset + 8*stddev)
+    p = np.stack([entries*0.075, offset, l, np.full(len(c), spe_charge), raw_spread, np.full(len(c), D_SPE_CHARGE_SPREAD), np.full(len(c), PS)], axis=1)
+    inf = np.full(len(c), np.inf)
+    lower = np.stack([np.zeros(len(c)), -inf, np.zeros(len(c)), zero_peak_end - offset, -inf, -inf, -inf], axis=1)
+    upper = np.stack([np.full(len(c), 1e9), inf, num_peaks + 5, np.full(len(c), spe_charge + 2), inf, inf, inf], axis=1)
+    fixed = np.array([False, True, False, False, True, True, True])
+    p = fit_batch(vinogradov_model, x, y, w, p, lower, upper, fixed, vinogradov_gradient)[0]
+
+    # Release all the parameters within limits around the first fit.
+    lower = np.stack([-inf, -inf, np.maximum(0, p[:,2] - 1), np.maximum(zero_peak_end - offset, p[:,3] - 1), np.zeros(len(c)), np.zeros(len(c)), np.full(len(c), 0.01)], axis=1)
+    upper = np.stack([inf, inf, p[:,2] + 1, p[:,3] + 1, np.full(len(c), 10), np.full(len(c), 0.5), np.full(len(c), 0.1)], axis=1)
+    p, errors, _, good = fit_batch(vinogradov_model, x, y, w, p, lower, upper, jacobian=vinogradov_gradient)
+
+    for k, i in enumerate(c):
+        if good[k]:
+            results[i] = list(map(float, p[k])), list(map(float, errors[k]))
+        else:
+            print("Fit error!")
+    return results
@@ -11,6 +11,18 @@ from ROOT import gROOT
 from ROOT import TMath
 from scipy.special import gamma
 from functools import lru_cache, wraps
+from .histograms import bin_centers, bin_contents
+from .fit_results import fit_npx, write_fit_result
+from .fit_chi2 import fit_chi2
+from . import fit_spe_batch
+
+# Compare the compiled models with the python ones before using them. See
+# `compiled_vinogradov_model()`.
+CHECK_COMPILED_MODELS = bool(os.environ.get('BTL_CHECK_COMPILED_MODELS'))
+
+# Version of the SPE fit for the fit cache. Bump this whenever a change to
+# the fit changes its results.
+FIT_VERSION = 1
 
 # DEFAULT VALUES FOR SPE FIT:
 D_OFFSET = 0
@@ -148,7 +160,9 @@ def fac(x):
     """
     return gamma(x+1)
 
-@lru_cache(maxsize=None)
+# The cache is keyed on the raw parameter values, which change on every
+# iteration of a fit, so it has to be bounded.
+@lru_cache(maxsize=4096)
 def vinogradov_fast(N, l, ps):
     """
     Returns probability of getting `N` PEs in the integration window.  `l` is
@@ -182,7 +196,9 @@ def B_coeff_fast(i, N):
     rv[(i == 0) & (N == 0)] = 1
     rv[(i == 0) & (N > 0)] = 0
     if (i > 0).any():
-        rv[i > 0] = (fac(N)*fac(N-1)) / (fac(i[i > 0])*fac(i[i > 0]-1)*fac(N-i[i > 0]))
+        # The coefficients are integers, so round instead of truncating when
+        # the ratio of gamma functions comes out just below one.
+        rv[i > 0] = np.rint((fac(N)*fac(N-1)) / (fac(i[i > 0])*fac(i[i > 0]-1)*fac(N-i[i > 0])))
     return rv
 
 def B_coeff(i, N):
@@ -210,17 +226,126 @@ class vinogradov_model:
     p[4]: std. of scope/digitizer noise
     p[5]: std. of SPE charge
     p[6]: probability that a primary PE triggers a secondary PE (https://arxiv.org/pdf/2106.13168.pdf)
+
+    This is called from python for every bin on every iteration of a fit, so
+    `fit_spe()` uses the compiled version from `compiled_vinogradov_model()`
+    instead when it can. With `gradient=True`, `fit_spe()` fits with
+    `fit_chi2()` instead, which calls `evaluate()` and `gradient()` with all
+    the bins at once.
     """
+    def __init__(self):
+        # The PE probabilities only depend on p[2] and p[6], which are the
+        # same for every bin, so keep the ones for the last parameters.
+        self.key = None
+        self.coefficients = None
+
     def __call__(self, x, p):
+        if self.key != (p[2], p[6]):
+            self.key = (p[2], p[6])
+            self.coefficients = [vinogradov_fast(i, p[2], p[6]) for i in range(num_peaks)]
         model = 0
-        for i in range(num_peaks):
-            coefficient = vinogradov_fast(i, p[2], p[6])
+        for i, coefficient in enumerate(self.coefficients):
             if i > 1 and coefficient < 1e-3:
                 break
             model += coefficient * TMath.Gaus(x[0]-p[1], i*p[3], TMath.Sqrt(p[4]**2 + i*(p[5]**2)), False)
         model *= p[0]
         return model
 
+    def evaluate(self, x, p):
+        """
+        Returns the model at each of the charges `x` with the parameters `p`.
+        """
+        x = np.asarray(x, dtype=float)
+        p = np.array([p[i] for i in range(7)], dtype=float)
+        return fit_spe_batch.vinogradov_model(x[np.newaxis], p[np.newaxis])[0]
+
+    def gradient(self, x, p):
+        """
+        Returns the model at each of the charges `x` with the parameters `p`
+        and the (len(x) x 7) matrix of its derivatives with respect to the
+        parameters.
+        """
+        x = np.asarray(x, dtype=float)
+        p = np.array([p[i] for i in range(7)], dtype=float)
+        model, jacobian = fit_spe_batch.vinogradov_gradient(x[np.newaxis], p[np.newaxis])
+        return model[0], jacobian[0]
+
+# C++ version of `vinogradov_model`, see `compiled_vinogradov_model()`.
+VINOGRADOV_CPP = """
+#include <cmath>
+#include "TMath.h"
+
+namespace btl {
+
+double vinogradov(int N, double l, double ps)
+{
+    // Same as vinogradov_fast() and B_coeff_fast().
+    double model = (N == 0) ? 1 : 0;
+    for (int i = 1; i <= N; i++) {
+        double B = std::round(std::tgamma(N+1)*std::tgamma(N)/(std::tgamma(i+1)*std::tgamma(i)*std::tgamma(N-i+1)));
+        model += B*TMath::Power(l*(1-ps), i)*TMath::Power(ps, N-i);
+    }
+    return TMath::Exp(-l)*model/std::tgamma(N+1);
+}
+
+double vinogradov_model(double *x, double *p)
+{
+    double model = 0;
+    for (int i = 0; i < %i; i++) {
+        double coefficient = vinogradov(i, p[2], p[6]);
+        if (i > 1 && coefficient < 1e-3)
+            break;
+        model += coefficient*TMath::Gaus(x[0]-p[1], i*p[3], TMath::Sqrt(p[4]*p[4] + i*(p[5]*p[5])), false);
+    }
+    return model*p[0];
+}
+
+}
+""" % num_peaks
+
+def compare_vinogradov_models(compiled, tolerance=1e-9):
+    """
+    Compares the C++ version `compiled` of `vinogradov_model` with the
+    python version on a grid of charges for a range of parameters. Returns a
+    description of the first value which differs by more than a relative
+    `tolerance`, or None if they all agree.
+    """
+    model = vinogradov_model()
+    for l in (0.05, 0.5, 2.0, 6.0):
+        for ps in (0, 0.05, 0.3):
+            p = np.array([1000, 0.1, l, 3.5, 0.4, 0.05, ps])
+            for x in np.linspace(-2, 40, 85):
+                x = np.array([x])
+                expected = model(x, p)
+                value = compiled(x, p)
+                if abs(value - expected) > tolerance*max(abs(expected), 1e-300):
+                    return "compiled vinogradov model gives %g instead of %g at x=%g, l=%g, ps=%g" % (value, expected, x[0], l, ps)
+    return None
+
+@lru_cache(maxsize=None)
+def compiled_vinogradov_model():
+    """
+    Returns the C++ version of `vinogradov_model` which can be passed to a
+    TF1 in the same way, or None if it couldn't be compiled.
+
+    The two versions are compared in tests/test_fit_spe_funcs.py. If the
+    BTL_CHECK_COMPILED_MODELS environment variable is set they are also
+    compared here with `compare_vinogradov_models()` and a difference raises
+    a RuntimeError, so a change to one model which isn't made to the other
+    is caught before any fits are done with it.
+    """
+    if not hasattr(ROOT, 'btl') or not hasattr(ROOT.btl, 'vinogradov_model'):
+        if not ROOT.gInterpreter.Declare(VINOGRADOV_CPP):
+            print("Failed to compile the vinogradov model! Using the python version.", file=sys.stderr)
+            return None
+    compiled = ROOT.btl.vinogradov_model
+
+    if CHECK_COMPILED_MODELS:
+        problem = compare_vinogradov_models(compiled)
+        if problem is not None:
+            raise RuntimeError(problem)
+    return compiled
+
 def plot_dists():
     """
     Plots the poisson and vinogradov distributions, then exits on user input.
@@ -260,7 +385,28 @@ def multigaussian_dfixed(x, par):
         model += par[6+2*jj] * TMath.Gaus(x[0],par[4] + jj* par[5] ,par[7+2*jj])
     return model
 
-def fit_spe(h, model, f_h=None, root_func=False):
+def write_spe_fit(h, model, pars, errors):
+    """
+    Writes the SPE fit with parameters `pars` and errors `errors` for the
+    histogram `h` found without ROOT (see `fit_spe_batch`) the same way as
+    `fit_spe()` does, i.e. as the TF1 "<name>_fit" which is also added to
+    the functions of `h` so it's drawn with it.
+    """
+    if isinstance(model, vinogradov_model):
+        model = compiled_vinogradov_model() or model
+
+    f1 = ROOT.TF1("%s_fit" % h.GetName(), model, h.GetXaxis().GetXmin(), h.GetXaxis().GetXmax(), 7)
+    f1.SetNpx(fit_npx())
+    f1.SetLineColor(ROOT.kRed)
+    for i in range(7):
+        f1.SetParameter(i, pars[i])
+        f1.SetParError(i, errors[i])
+    h.GetListOfFunctions().Add(f1)
+    h.SetAxisRange(1., h.GetBinContent(h.GetMaximumBin())+h.GetEntries()*0.0025, "Y")
+    write_fit_result(f1)
+    return f1
+
+def fit_spe(h, model, f_h=None, root_func=False, gradient=False, prior=None):
     """ 
     SPE Fitting Strategy
     
@@ -292,6 +438,15 @@ def fit_spe(h, model, f_h=None, root_func=False):
 
     If the fit is successful, returns the list of fit parameters, otherwise
     returns None.
+
+    If `gradient` is True and `model` is a `vinogradov_model`, the fits are
+    done with `fit_chi2()` using the analytic derivatives of the model
+    instead of Minuit estimating them with finite differences.
+
+    If `prior` is the list of parameters of an earlier fit of the same
+    channel (see `fit_priors`), the SPE charge, SPE charge spread and
+    crosstalk probability start from its values instead of the defaults.
+    The offset, noise and `l` are still estimated from `h`.
     """
     offset = D_OFFSET
     raw_spread = D_ZERO_PEAK_SPREAD
@@ -300,23 +455,11 @@ def fit_spe(h, model, f_h=None, root_func=False):
         print('Ignoring filtered data; outdated procedure')
 
     # Try to guess the offset by looking for the highest peak less than zero
-    xmax = None
-    ymax = 0
-    for i in range(1,h.GetNbinsX()-1):
-        x = h.GetBinCenter(i)
-
-        value = h.GetBinContent(i)
-
-        if x < 1 and value > ymax:
-            xmax = x
-            ymax = value
-
-        # Depending on binning, this may break too early
-        # if value < ymax*0.8:
-        #     break
-
-    if xmax is None:
+    centers = bin_centers(h)[1:h.GetNbinsX()-1]
+    contents = np.where(centers < 1, bin_contents(h)[1:h.GetNbinsX()-1], 0)
+    if len(contents) == 0 or contents.max() <= 0:
         return None
+    xmax = centers[np.argmax(contents)]
 
     offset = xmax
     
@@ -353,13 +496,20 @@ def fit_spe(h, model, f_h=None, root_func=False):
     SPE_charge = min(4, SPE_charge)
     SPE_charge = max(zero_peak_end - offset, SPE_charge)
 
+    # Model whose gradient fit_chi2() uses, if any.
+    gradient_model = model if gradient and not root_func and isinstance(model, vinogradov_model) else None
+    if isinstance(model, vinogradov_model):
+        # Use the compiled model if we can, since the python one is called
+        # for every bin on every iteration of the fit.
+        model = compiled_vinogradov_model() or model
+
     if root_func:
         f1 = ROOT.TF1("%s_fit" % h.GetName(), MultiGaussian, offset - 1.5*raw_spread, offset + 8*h.GetStdDev())
     else:
         # Number of parameters must be specified when using a python function
         f1 = ROOT.TF1("%s_fit" % h.GetName(), model, offset - 1.5*raw_spread, offset + 8*h.GetStdDev(), 7)
 
-        f1.SetNpx(10000)
+        f1.SetNpx(fit_npx())
         f1.SetLineColor(ROOT.kRed)
 
         f1.SetParameter(0, scale)
@@ -371,11 +521,17 @@ def fit_spe(h, model, f_h=None, root_func=False):
         f1.SetParLimits(2, 0, num_peaks+5)
 
         SPE_charge = 4
+        spe_charge_spread = D_SPE_CHARGE_SPREAD
+        if prior is not None:
+            # Stay within the limits of the second fit.
+            SPE_charge = max(zero_peak_end - offset, prior[3])
+            spe_charge_spread = min(max(prior[5], 0), 0.5)
+            ps = min(max(prior[6], 0.01), 0.1)
         f1.SetParameter(3, SPE_charge)
         f1.SetParLimits(3, zero_peak_end - offset, SPE_charge + 2)
         f1.FixParameter(4, raw_spread)
     
-        f1.FixParameter(5, D_SPE_CHARGE_SPREAD)
+        f1.FixParameter(5, spe_charge_spread)
         
         f1.FixParameter(6, ps)
         f1.FixParameter(7, 0)
@@ -383,7 +539,10 @@ def fit_spe(h, model, f_h=None, root_func=False):
         #for i in range(6):
         #    print(f'[{i}]: {f1.GetParameter(i)}')
     
-        r = h.Fit(f1, 'Q0SRB')
+        if gradient_model is not None:
+            fit_chi2(h, f1, gradient_model, f1.GetXmin(), f1.GetXmax(), quiet=True, gradient=True)
+        else:
+            r = h.Fit(f1, 'Q0SRB')
 
         h.SetAxisRange(1., h.GetBinContent(h.GetMaximumBin())+h.GetEntries()*0.0025, "Y")
         #h.Write()
@@ -399,8 +558,11 @@ def fit_spe(h, model, f_h=None, root_func=False):
             f1.SetParLimits(6, 0.01, 0.1)
             
 
-    r = h.Fit(f1, 'QSR+')
-    r = r.Get()
+    if gradient_model is not None:
+        r = fit_chi2(h, f1, gradient_model, f1.GetXmin(), f1.GetXmax(), quiet=True, gradient=True)
+    else:
+        r = h.Fit(f1, 'QSR+')
+        r = r.Get()
     if not r.IsValid():
         print("Fit error!")
         return None
@@ -409,7 +571,7 @@ def fit_spe(h, model, f_h=None, root_func=False):
     #     print("par", i, ": ", f1.GetParameter(i))
         
     h.SetAxisRange(1., h.GetBinContent(h.GetMaximumBin())+h.GetEntries()*0.0025, "Y")
-    f1.Write()
+    write_fit_result(f1, r)
     #h.Write()
 
     return [f1.GetParameter(i) for i in range(7)], [f1.GetParError(i) for i in range(7)]
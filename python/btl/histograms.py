@@ -0,0 +1,190 @@
+"""
+Converting between ROOT histograms and NumPy arrays.
+
+Filling a histogram with `for x in charges: h.Fill(x)` is one PyROOT call per
+event, which for a full module is millions of calls. `fill_histogram()` bins
+the values with NumPy and sets the bin contents, errors and statistics with a
+handful of calls, giving exactly the same histogram as calling `Fill()` for
+each value. `histogram_counts()` gives the same bin contents without a ROOT
+histogram, e.g. for fitting them with NumPy.
+
+The same goes for reading a histogram with `GetBinContent()` and
+`GetBinCenter()` one bin at a time. `bin_contents()` and `bin_sumw2()` return
+NumPy arrays which share memory with the histogram, and `bin_errors()`,
+`bin_centers()` and `bin_edges()` compute the rest of the bins at once, so the
+peak finding and the seeding of the fits can work on whole arrays. The arrays
+for the contents, errors and centers are indexed by the bin number, i.e.
+they include the underflow and overflow bins.
+
+Example:
+
+    h = ROOT.TH1D("spe_ch0", "SPE Charge Integral for ch0", len(bins), bins[0], bins[-1])
+    fill_histogram(h, charges)
+    peak = bin_centers(h)[np.argmax(bin_contents(h)[1:-1]) + 1]
+"""
+from __future__ import print_function, division
+import numpy as np
+
+# Types of the bin contents. A TH1D is also the TArrayD with the contents of
+# all its bins, a TH1F a TArrayF, and so on.
+ARRAY_TYPES = (
+    ('TArrayD', np.float64),
+    ('TArrayF', np.float32),
+    ('TArrayL64', np.int64),
+    ('TArrayI', np.int32),
+    ('TArrayS', np.int16),
+    ('TArrayC', np.int8),
+)
+
+def _view(buffer, dtype, n):
+    """
+    Returns the `n` values of type `dtype` at the PyROOT pointer `buffer` as a
+    NumPy array without copying them.
+    """
+    if n == 0:
+        return np.zeros(0, dtype=dtype)
+    # PyROOT doesn't know how long the buffer is.
+    buffer.reshape((n,))
+    return np.frombuffer(buffer, dtype=dtype, count=n)
+
+def bin_contents(h):
+    """
+    Returns the contents of all the bins of the TH1 `h`, i.e. element `i` is
+    `h.GetBinContent(i)`.
+
+    The array shares memory with `h`, so it changes when `h` is filled and is
+    only valid as long as `h` isn't deleted or rebinned. Copy it if it needs
+    to be kept or changed.
+    """
+    for name, dtype in ARRAY_TYPES:
+        if h.InheritsFrom(name):
+            return _view(h.GetArray(), dtype, h.GetNcells())
+    raise TypeError("don't know the type of the bin contents of %s" % h.ClassName())
+
+def bin_sumw2(h):
+    """
+    Returns the sum of the squared weights of all the bins of the TH1 `h`, or
+    None if `h` doesn't store them, without copying them like
+    `bin_contents()`.
+    """
+    sumw2 = h.GetSumw2()
+    if sumw2.GetSize() == 0:
+        return None
+    return _view(sumw2.GetArray(), np.float64, sumw2.GetSize())
+
+def bin_errors(h):
+    """
+    Returns the errors of all the bins of the TH1 `h`, i.e. element `i` is
+    `h.GetBinError(i)` for the default (not Poisson) errors.
+    """
+    sumw2 = bin_sumw2(h)
+    if sumw2 is None:
+        return np.sqrt(np.abs(bin_contents(h).astype(np.float64)))
+    return np.sqrt(sumw2)
+
+def bin_edges(h):
+    """
+    Returns the `GetNbinsX() + 1` bin edges of the TH1 `h`, i.e. the low edges
+    of all the bins and the high edge of the last one.
+    """
+    axis = h.GetXaxis()
+    nbins = axis.GetNbins()
+    xbins = axis.GetXbins()
+    if xbins.GetSize() > 0:
+        # Variable bin widths.
+        return _view(xbins.GetArray(), np.float64, xbins.GetSize())
+    # Same as TAxis::GetBinLowEdge().
+    width = (axis.GetXmax() - axis.GetXmin())/nbins
+    return axis.GetXmin() + np.arange(nbins + 1)*width
+
+def bin_centers(h):
+    """
+    Returns the centers of all the bins of the TH1 `h`, i.e. element `i` is
+    exactly `h.GetBinCenter(i)`.
+    """
+    axis = h.GetXaxis()
+    nbins = axis.GetNbins()
+    # Same order of operations as TAxis::GetBinCenter(), which for the
+    # underflow and overflow bins uses the average bin width.
+    width = (axis.GetXmax() - axis.GetXmin())/nbins
+    centers = axis.GetXmin() + (np.arange(nbins + 2) - 1)*width + 0.5*width
+    if axis.GetXbins().GetSize() > 0:
+        edges = bin_edges(h)
+        centers[1:-1] = edges[:-1] + 0.5*(edges[1:] - edges[:-1])
+    return centers
+
+def find_bins(h, x):
+    """
+    Returns the bin number of each value in `x` for the TH1 `h` the same way
+    as `TAxis::FindBin()`, i.e. 0 for underflow and `GetNbinsX() + 1` for
+    overflow (including NaN).
+    """
+    axis = h.GetXaxis()
+    nbins = axis.GetNbins()
+    xbins = axis.GetXbins()
+    x = np.asarray(x, dtype=np.float64)
+    if xbins.GetSize() > 0:
+        # Variable bin widths.
+        return np.searchsorted(bin_edges(h), x, side='right')
+
+    return bin_numbers(x, nbins, axis.GetXmin(), axis.GetXmax())
+
+def bin_numbers(x, nbins, xmin, xmax):
+    """
+    Returns the bin number of each value in `x` for `nbins` equal bins from
+    `xmin` to `xmax`, numbered like ROOT with 0 for underflow and `nbins + 1`
+    for overflow (including NaN).
+    """
+    x = np.asarray(x, dtype=np.float64)
+    bins = np.full(len(x), nbins + 1, dtype=np.int64)
+    bins[x < xmin] = 0
+    inside = (x >= xmin) & (x < xmax)
+    # Same order of operations as TAxis::FindBin() so that values on a bin
+    # edge end up in the same bin.
+    bins[inside] = np.minimum(1 + (nbins*(x[inside] - xmin)/(xmax - xmin)).astype(np.int64), nbins)
+    return bins
+
+def histogram_counts(x, nbins, xmin, xmax, counts=None):
+    """
+    Returns the contents of a histogram of `x` with `nbins` equal bins from
+    `xmin` to `xmax`, including the underflow and overflow bins, i.e. the
+    same as `GetBinContent(i)` for i from 0 to `nbins + 1` of a TH1 filled
+    with `x`. If `counts` is given, each value of `x` is counted that many
+    times.
+    """
+    return np.bincount(bin_numbers(x, nbins, xmin, xmax), weights=counts, minlength=nbins + 2).astype(np.float64)
+
+def fill_histogram(h, x, counts=None):
+    """
+    Fills the TH1 `h` with all the values in `x`, each with weight 1. This is
+    the same as calling `h.Fill(value)` for each value, including the number
+    of entries and the statistics used by `GetMean()` and `GetStdDev()`,
+    which like `Fill()` don't include the underflow and overflow bins. If
+    `counts` is given, each value of `x` is filled that many times, e.g. for
+    the `values` and `counts` of an `accumulators.ChargeHistogram`.
+
+    Returns `h`.
+    """
+    x = np.asarray(x, dtype=np.float64).ravel()
+    if counts is None:
+        counts = np.ones(len(x))
+    counts = np.asarray(counts, dtype=np.float64).ravel()
+    nbins = h.GetNbinsX()
+    bins = find_bins(h, x)
+
+    content = bin_contents(h) + np.bincount(bins, weights=counts, minlength=nbins + 2)
+    entries = h.GetEntries() + np.sum(counts)
+
+    stats = np.zeros(4)
+    h.GetStats(stats)
+    inside = (bins > 0) & (bins <= nbins)
+    n = np.sum(counts[inside])
+    stats += [n, n, np.sum(counts[inside]*x[inside]), np.sum(counts[inside]*x[inside]**2)]
+
+    h.SetContent(content)
+    if h.GetSumw2N() > 0:
+        # With unit weights the sum of the squared weights is the content.
+        h.SetError(np.sqrt(content))
+    h.PutStats(stats)
+    h.SetEntries(entries)
+    return h
@@ -0,0 +1,233 @@
+"""
+Reading and writing the integrals files made by `integrate-waveforms`.
+
+An integrals file has one hdf5 group for each group of waveforms ('lyso',
+'sodium', 'spe', ...). The per event quantities are stored as a single
+(events x channels) matrix each, so a reader gets all the channels with one
+contiguous read:
+
+    charge      float32  integrated charge in pC, NaN for cut events
+    t10, t40, t90
+                float32  10%, 40% and 90% crossing times of the rising edge in ns
+    fall_time   float32  time between the 90% and 10% crossings of the falling
+                         edge in ns
+    saturated   uint8    1 if the digitizer saturated
+    good        uint8    0 for events cut by the SPE baseline subtraction and
+                         for padding past the last event of a channel
+
+The column of each channel is given by the `channels` attribute of the group,
+and the number of events of each channel by `n_events`. The group also has
+the integration window of each channel (`window`, channels x 2, -1 for
+channels where the window was found separately for every block) and, for the
+source groups, the average pulse (`avg_pulse_x` and the channels x samples
+matrices `avg_pulse_y`, `avg_pulse_var`, `avg_pulse_p10`, ...). The other
+group attributes are the parameters used for the integration, and the
+`source_fingerprint` attribute of the file identifies the raw waveform file
+(see `fingerprint()`), so analyses can check whether the integrals are up to
+date with `check_integrals()` before using them instead of the waveforms.
+
+The matrices are chunked by blocks of `EVENTS_PER_CHUNK` events and
+compressed with lzf, which is fast enough that reading them is limited by the
+disk.
+
+Example:
+
+    integrals = read_integrals('run_integrals.hdf5', 'lyso')
+    charge = integrals['charge'][:,integrals['channels'].index('ch3')]
+"""
+from __future__ import print_function, division
+import hashlib
+import os
+import h5py
+import numpy as np
+
+# Written to the `format` and `version` attributes of the file. Bump the
+# version whenever the layout changes so old files can be recognized.
+FORMAT = 'btl-integrals'
+VERSION = 2
+
+# Number of events in each hdf5 chunk. With 32 float32 columns this is 1 MB.
+EVENTS_PER_CHUNK = 8192
+
+# Per event quantities and their types. Missing values are NaN for the floats
+# and 0 otherwise.
+EVENT_KEYS = {
+    'charge': np.float32,
+    't10': np.float32,
+    't40': np.float32,
+    't90': np.float32,
+    'fall_time': np.float32,
+    'saturated': np.uint8,
+    'good': np.uint8,
+}
+
+def is_integrals_file(f):
+    """
+    Returns True if the opened hdf5 file `f` is an integrals file in the
+    current format.
+    """
+    return f.attrs.get('format') in (FORMAT, FORMAT.encode()) and f.attrs.get('version') == VERSION
+
+def fingerprint(f):
+    """
+    Returns a string which identifies the opened raw waveform file `f`. This
+    is a hash of the attributes of the file and its groups and the names,
+    shapes and types of all the datasets, so it doesn't read any waveforms and
+    doesn't change when the file is copied.
+    """
+    h = hashlib.sha1()
+    def update(name, item):
+        h.update(name.encode())
+        if isinstance(item, h5py.Dataset):
+            h.update(repr((item.shape, item.dtype.str)).encode())
+        for key in sorted(item.attrs):
+            h.update(repr((key, item.attrs[key])).encode())
+    update('/', f)
+    f.visititems(update)
+    return h.hexdigest()
+
+def empty_columns(channels, n, keys=EVENT_KEYS):
+    """
+    Returns a dictionary with an empty (n x len(channels)) matrix for each of
+    the per event quantities in `keys`.
+    """
+    columns = {}
+    for key in keys:
+        dtype = EVENT_KEYS[key]
+        fill = np.nan if np.issubdtype(dtype, np.floating) else 0
+        columns[key] = np.full((n, len(channels)), fill, dtype=dtype)
+    return columns
+
+def write_integrals(f, group, channels, columns, n_events, windows=None, pulses=None, attrs=None):
+    """
+    Writes the integrals for `group` to the opened hdf5 file `f`.
+
+    `channels` is the list of channel names and `columns` a dictionary
+    mapping the names in `EVENT_KEYS` to (events x len(channels)) matrices.
+    `n_events` is the number of events of each channel. `windows` and
+    `pulses` are optional dictionaries mapping channel names to the
+    integration window and the PulseAccumulator of the average pulse. `attrs`
+    is an optional dictionary of extra attributes for the group, e.g. the
+    parameters used for the integration.
+    """
+    f.attrs['format'] = FORMAT
+    f.attrs['version'] = VERSION
+
+    g = f.create_group(group)
+    g.attrs['channels'] = np.array([int(channel[2:]) for channel in channels], dtype=np.int32)
+    g.attrs['n_events'] = np.array([n_events[channel] for channel in channels], dtype=np.int64)
+    if attrs:
+        g.attrs.update(attrs)
+
+    for key, value in columns.items():
+        value = np.asarray(value, dtype=EVENT_KEYS[key])
+        chunks = (max(min(len(value), EVENTS_PER_CHUNK), 1), max(value.shape[1], 1))
+        g.create_dataset(key, data=value, chunks=chunks, compression='lzf', shuffle=True)
+
+    if windows:
+        g.create_dataset('window', data=np.array([windows.get(channel, (-1, -1)) for channel in channels], dtype=np.int32))
+
+    if pulses:
+        pulse = pulses[channels[0]]
+        g.create_dataset('avg_pulse_x', data=pulse.x)
+        g.create_dataset('avg_pulse_y', data=np.array([pulses[channel].mean for channel in channels]))
+        g.create_dataset('avg_pulse_var', data=np.array([pulses[channel].variance() for channel in channels]))
+        g.create_dataset('avg_pulse_count', data=np.array([pulses[channel].count for channel in channels]))
+        for q in pulse.percentiles:
+            g.create_dataset('avg_pulse_p%i' % q, data=np.array([pulses[channel].band(q) for channel in channels]))
+
+def read_integrals(f, group, keys=None):
+    """
+    Reads the integrals for `group` from the integrals file `f`, which can be
+    a filename or an opened hdf5 file. Returns a dictionary with all the
+    datasets in the group (or only the ones in `keys`), the list of channel
+    names under 'channels' and the number of events for each channel under
+    'n_events'.
+    """
+    if not isinstance(f, h5py.File):
+        with h5py.File(f,'r') as f:
+            return read_integrals(f, group, keys)
+
+    if not is_integrals_file(f):
+        raise ValueError("%s is not an integrals file (version %i)" % (f.filename, VERSION))
+
+    g = f[group]
+    integrals = {}
+    for key in g:
+        if keys is None or key in keys:
+            integrals[key] = g[key][()]
+    integrals['channels'] = ['ch%i' % ch for ch in g.attrs['channels']]
+    integrals['n_events'] = dict(zip(integrals['channels'], map(int, g.attrs['n_events'])))
+    return integrals
+
+def read_pulses(integrals):
+    """
+    Returns a dictionary mapping each channel to a PulseAccumulator with the
+    average pulse in `integrals` as returned by `read_integrals()`, or an
+    empty dictionary if there is none.
+    """
+    from .accumulators import PulseAccumulator
+
+    if 'avg_pulse_x' not in integrals:
+        return {}
+    percentiles = sorted(int(key[len('avg_pulse_p'):]) for key in integrals if key.startswith('avg_pulse_p'))
+    pulses = {}
+    for j, channel in enumerate(integrals['channels']):
+        pulse = PulseAccumulator(integrals['avg_pulse_x'], percentiles)
+        pulse.count = int(integrals['avg_pulse_count'][j])
+        pulse.mean = integrals['avg_pulse_y'][j]
+        pulse.m2 = np.nan_to_num(integrals['avg_pulse_var'][j])*max(pulse.count - 1, 0)
+        pulse.bands = np.array([integrals['avg_pulse_p%i' % q][j] for q in percentiles])
+        pulses[channel] = pulse
+    return pulses
+
+def check_integrals(filename, raw, group, channels, params, windows):
+    """
+    Checks whether the integrals for `group` in the integrals file `filename`
+    can be used instead of integrating the channels `channels` of the opened
+    raw waveform file `raw`. The integrals must come from the same raw file,
+    include all of `channels` and have been integrated with the attributes in
+    `params` and the integration windows `windows`, a dictionary mapping each
+    channel to the window (a, b) or (-1, -1) if it's found for every block.
+
+    Returns None if the integrals are up to date, otherwise a string saying
+    why not.
+    """
+    if not os.path.exists(filename):
+        return "%s doesn't exist" % filename
+
+    with h5py.File(filename,'r') as f:
+        if not is_integrals_file(f):
+            return "%s is not an integrals file (version %i)" % (filename, VERSION)
+        if f.attrs.get('source_fingerprint') != fingerprint(raw):
+            return "%s was integrated from a different raw file" % filename
+        if group not in f:
+            return "%s has no %s group" % (filename, group)
+
+        g = f[group]
+        stored = ['ch%i' % ch for ch in g.attrs['channels']]
+        for channel in channels:
+            if channel not in stored:
+                return "%s has no %s %s integrals" % (filename, group, channel)
+
+        for key, value in params.items():
+            if key not in g.attrs or not np.array_equal(g.attrs[key], value):
+                return "%s has %s %s=%s, not %s" % (filename, group, key, g.attrs.get(key), value)
+
+        window = g['window'][()] if 'window' in g else np.full((len(stored), 2), -1)
+        for channel in channels:
+            if tuple(window[stored.index(channel)]) != tuple(windows.get(channel, (-1, -1))):
+                return "%s has a different %s %s integration window" % (filename, group, channel)
+
+    return None
+
+def read_windows(filename, group):
+    """
+    Returns a dictionary mapping each channel to the integration window for
+    `group` stored in the integrals file `filename`.
+    """
+    with h5py.File(filename,'r') as f:
+        if group not in f or 'window' not in f[group]:
+            return {}
+        integrals = read_integrals(f, group, keys=['window'])
+    return {channel: (int(a), int(b)) for channel, (a, b) in zip(integrals['channels'], integrals['window']) if a >= 0}
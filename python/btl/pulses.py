@@ -0,0 +1,317 @@
+"""
+Fused pulse feature extraction for blocks of waveforms.
+
+`pulse_features()` replaces the chain of `get_window()`, the median baseline
+subtraction, `integrate()`, `get_rise_time()`, `get_fall_time()` and
+`checkSat()` in the integration scripts. Each of those built their own
+(events x samples) boolean masks. Here we only ever walk outwards from the
+minimum of each waveform, so apart from the baseline samples the temporary
+arrays are all one value per event.
+
+If numba is installed the per event work is compiled, otherwise a NumPy
+implementation with the same results is used.
+"""
+from __future__ import print_function, division
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# Resistance of CAEN digitizer. Used to convert integrated voltage
+# signal to charge.
+CAEN_R = 50.0
+
+# Fractions of the pulse height at which we find the threshold crossings. The
+# rising edge crossings must be sorted from largest to smallest since each
+# walk starts where the previous one stopped.
+RISING = (0.9, 0.4, 0.1)
+FALLING = (0.9, 0.1)
+
+BACKENDS = ('numba', 'numpy') if numba is not None else ('numpy',)
+
+def _baseline(x, y, baseline):
+    """
+    Returns the median of the samples in the first `baseline` ns of every
+    waveform in `y`, or zeros if `baseline` is None.
+    """
+    if baseline is None:
+        return np.zeros(len(y), dtype=y.dtype)
+    k = max(int(np.count_nonzero(x < x[0] + baseline)), 1)
+    return np.median(y[:,:k],axis=-1)
+
+def _trapz_weights(x, a, b):
+    """
+    Returns the weights `w` such that `y[:,a:b] @ w` is the trapezoid integral
+    of `y` from `x[a]` to `x[b-1]`.
+    """
+    dx = np.diff(x[a:b])
+    w = np.zeros(b - a)
+    w[:-1] += dx/2
+    w[1:] += dx/2
+    return w
+
+def _crossings_numpy(x, y, start, thresholds, rising):
+    """
+    Returns the interpolated times at which each waveform in `y` first crosses
+    above `thresholds` going backwards (`rising`) or forwards from the sample
+    `start`, along with the index of the crossing sample. Events which never
+    cross are set to NaN and their index is left at `start`.
+
+    Only the events which haven't crossed yet are looked at for each step, so
+    this is fast when the crossings are close to `start`.
+    """
+    n, m = y.shape
+    step = -1 if rising else 1
+    index = start.copy()
+    found = np.zeros(n, dtype=bool)
+    active = np.arange(n)
+    i = start.copy()
+    while active.size:
+        i = i + step
+        ok = (i >= 0) & (i < m)
+        active, i = active[ok], i[ok]
+        hit = y[active,i] > thresholds[active]
+        index[active[hit]] = i[hit]
+        found[active[hit]] = True
+        active, i = active[~hit], i[~hit]
+
+    if rising:
+        il = index
+        ir = np.minimum(il + 1, m - 1)
+    else:
+        ir = index
+        il = np.maximum(ir - 1, 0)
+    events = np.arange(n)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = x[il] + (thresholds - y[events,il])*(x[ir] - x[il])/(y[events,ir] - y[events,il])
+    t[~found] = np.nan
+    return t, index
+
+def _features_numpy(x, y, baseline):
+    n = len(y)
+    argmin = np.argmin(y,axis=-1)
+    ymin = y[np.arange(n),argmin]
+    base = _baseline(x, y, baseline)
+    height = ymin - base
+
+    rise = {}
+    start = argmin
+    for f in RISING:
+        rise[f], index = _crossings_numpy(x, y, start, base + f*height, True)
+        # Lower thresholds always cross at or before higher ones.
+        start = np.where(np.isnan(rise[f]), start, index + 1)
+
+    fall = {}
+    start = argmin
+    for f in FALLING:
+        fall[f], index = _crossings_numpy(x, y, start, base + f*height, False)
+        start = np.where(np.isnan(fall[f]), start, index - 1)
+
+    return argmin, ymin, base, rise, fall
+
+if numba is not None:
+    @numba.njit(cache=True)
+    def _crossing_numba(x, y, start, threshold, rising):
+        m = len(y)
+        if rising:
+            i = start - 1
+            while i >= 0 and not y[i] > threshold:
+                i -= 1
+            if i < 0:
+                return np.nan, start
+            il, ir = i, min(i + 1, m - 1)
+        else:
+            i = start + 1
+            while i < m and not y[i] > threshold:
+                i += 1
+            if i >= m:
+                return np.nan, start
+            il, ir = max(i - 1, 0), i
+        return x[il] + (threshold - y[il])*(x[ir] - x[il])/(y[ir] - y[il]), i
+
+    @numba.njit(cache=True)
+    def _features_numba_kernel(x, y, k, rising, falling, argmin, ymin, base, rise, fall):
+        for j in range(y.shape[0]):
+            w = y[j]
+            imin = 0
+            for i in range(1, len(w)):
+                if w[i] < w[imin]:
+                    imin = i
+            argmin[j] = imin
+            ymin[j] = w[imin]
+            if k > 0:
+                base[j] = np.median(w[:k])
+            else:
+                base[j] = 0
+            height = ymin[j] - base[j]
+
+            start = imin
+            for l in range(len(rising)):
+                t, i = _crossing_numba(x, w, start, base[j] + rising[l]*height, True)
+                rise[l,j] = t
+                if not np.isnan(t):
+                    start = i + 1
+
+            start = imin
+            for l in range(len(falling)):
+                t, i = _crossing_numba(x, w, start, base[j] + falling[l]*height, False)
+                fall[l,j] = t
+                if not np.isnan(t):
+                    start = i - 1
+
+    @numba.njit(cache=True)
+    def _charge_numba(y, w, a, base, charge):
+        wsum = 0.0
+        for i in range(len(w)):
+            wsum += w[i]
+        for j in range(y.shape[0]):
+            total = 0.0
+            for i in range(len(w)):
+                total += w[i]*y[j,a+i]
+            charge[j] = total - base[j]*wsum
+
+def _features_numba(x, y, baseline):
+    n = len(y)
+    k = 0 if baseline is None else max(int(np.count_nonzero(x < x[0] + baseline)), 1)
+    argmin = np.empty(n, dtype=np.intp)
+    ymin = np.empty(n, dtype=y.dtype)
+    base = np.empty(n, dtype=y.dtype)
+    rise = np.empty((len(RISING), n))
+    fall = np.empty((len(FALLING), n))
+    _features_numba_kernel(x, y, k, np.array(RISING), np.array(FALLING), argmin, ymin, base, rise, fall)
+    return argmin, ymin, base, dict(zip(RISING, rise)), dict(zip(FALLING, fall))
+
+def get_noise(x, y, base, noise=10):
+    """
+    Returns the interquartile range of the baseline subtracted samples in the
+    first `noise` ns of all the waveforms in `y`.
+    """
+    k = max(int(np.count_nonzero(x < x[0] + noise)), 1)
+    s = y[:,:k] - base[:,np.newaxis]
+    return np.percentile(s,75) - np.percentile(s,25)
+
+def get_pulse_window(x, t40, height, noise, left=1, right=10):
+    """
+    Returns the indices start and stop over which you should integrate the
+    waveforms. The window is found by calculating the median 40% crossing
+    time `t40` for all events with a pulse larger than 5 times the `noise`
+    and then going back `left` ns and forward `right` ns.
+    """
+    pulses = height < -noise*5
+    # Select events with pulses. If there are no matches (which might be the
+    # case for the triggering channel), then don't apply the selection.
+    if np.count_nonzero(pulses):
+        t40 = t40[pulses]
+    t40 = t40[~np.isnan(t40)]
+    hit_time = np.median(t40) if len(t40) else x[0]
+    a, b = np.searchsorted(x,[hit_time-left,hit_time+right])
+    a = max(int(a), 0)
+    b = min(int(b), len(x) - 1)
+    return a, b
+
+def pulse_features(x, y, window=None, left=50, right=350, baseline=100, backend=None):
+    """
+    Computes the pulse features of all waveforms in `y` with times `x` in a
+    single pass over each waveform. `y` is not modified.
+
+    The baseline of each event is the median of the first `baseline` ns. If
+    `baseline` is None, the waveforms are assumed to be baseline subtracted
+    already. The integration window is given by `window` as a tuple of
+    indices (a, b), or if it is None, found from the median 40% crossing time
+    going back `left` ns and forward `right` ns (see `get_pulse_window()`).
+
+    Returns a dictionary with:
+
+        argmin: index of the minimum sample
+        baseline: the baseline of each event
+        height: the minimum sample minus the baseline
+        charge: the baseline subtracted charge integrated over the window
+        t10, t40, t90: 10%, 40% and 90% crossing times on the rising edge
+        fall_t90, fall_t10: 90% and 10% crossing times on the falling edge
+        rise_time, fall_time: t90 - t10 and fall_t10 - fall_t90
+        saturated: True for events where the digitizer saturated
+        window: the integration window (a, b)
+
+    Crossing times are NaN if the waveform never crosses the threshold.
+    `backend` is one of `BACKENDS` and defaults to numba if it's installed.
+    """
+    if backend is None:
+        backend = BACKENDS[0]
+    if backend not in BACKENDS:
+        raise ValueError("unknown backend '%s'" % backend)
+
+    y = np.asarray(y)
+    x = np.asarray(x, dtype=np.float64)
+
+    if backend == 'numba':
+        argmin, ymin, base, rise, fall = _features_numba(x, y, baseline)
+    else:
+        argmin, ymin, base, rise, fall = _features_numpy(x, y, baseline)
+
+    height = ymin - base
+    if window is None:
+        noise = get_noise(x, y, base) if baseline is not None else 0
+        window = get_pulse_window(x, rise[0.4], height, noise, left, right)
+    a, b = window
+
+    # Integrate the baseline subtracted waveforms without making a baseline
+    # subtracted copy.
+    # i = v/r
+    # divide by `CAEN_R` to convert to a charge
+    w = _trapz_weights(x, a, b)
+    if backend == 'numba':
+        charge = np.empty(len(y))
+        _charge_numba(y, w, a, base, charge)
+    else:
+        # Accumulate in double precision like the numba kernel, without
+        # converting the whole block of float32 samples.
+        charge = np.einsum('ij,j->i', y[:,a:b], w, dtype=np.float64) - base.astype(np.float64)*w.sum()
+    charge = -charge*1000/CAEN_R
+
+    return {
+        'argmin': argmin,
+        'baseline': base,
+        'charge': charge,
+        't10': rise[0.1],
+        't40': rise[0.4],
+        't90': rise[0.9],
+        'fall_t90': fall[0.9],
+        'fall_t10': fall[0.1],
+        'height': height,
+        'rise_time': rise[0.9] - rise[0.1],
+        'fall_time': fall[0.1] - fall[0.9],
+        # The digitizer clips at zero.
+        'saturated': ymin == 0.0,
+        'window': (a, b),
+    }
+
+def estimate_windows(source, channels, events=5000, left=50, right=350, baseline=100, seed=0):
+    """
+    Returns a dictionary mapping each channel in `channels` to the integration
+    window (a, b) found from a random sample of about `events` events from
+    the WaveformSource `source`. See `get_pulse_window()`.
+
+    This is used to find the window once before integrating the whole
+    channel, so that the window doesn't drift from one block to the next and
+    we don't have to look for it in every block.
+    """
+    t40 = {channel: [] for channel in channels}
+    height = {channel: [] for channel in channels}
+    noise = {channel: [] for channel in channels}
+    for start, stop in source.sample_ranges(channels, events, seed):
+        x, y = source.read_block(channels, start, stop)
+        for j, channel in enumerate(channels):
+            # The window doesn't matter here, so just pass something to skip
+            # looking for it.
+            features = pulse_features(x, y[j], window=(0, 1), baseline=baseline)
+            t40[channel].append(features['t40'])
+            height[channel].append(features['height'])
+            noise[channel].append(get_noise(x, y[j], features['baseline']))
+
+    windows = {}
+    for channel in channels:
+        x = source.time(channel)
+        windows[channel] = get_pulse_window(x, np.concatenate(t40[channel]), np.concatenate(height[channel]), np.median(noise[channel]), left, right)
+    return windows
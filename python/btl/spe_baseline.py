@@ -0,0 +1,123 @@
+"""
+Baseline subtraction of the SPE waveforms.
+
+`spe_baseline_subtraction()` is shared by integrate-waveforms,
+analyze-waveforms and analyze_waveforms.py, so the SPE charges are the same
+whichever script integrates them. The baseline subtracted waveforms are
+integrated over the SPE window; see `get_spe_window()` in the scripts.
+
+Example:
+
+    y, good = spe_baseline_subtraction(x, y, a, b, method=1, start_time=50)
+    charge = integrate(x, y, a, b, good)
+"""
+from __future__ import print_function, division
+from functools import lru_cache
+import numpy as np
+from scipy import signal
+
+def iqr(x):
+    return np.percentile(x,75) - np.percentile(x,25)
+
+@lru_cache(maxsize=None)
+def get_spe_filter(dt, btype):
+    """
+    Returns the second order sections of the `btype` ('lowpass' or
+    'highpass') Butterworth filter used for the SPE waveforms with a sample
+    spacing of `dt` ns. The filter is only designed once for each sampling
+    rate. Edit the cutoff frequency by modifying the filter defined below.
+
+    The coefficients are single precision so that filtering a float32 block
+    doesn't make a double precision copy of it.
+    """
+    filter_order = 2
+    nyquist = (0.5 * dt)**(-1)
+    cutoff = 5**(-1)  # Cut off frequency for the filter measured in inverse nanoseconds
+    sos = signal.butter(filter_order, min(1, cutoff/nyquist), btype=btype, output='sos')
+    return sos.astype(np.float32)
+
+def low_filter_SPE(x, y):
+    """
+    Returns `y` through a low pass filter. See `get_spe_filter()`.
+    """
+    return signal.sosfilt(get_spe_filter(float(x[1] - x[0]), 'lowpass'), y)
+
+def high_filter_SPE(x, y):
+    """
+    Returns `y` through a high pass filter. See `get_spe_filter()`.
+    """
+    return signal.sosfilt(get_spe_filter(float(x[1] - x[0]), 'highpass'), y)
+
+def spe_baseline_subtraction(x, y, a, b, method=1, start_time=50):
+    """ 
+    INTEGRATION METHODS
+    0: Only per event median subtraction (preformed in every method).
+
+    1: Cut events where the voltage is more than two standard
+       devations below the baseline at the start or end of the integration
+       window to avoid half pulses.
+
+    2: Per sample median subtraction. This method is not good because the SPE
+       signal gets diminished.
+
+    3: Cut all trials that have an SPE between `ma` and `mb`. Subtract off
+       the median between `ma` and `mb` on a per event basis.
+
+    4: Same as 3, except no trials are deleted. Trials that have an SPE between
+       `ma` and `mb` get reduced by the total median between `ma` and `mb` of
+       events that don't have an SPE in this range.
+
+    The baseline before `start_time` ns is used for the per event median and
+    the noise, and `a` and `b` are the indices of the start and end of the
+    integration window.
+
+    Returns the baseline subtracted waveforms and a boolean array which is
+    False for the events which are cut. Events are never removed from `y` so
+    that all the channels stay aligned event by event.
+    """ 
+    if method in (2, 3, 4):
+        # Only the methods which look for SPEs need the filtered waveforms.
+        # This has to be done before the median subtraction below.
+        high_filter_y = high_filter_SPE(x, y)
+    
+    # Integration Method 0, per event median subtraction:
+    y -= np.median(y[:,x < start_time], axis=-1)[:, np.newaxis]
+
+    # Get a rough approximation of the standard deviation of the noise.
+    std = np.std(y[:,x < start_time])
+
+    good = np.ones(len(y), dtype=bool)
+
+    if method == 1:  # Default 
+        # Cut events where the voltage signal is more than 2 standard
+        # deviations away at the start or stop of the integration window.
+        good = (y[:,a] > -2*std) & (y[:,b] > -2*std)
+    elif method == 2:
+        # Take the median of each sample over all events, ignoring the
+        # samples which are part of a pulse.
+        s_mask = y > -10*iqr(high_filter_y.flatten())
+        print('average number of good samples: %.2f' % np.mean(np.count_nonzero(s_mask, axis=0)))
+        sample_medians = np.nanmedian(np.where(s_mask, y, np.nan), axis=0)
+        y -= sample_medians
+    elif method == 3:
+        ma = -25
+        mb = 200
+        SPE_trials = np.min(y[:, np.logical_and(x >= ma, x < mb)], axis=-1) < -2 * iqr(high_filter_y[:, np.logical_and(x >= ma, x < mb)].flatten())
+        good = ~SPE_trials
+        # Subtract off the median between `ma` and `mb` per event
+        y -= np.median(y[:, np.logical_and(x >= ma, x < mb)], axis=-1)[:, np.newaxis]  # per event median subtraction
+        if not np.any(good):
+            print('All trials were removed')
+    elif method == 4:
+        ma = -25
+        mb = 200
+        m_mask = np.logical_and(x>=ma, x<mb)
+        no_SPE_trials_mask = np.min(y[:, m_mask], axis=-1) > -2 * iqr(high_filter_y[:, m_mask].flatten())
+        medians = np.median(y[:, m_mask], axis=-1)
+        if not np.all(no_SPE_trials_mask):
+            # Events with an SPE get the median of all the events without one.
+            medians[~no_SPE_trials_mask] = np.median(y[no_SPE_trials_mask][:, m_mask])
+        y -= medians[:, np.newaxis]
+    elif method != 0:
+        print('Not a valid integration method. Defaulting to integration method 0')
+    return y, good
@@ -0,0 +1,286 @@
+"""
+Readers for the waveform hdf5 files written by `wavedump` and
+`acquire-waveforms`.
+
+The waveforms are read in blocks of events which are aligned to the hdf5 chunk
+boundaries so that every chunk is only decompressed and copied once. Each
+block is read directly into a preallocated float32 buffer which is reused for
+the next block, so callers must copy any data they want to keep around after
+asking for the next block.
+"""
+from __future__ import print_function, division
+import h5py
+import numpy as np
+
+# Number of events in each hdf5 chunk written by `wavedump`. Only used for
+# datasets which aren't chunked.
+EVENTS_PER_CHUNK = 1024
+
+# The CAEN digitizer is a 12 bit ADC with a 1 V dynamic range.
+CAEN_SCALE = 1/2**12
+
+# The digitizer reads out the 32 channels in four trigger groups:
+# 0: ch0-7
+# 1: ch8-15
+# 2: ch16-23
+# 3: ch24-31
+TRIGGER_GROUPS = [list(range(8*i, 8*(i+1))) for i in range(4)]
+
+def split_trigger_groups(channels):
+    """
+    Splits the channel names in `channels` by trigger group. Returns a list of
+    four lists, one for each trigger group, with the channels sorted by
+    channel number.
+    """
+    groups = [[] for i in range(len(TRIGGER_GROUPS))]
+    for channel in sorted(channels, key=lambda channel: int(channel[2:])):
+        groups[int(channel[2:])//8].append(channel)
+    return groups
+
+class WaveformSource(object):
+    """
+    Reads waveforms for the group `group` from the opened hdf5 file `f`.
+
+    Events are read in blocks of approximately `chunks` events. The block size
+    is rounded down to a multiple of the number of events in each hdf5 chunk.
+
+    Example:
+
+        source = WaveformSource(f, 'lyso', chunks=10000)
+        for channel in source.channels():
+            for x, y in source.iter_chunks(channel):
+                charge.extend(integrate(x, y, a, b))
+    """
+    def __init__(self, f, group, chunks=10000):
+        self.f = f
+        self.group = group
+        self.chunks = chunks
+        # Cache of (dataset, x, scale, offset) for each channel.
+        self._info = {}
+        self._buffer = None
+        self._block_buffer = None
+
+    def channels(self):
+        """
+        Returns the names of all the channels in this group.
+        """
+        return [channel for channel in self.f[self.group] if channel.startswith('ch')]
+
+    def _channel_info(self, channel):
+        """
+        Returns the dataset for `channel`, the time axis in nanoseconds and the
+        scale and offset used to convert the raw values to volts.
+        """
+        if channel in self._info:
+            return self._info[channel]
+
+        f = self.f
+        group = self.group
+        if 'data_source' in f[group].attrs:
+            if f[group].attrs['data_source'] != b'CAEN':
+                raise ValueError("unknown data source '%s'" % f[group].attrs['data_source'])
+
+            xinc = 1/(f[group].attrs['drs4_frequency'] * 10**6)
+            points = f[group].attrs['record_length']
+            x = np.linspace(0, xinc * points, int(points)) - xinc * points * (1 - f[group].attrs['post_trigger']/100)
+
+            # While `y` is measured in volts, it's only relatively. We could
+            # use the DC offset to determine the absolute voltage, but the
+            # DC offset isn't well defined. Setting it to about 22000 (DAC
+            # units) means approximately no offset is added, but not
+            # exactly. This shouldn't matter much because we use a baseline
+            # subtraction method anyways.
+            info = (f[group][channel], x*1e9, CAEN_SCALE, 0)
+        elif 'yinc' in dict(f[channel].attrs):
+            # FIXME: All of the code below assumes that the datasets are in no
+            # group. `acquire-waveforms` should be updated first if we want to
+            # be able to use this class for oscilloscope data.
+            attrs = f[channel].attrs
+            x = attrs['xorg'] + np.linspace(0,attrs['xinc']*attrs['points'],int(attrs['points']))
+            info = (f[channel], x*1e9, attrs['yinc'], attrs['yorg'])
+        else:
+            # In older versions of the code, I stored xorg, xinc, etc.
+            # in the main HDF5 group and not on a per channel basis
+            x = f.attrs['xorg'] + np.linspace(0,f.attrs['xinc']*f.attrs['points'],int(f.attrs['points']))
+
+            if ':WAVeform:FORMat' in dict(f['settings'].attrs) and f['settings'].attrs[':WAVeform:FORMat'] != 'ASC':
+                # convert word values -> voltages if the data was saved in a non-ascii format
+                info = (f[channel], x*1e9, f.attrs['yinc'], f.attrs['yorg'])
+            else:
+                info = (f[channel], x*1e9, 1, 0)
+
+        self._info[channel] = info
+        return info
+
+    def time(self, channel):
+        """
+        Returns the sample times in nanoseconds for `channel`.
+        """
+        return self._channel_info(channel)[1]
+
+    def n_events(self, channel):
+        """
+        Returns the number of events recorded for `channel`.
+        """
+        return len(self._channel_info(channel)[0])
+
+    def block_size(self, channel):
+        """
+        Returns the number of events to read at a time for `channel`. This is
+        the largest multiple of the hdf5 chunk size which is not larger than
+        `self.chunks`, but at least a single chunk.
+        """
+        dset = self._channel_info(channel)[0]
+        rows = dset.chunks[0] if dset.chunks else EVENTS_PER_CHUNK
+        return max(rows, self.chunks//rows*rows)
+
+    def ranges(self, channel):
+        """
+        Returns a list of (start, stop) event ranges for `channel` which are
+        aligned to the hdf5 chunk boundaries.
+        """
+        n = self.n_events(channel)
+        size = self.block_size(channel)
+        return [(i, min(i + size, n)) for i in range(0, n, size)]
+
+    def _get_buffer(self, shape):
+        if self._buffer is None or self._buffer.shape[0] < shape[0] or self._buffer.shape[1:] != shape[1:]:
+            self._buffer = np.empty(shape, dtype=np.float32)
+        return self._buffer
+
+    def read(self, channel, start, stop):
+        """
+        Reads the events from `start` to `stop` in the dataset `channel`.
+        Returns a tuple (x, y) where `x` is the time in nanoseconds and `y` is
+        a view into the internal buffer with the voltage of each sample.
+        """
+        dset, x, scale, offset = self._channel_info(channel)
+        stop = min(stop, len(dset))
+        n = max(stop - start, 0)
+        buf = self._get_buffer((max(n, self.block_size(channel)),) + dset.shape[1:])
+        y = buf[:n]
+        if n > 0:
+            dset.read_direct(buf, np.s_[start:stop], np.s_[0:n])
+            if scale != 1:
+                y *= scale
+            if offset != 0:
+                y += offset
+        return x, y
+
+    def iter_chunks(self, channel):
+        """
+        Yields (x, y) for successive chunk aligned blocks of events in
+        `channel`. See `read()`.
+        """
+        for start, stop in self.ranges(channel):
+            yield self.read(channel, start, stop)
+
+    def block_ranges(self, channels):
+        """
+        Returns a list of chunk aligned (start, stop) event ranges which are
+        shared by all the channels in `channels`.
+        """
+        n = self.n_events(channels[0])
+        for channel in channels[1:]:
+            if self.n_events(channel) != n:
+                raise ValueError("%s has %i events but %s has %i" % (channels[0], n, channel, self.n_events(channel)))
+        size = self.block_size(channels[0])
+        return [(i, min(i + size, n)) for i in range(0, n, size)]
+
+    def read_block(self, channels, start, stop):
+        """
+        Reads the events from `start` to `stop` for every channel in
+        `channels`. Returns a tuple (x, y) where `x` is the time in nanoseconds
+        and `y` is a view into the internal buffer with shape
+        (len(channels), stop - start, number of samples).
+        """
+        x = self.time(channels[0])
+        n = max(min(stop, self.n_events(channels[0])) - start, 0)
+        shape = (len(channels), max(n, self.block_size(channels[0])), len(x))
+        buf = self._block_buffer
+        if buf is None or buf.shape[0] != shape[0] or buf.shape[1] < shape[1] or buf.shape[2] != shape[2]:
+            buf = self._block_buffer = np.empty(shape, dtype=np.float32)
+        y = buf[:,:n]
+        if n == 0:
+            return x, y
+        for i, channel in enumerate(channels):
+            dset, _, scale, offset = self._channel_info(channel)
+            dset.read_direct(buf, np.s_[start:start+n], np.s_[i,0:n])
+            if scale != 1:
+                y[i] *= scale
+            if offset != 0:
+                y[i] += offset
+        return x, y
+
+    def sample_ranges(self, channels, events, seed=0):
+        """
+        Returns a sorted list of (start, stop) event ranges which cover a
+        random selection of whole hdf5 chunks with at least `events` events in
+        total (or all of them if there aren't that many). Sampling whole chunks
+        means every chunk we read is only decompressed once.
+        """
+        n = self.n_events(channels[0])
+        dset = self._channel_info(channels[0])[0]
+        rows = dset.chunks[0] if dset.chunks else EVENTS_PER_CHUNK
+        starts = np.arange(0, n, rows)
+        count = min(len(starts), -(-events//rows))
+        rng = np.random.RandomState(seed)
+        starts = np.sort(rng.choice(starts, count, replace=False))
+        return [(int(i), int(min(i + rows, n))) for i in starts]
+
+    def iter_blocks(self, channels):
+        """
+        Yields (start, stop, x, y) for successive chunk aligned blocks of
+        events where `y` holds the same events for every channel in
+        `channels`, e.g. the 8 channels of a trigger group or all 32 channels.
+        See `read_block()`.
+        """
+        for start, stop in self.block_ranges(channels):
+            x, y = self.read_block(channels, start, stop)
+            yield start, stop, x, y
+
+# Files and WaveformSource objects opened by each worker process in
+# `map_blocks()`, indexed by the filename and by (filename, group, chunks).
+_worker_files = {}
+_worker_sources = {}
+
+def _integrate_worker(task):
+    """
+    Reads a single block of events and calls `func` on it. This runs in the
+    worker processes of `map_blocks()` which open the hdf5 file themselves.
+    """
+    func, filename, group, chunks, channels, start, stop = task
+    key = (filename, group, chunks)
+    if key not in _worker_sources:
+        if filename not in _worker_files:
+            _worker_files[filename] = h5py.File(filename,'r')
+        _worker_sources[key] = WaveformSource(_worker_files[filename], group, chunks)
+    x, y = _worker_sources[key].read_block(channels, start, stop)
+    return func(group, channels, x, y)
+
+def map_blocks(func, source, channel_groups, pool=None):
+    """
+    Calls `func(group, channels, x, y)` for every chunk aligned block of events
+    (see `WaveformSource.iter_blocks()`) for each list of channels in
+    `channel_groups` and yields (channels, start, stop, result).
+
+    If `pool` is a `btl.workers.WorkerPool` with more than one job, the
+    blocks are processed by its workers which each open the hdf5 file
+    themselves, with at most two blocks per worker in flight. The results
+    are always yielded in the same order as the serial loop so that merging
+    them gives bit-identical results. The pool has to be created before the
+    hdf5 file is opened, so `func` must be a top level function (or a
+    `functools.partial` of one) and any global state it needs (like `args`)
+    must be set before creating the pool.
+    """
+    tasks = [(channels, start, stop) for channels in channel_groups if len(channels) > 0 for start, stop in source.block_ranges(channels)]
+
+    if pool is None or pool.pool is None:
+        for channels, start, stop in tasks:
+            x, y = source.read_block(channels, start, stop)
+            yield channels, start, stop, func(source.group, channels, x, y)
+        return
+
+    results = pool.imap(_integrate_worker, ((func, source.f.filename, source.group, source.chunks, channels, start, stop) for channels, start, stop in tasks))
+    for (channels, start, stop), result in zip(tasks, results):
+        yield channels, start, stop, result
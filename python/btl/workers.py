@@ -0,0 +1,76 @@
+"""
+Pools of forked worker processes for the analysis scripts.
+
+Neither HDF5 nor ROOT expect a process to be forked while they have files
+open, so the pools are created at the start of a script before any hdf5 or
+ROOT files are opened, and are then reused for every group of waveforms.
+Anything a worker needs which is only known later, like the integration
+windows, has to be passed with the tasks.
+
+`WorkerPool.imap()` only submits a few tasks per worker ahead of the one
+whose result is yielded next, so a slow consumer doesn't make the pool queue
+up every task and hold all their results in memory.
+
+Example:
+
+    pool = WorkerPool(args.jobs)
+    with h5py.File(args.filename,'r') as f:
+        for result in pool.imap(func, tasks):
+            ...
+    pool.close()
+"""
+from __future__ import print_function, division
+from collections import deque
+import multiprocessing
+
+class WorkerPool(object):
+    """
+    Pool of `jobs` forked worker processes which run `initializer()` when
+    they start. If `jobs` is one or less there are no workers and `imap()`
+    calls the function in this process.
+    """
+    def __init__(self, jobs=1, initializer=None):
+        self.jobs = jobs
+        self.initializer = initializer
+        self.pool = None
+        if jobs > 1:
+            self.pool = multiprocessing.get_context('fork').Pool(jobs, initializer)
+
+    def imap(self, func, iterable, window=None):
+        """
+        Yields `func(item)` for each item in `iterable` in the same order,
+        like `Pool.imap()`, but with at most `window` tasks (by default two
+        per worker) submitted whose results haven't been yielded yet.
+        """
+        if self.pool is None:
+            for item in iterable:
+                yield func(item)
+            return
+
+        if window is None:
+            window = 2*self.jobs
+        pending = deque()
+        for item in iterable:
+            if len(pending) >= window:
+                yield pending.popleft().get()
+            pending.append(self.pool.apply_async(func, (item,)))
+        while pending:
+            yield pending.popleft().get()
+
+    def close(self):
+        """
+        Waits for the workers to exit. The pool can't be used afterwards.
+        """
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
@@ -3,45 +3,62 @@
 import h5py
 import sys
 import numpy as np
-
-
+from btl.integrals import EVENT_KEYS, empty_columns, read_integrals, write_integrals, read_pulses
 
 def merge_hdf5_files(filepaths):
-    
+    """
+    Merges the integrals files in `filepaths[:-1]` into `filepaths[-1]`. The
+    events of each channel are appended in the order the files are given.
+    The integration windows are taken from the first file which has them.
+    """
     outputpath = filepaths[-1]
 
-    # Open the output HDF5 file
-    with h5py.File(outputpath, 'a') as fileo:
-        
-        # Open the first HDF5 file
-        with h5py.File(filepaths[0], 'r') as file1:
-            
-            for name,item in file1.items():
-                print(name, item)
-
-                output_group = None
-                if isinstance(item, h5py.Group):
-                    output_group = fileo.require_group(name)
-                
-                for name2,item2 in item.items():
-                    print(name2,item2)
-
-                    if isinstance(item2, h5py.Dataset):
-                        if name2 in ['spe_charge', 'lyso_charge', 'lyso_rise_time', 'lyso_fall_time']:
-                            output_group.create_dataset(name2, maxshape=(None,), data=item2[...])
-                        else:
-                            output_group.create_dataset(name2, data=item2[...])
-                    
-                    # Open the other HDF5 files and merge the datasets
-                    for filepath in filepaths[1:-1]:
-                        with h5py.File(filepath, 'r') as filei:
-                            output_dataset = output_group[name2]
-                            dataseti = filei[name][name2]
-                            if name2 in ['spe_charge', 'lyso_charge', 'lyso_rise_time', 'lyso_fall_time']:
-                                output_dataset.resize((output_dataset.shape[0] + dataseti.shape[0],) + dataseti.shape[1:])
-                                output_dataset[-dataseti.shape[0]:, ...] = dataseti
+    groups = []
+    for filepath in filepaths[:-1]:
+        with h5py.File(filepath, 'r') as f:
+            for group in f:
+                if group not in groups:
+                    groups.append(group)
+
+    with h5py.File(outputpath, 'w') as fileo:
+        for group in groups:
+            print(group)
+
+            integrals = []
+            for filepath in filepaths[:-1]:
+                with h5py.File(filepath, 'r') as filei:
+                    if group in filei:
+                        integrals.append(read_integrals(filei, group))
+
+            channels = sorted(set(sum([x['channels'] for x in integrals], [])), key=lambda channel: int(channel[2:]))
+            n_events = {channel: sum(x['n_events'].get(channel, 0) for x in integrals) for channel in channels}
+            columns = empty_columns(channels, max(n_events.values()))
+
+            windows = {}
+            pulses = {}
+            start = dict.fromkeys(channels, 0)
+            for x in integrals:
+                for j, channel in enumerate(x['channels']):
+                    n = x['n_events'][channel]
+                    k = channels.index(channel)
+                    for key in EVENT_KEYS:
+                        if key in x:
+                            columns[key][start[channel]:start[channel]+n,k] = x[key][:n,j]
+                    start[channel] += n
+                    if 'window' in x and x['window'][j][0] >= 0:
+                        windows.setdefault(channel, tuple(x['window'][j]))
+
+                for channel, pulse in read_pulses(x).items():
+                    if channel in pulses:
+                        pulses[channel].merge(pulse)
+                    else:
+                        pulses[channel] = pulse
 
+            # Only keep the average pulse if every channel has one.
+            if set(pulses) != set(channels):
+                pulses = {}
 
+            write_integrals(fileo, group, channels, columns, n_events, windows=windows, pulses=pulses)
 
 # Example usage:
 nfiles = len(sys.argv) - 2
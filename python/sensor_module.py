@@ -428,11 +428,14 @@ class sensor_module:
         
         tfile = TFile(inputFile)
         spectra_params_dict = {}
+        if source=="sodium" or source=="cesium":
+            # Fit all the channels at once so the file is only read once.
+            fits = fit_modified_batch(inputFile, list(sensor_module.channels), source)
         for channel in sensor_module.channels:
             hist = tfile.Get(f'{source}_ch{channel}')
             #mu, mue, sig, A, p0, p1 = self.fit_spectra(hist)
             if source=="sodium" or source=="cesium":
-                fit_params, chi2 = fit_modified(inputFile, channel, source)
+                fit_params, chi2 = fits[channel]
                 mu = fit_params[4]; mue = fit_params[5]
             if calibrate and os.path.exists(sensor_module.path_to_jig_calibration):
                 calibration_data = pd.read_csv(sensor_module.path_to_jig_calibration, delimiter=',')
@@ -0,0 +1,18 @@
+"""
+Lets the tests of the modules which don't need ROOT run without it.
+
+Importing `btl` imports the fit modules, which import ROOT. If ROOT isn't
+installed, `btl` is registered as a package without running its `__init__`
+so that modules like `btl.pulses` or `btl.fit_priors` can still be imported.
+The tests of modules which need ROOT skip themselves with
+`pytest.importorskip('ROOT')`.
+"""
+import importlib.util
+import os
+import sys
+import types
+
+if importlib.util.find_spec('ROOT') is None and 'btl' not in sys.modules:
+    btl = types.ModuleType('btl')
+    btl.__path__ = [os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'btl')]
+    sys.modules['btl'] = btl
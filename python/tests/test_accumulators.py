@@ -0,0 +1,65 @@
+"""
+Checks that a `ChargeHistogram` filled block by block gives the same
+percentiles and histograms as the charges themselves up to its resolution.
+Run with `python -m pytest tests/test_accumulators.py` from the python
+directory.
+"""
+from __future__ import print_function, division
+import numpy as np
+
+from btl.accumulators import ChargeHistogram
+from btl.histograms import histogram_counts
+
+def charges(n=200000):
+    """
+    Returns `n` charges which look like an SPE spectrum: a pedestal and a
+    few PE peaks.
+    """
+    rng = np.random.default_rng(0)
+    pe = rng.poisson(1.2, n)
+    return rng.normal(0.05 + 3.5*pe, np.sqrt(0.3**2 + pe*0.35**2))
+
+def fill(x):
+    h = ChargeHistogram()
+    for block in np.array_split(x, 17):
+        h.add(block)
+    return h
+
+def test_percentile():
+    x = charges()
+    h = fill(x)
+    assert h.count() == len(x)
+    q = [0, 1, 25, 50, 75, 99, 100]
+    assert np.all(np.abs(h.percentile(q) - np.percentile(x, q)) <= h.resolution/2 + 1e-9)
+    # The same as np.percentile() of the rounded charges.
+    assert np.allclose(h.percentile(q), np.percentile(np.repeat(h.values, h.counts), q), rtol=0, atol=1e-9)
+    assert abs(h.iqr() - (np.percentile(x, 75) - np.percentile(x, 25))) <= h.resolution + 1e-9
+
+def test_bins():
+    # The Freedman Diaconis edges used for the SPE histograms.
+    x = charges()
+    h = fill(x)
+    width = 0.5*(np.percentile(x, 75) - np.percentile(x, 25))/len(x)**(1/3)
+    assert abs(0.5*h.iqr()/h.count()**(1/3) - width) <= 0.5*h.resolution/len(x)**(1/3) + 1e-12
+    first, last = np.percentile(x, [1, 99])
+    assert np.all(np.abs(h.percentile([1, 99]) - [first, last]) <= h.resolution/2 + 1e-9)
+
+    assert np.allclose(np.arange(first, last, width), np.arange(*h.percentile([1, 99]), 0.5*h.iqr()/h.count()**(1/3)), rtol=0, atol=5*h.resolution)
+
+    nbins = 500
+    counts = histogram_counts(h.values, nbins, first, last, h.counts)
+    assert counts.sum() == len(x)
+    # Only the charges within resolution/2 of an edge can change bins.
+    edges = np.linspace(first, last, nbins + 1)
+    i = np.clip(np.searchsorted(edges, x), 1, nbins)
+    near = np.count_nonzero(np.minimum(np.abs(x - edges[i - 1]), np.abs(x - edges[i])) <= h.resolution/2)
+    assert np.sum(np.abs(counts - histogram_counts(x, nbins, first, last))) <= 2*near
+
+def test_merge():
+    x = charges(10000)
+    h = fill(x[:3000]).merge(fill(x[3000:]))
+    g = ChargeHistogram().add(x)
+    assert np.array_equal(h.keys, g.keys)
+    assert np.array_equal(h.counts, g.counts)
+    assert ChargeHistogram().count() == 0
+    assert np.isnan(ChargeHistogram().median())
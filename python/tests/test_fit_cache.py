@@ -0,0 +1,161 @@
+"""
+Checks the keys, hits, misses and eviction of a `FitCache`. Run with
+`python -m pytest tests/test_fit_cache.py` from the python directory.
+"""
+from __future__ import print_function, division
+import os
+import numpy as np
+import pytest
+
+from btl.fit_cache import FitCache, cached_fit, histogram_hash
+
+class Axis(object):
+    def __init__(self, nbins, xmin, xmax):
+        self.nbins, self.xmin, self.xmax = nbins, xmin, xmax
+        self.first, self.last = 1, nbins
+
+    def GetXmin(self):
+        return self.xmin
+
+    def GetXmax(self):
+        return self.xmax
+
+    def GetFirst(self):
+        return self.first
+
+    def GetLast(self):
+        return self.last
+
+class Histogram(object):
+    """
+    The parts of a TH1D which `histogram_hash()` uses.
+    """
+    def __init__(self, name, counts, xmin=0.0, xmax=1.0):
+        self.name = name
+        self.axis = Axis(len(counts), xmin, xmax)
+        self.contents = np.concatenate(([0], counts, [0])).astype(np.float64)
+
+    def GetName(self):
+        return self.name
+
+    def GetXaxis(self):
+        return self.axis
+
+    def GetNbinsX(self):
+        return self.axis.nbins
+
+    def GetNcells(self):
+        return len(self.contents)
+
+    def GetEntries(self):
+        return float(self.contents.sum())
+
+    def GetStats(self, stats):
+        x = np.linspace(self.axis.xmin, self.axis.xmax, self.axis.nbins + 1)
+        x = (x[1:] + x[:-1])/2
+        w = self.contents[1:-1]
+        stats[:] = w.sum(), (w**2).sum(), (w*x).sum(), (w*x**2).sum()
+
+    def InheritsFrom(self, name):
+        return name == 'TArrayD'
+
+    def GetArray(self):
+        return self.contents
+
+def test_histogram_hash():
+    h = Histogram('spe_ch0', [1, 5, 3, 0])
+    key = histogram_hash(h, 'btl.fit_spe_funcs.fit_spe', 2, (False,))
+
+    # The key only depends on the histogram and the arguments.
+    assert histogram_hash(Histogram('spe_ch0', [1, 5, 3, 0]), 'btl.fit_spe_funcs.fit_spe', 2, (False,)) == key
+    assert histogram_hash(h, 'btl.fit_spe_funcs.fit_spe', 2, [False]) == key
+
+    others = [
+        histogram_hash(Histogram('spe_ch1', [1, 5, 3, 0]), 'btl.fit_spe_funcs.fit_spe', 2, (False,)),
+        histogram_hash(Histogram('spe_ch0', [1, 5, 4, 0]), 'btl.fit_spe_funcs.fit_spe', 2, (False,)),
+        histogram_hash(Histogram('spe_ch0', [1, 5, 3, 0], xmax=2.0), 'btl.fit_spe_funcs.fit_spe', 2, (False,)),
+        histogram_hash(h, 'btl.fit_lyso_funcs.fit_lyso', 2, (False,)),
+        histogram_hash(h, 'btl.fit_spe_funcs.fit_spe', 3, (False,)),
+        histogram_hash(h, 'btl.fit_spe_funcs.fit_spe', 2, (True,)),
+        histogram_hash(h, 'btl.fit_spe_funcs.fit_spe', 2),
+    ]
+    assert len(set(others + [key])) == len(others) + 1
+
+    # Zooming in on the axis changes the key.
+    h.axis.first = 2
+    assert histogram_hash(h, 'btl.fit_spe_funcs.fit_spe', 2, (False,)) != key
+
+def test_get_put(tmp_path):
+    cache = FitCache(str(tmp_path / 'fits'))
+    assert cache.get('a') is None
+
+    entry = {'status': 'ok', 'pars': [1.0, 2.0], 'errors': [0.1, 0.2]}
+    cache.put('a', entry)
+    assert cache.get('a') == entry
+    assert cache.get('b') is None
+    # Another cache in the same directory sees the entry.
+    assert FitCache(str(tmp_path / 'fits')).get('a') == entry
+
+    # A corrupt entry is a miss.
+    with open(cache.filename('b'), 'wb') as f:
+        f.write(b'not a pickle')
+    assert cache.get('b') is None
+
+    assert sorted(os.listdir(cache.path)) == ['a.pkl', 'b.pkl']
+
+def test_evict(tmp_path):
+    entry = {'data': b'x'*1000}
+    cache = FitCache(str(tmp_path), max_bytes=2500)
+    cache.put('a', entry)
+    cache.put('b', entry)
+    os.utime(cache.filename('a'), (1000, 1000))
+    os.utime(cache.filename('b'), (2000, 2000))
+
+    # Reading an entry makes it the most recently used one, so adding a
+    # third entry evicts 'b' instead of 'a'.
+    assert cache.get('a') == entry
+    cache.put('c', entry)
+    assert cache.get('b') is None
+    assert cache.get('a') == entry
+    assert cache.get('c') == entry
+    assert sorted(os.listdir(str(tmp_path))) == ['a.pkl', 'c.pkl']
+
+    # An entry bigger than the cache doesn't stay.
+    cache.put('d', {'data': b'x'*5000})
+    assert cache.get('d') is None
+
+FITS = []
+
+def fit(h, prior=None):
+    FITS.append(prior)
+    return [1.0, 2.0], [0.1, 0.2]
+
+def test_cached_fit(tmp_path):
+    ROOT = pytest.importorskip('ROOT')
+    cache = FitCache(str(tmp_path))
+    h = ROOT.TH1D('h_test_cached_fit', '', 10, 0, 10)
+    for x in (1.5, 2.5, 2.5, 7.5):
+        h.Fill(x)
+    del FITS[:]
+
+    assert cached_fit(cache, fit, h, version=1, key=(0,)) == ([1.0, 2.0], [0.1, 0.2])
+    assert not cache.last_hit
+    # The prior isn't part of the key, so a new one still hits and the fit
+    # isn't run.
+    assert cached_fit(cache, fit, h, prior=[3.0], version=1, key=(0,)) == ([1.0, 2.0], [0.1, 0.2])
+    assert cache.last_hit
+    assert FITS == [None]
+
+    # Anything in the key or the histogram changing is a miss.
+    cached_fit(cache, fit, h, prior=[3.0], version=1, key=(1,))
+    assert not cache.last_hit
+    cached_fit(cache, fit, h, prior=[3.0], version=2, key=(0,))
+    assert not cache.last_hit
+    h.Fill(5.5)
+    cached_fit(cache, fit, h, prior=[3.0], version=1, key=(0,))
+    assert not cache.last_hit
+    assert FITS == [None, [3.0], [3.0], [3.0]]
+
+    # Without a cache the fit always runs.
+    assert cached_fit(None, fit, h, prior=[4.0], version=1, key=(0,)) == ([1.0, 2.0], [0.1, 0.2])
+    assert FITS[-1] == [4.0]
@@ -0,0 +1,63 @@
+"""
+Checks storing and looking up fit parameters in a `FitPriors` store. Run
+with `python -m pytest tests/test_fit_priors.py` from the python directory.
+"""
+from __future__ import print_function, division
+import os
+
+from btl.fit_priors import FitPriors
+
+def test_round_trip(tmp_path):
+    priors = FitPriors(str(tmp_path))
+    assert priors.get(1234, 'ch0', 'lyso', 30.0) is None
+
+    assert priors.put(1234, 'ch0', 'lyso', 30.0, [1, 2.5, 3], chi2_ndf=1.2)
+    assert priors.get(1234, 'ch0', 'lyso', 30.0) == [1, 2.5, 3]
+    # A new store reads the same directory.
+    assert FitPriors(str(tmp_path)).get(1234, 'ch0', 'lyso', 30.0) == [1, 2.5, 3]
+
+    # Other channels, sources and modules don't see them.
+    assert priors.get(1234, 'ch1', 'lyso', 30.0) is None
+    assert priors.get(1234, 'ch0', 'spe', 30.0) is None
+    assert priors.get(4321, 'ch0', 'lyso', 30.0) is None
+
+    # Storing a fit at the same voltage replaces the old one.
+    assert priors.put(1234, 'ch0', 'lyso', 30.0, [4, 5, 6])
+    assert priors.get(1234, 'ch0', 'lyso', 30.0) == [4, 5, 6]
+    assert priors.load(1234) == {'ch0': {'lyso': [[30.0, [4, 5, 6]]]}}
+
+    # Nothing is left behind from the temporary files.
+    assert sorted(os.listdir(str(tmp_path))) == ['1234.json']
+
+def test_max_chi2_ndf(tmp_path):
+    priors = FitPriors(str(tmp_path), max_chi2_ndf=5)
+
+    assert not priors.put(1234, 'ch0', 'spe', 30.0, [1, 2], chi2_ndf=6)
+    assert not priors.put(1234, 'ch0', 'spe', 30.0, [1, 2], chi2_ndf=float('nan'))
+    assert priors.get(1234, 'ch0', 'spe', 30.0) is None
+
+    assert priors.put(1234, 'ch0', 'spe', 30.0, [1, 2], chi2_ndf=5)
+    # Fits without a chi-square are stored.
+    assert priors.put(1234, 'ch1', 'spe', 30.0, [3, 4])
+    assert priors.get(1234, 'ch0', 'spe', 30.0) == [1, 2]
+    assert priors.get(1234, 'ch1', 'spe', 30.0) == [3, 4]
+
+    # A bad fit doesn't replace a good one.
+    assert not priors.put(1234, 'ch0', 'spe', 30.0, [5, 6], chi2_ndf=50)
+    assert priors.get(1234, 'ch0', 'spe', 30.0) == [1, 2]
+
+def test_voltage(tmp_path):
+    priors = FitPriors(str(tmp_path))
+    priors.put(1234, 'ch0', 'lyso', 30.0, [1])
+    priors.put(1234, 'ch0', 'lyso', 32.0, [2])
+    priors.put(1234, 'ch0', 'lyso', 32.008, [3])
+
+    assert priors.get(1234, 'ch0', 'lyso', 30.0) == [1]
+    assert priors.get(1234, 'ch0', 'lyso', 30.005) == [1]
+    # The closest voltage within the tolerance wins.
+    assert priors.get(1234, 'ch0', 'lyso', 32.001) == [2]
+    assert priors.get(1234, 'ch0', 'lyso', 32.007) == [3]
+    # Fits at other voltages aren't used.
+    assert priors.get(1234, 'ch0', 'lyso', 31.0) is None
+    assert priors.get(1234, 'ch0', 'lyso', 30.02) is None
+    assert priors.get(1234, 'ch0', 'lyso', 30.6, tolerance=1) == [1]
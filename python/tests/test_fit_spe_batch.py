@@ -0,0 +1,59 @@
+"""
+Checks that `fit_spe_batch()` agrees with `fit_spe()` on simulated SPE
+spectra. Run with `python -m pytest tests/test_fit_spe_batch.py` from the
+python directory.
+"""
+from __future__ import print_function, division
+import numpy as np
+import pytest
+
+ROOT = pytest.importorskip('ROOT')
+
+from btl.fit_spe_batch import fit_spe_batch, vinogradov_model
+from btl.fit_spe_funcs import fit_spe
+from btl import fit_spe_funcs
+from btl.histograms import fill_histogram
+from btl.plot_utils import get_bins
+
+# Parameters of the simulated channels: scale, offset, l, SPE charge, noise,
+# SPE charge spread and crosstalk probability.
+TRUTH = [
+    [1, 0.05, 1.5, 3.3, 0.3, 0.1, 0.05],
+    [1, -0.05, 1.3, 3.8, 0.35, 0.15, 0.04],
+    [1, 0.0, 0.9, 4.1, 0.3, 0.1, 0.03],
+]
+
+def simulate(rng, p, n=50000):
+    """
+    Returns `n` charges drawn from the vinogradov model with parameters `p`.
+    """
+    grid = np.linspace(-2, 30, 32001)
+    pdf = vinogradov_model(grid[np.newaxis], np.array([p], dtype=float))[0]
+    return rng.choice(grid, n, p=pdf/pdf.sum()) + rng.uniform(-5e-4, 5e-4, n)
+
+@pytest.fixture(scope='module')
+def spectra():
+    rng = np.random.default_rng(0)
+    return [simulate(rng, p) for p in TRUTH]
+
+def test_truth(spectra):
+    results = fit_spe_batch(spectra, [get_bins(x) for x in spectra])
+    for p, result in zip(TRUTH, results):
+        assert result is not None
+        pars, errors = result
+        assert abs(pars[3] - p[3]) < 5*errors[3]
+
+def test_fit_spe(spectra, tmp_path):
+    # fit_spe() writes the fit to the current directory.
+    f = ROOT.TFile(str(tmp_path / 'test_fit_spe_batch.root'), 'recreate')
+    results = fit_spe_batch(spectra, [get_bins(x) for x in spectra])
+    for i, (x, result) in enumerate(zip(spectra, results)):
+        bins = get_bins(x)
+        h = ROOT.TH1D('spe_ch%i' % i, '', len(bins), bins[0], bins[-1])
+        fill_histogram(h, x)
+        expected = fit_spe(h, fit_spe_funcs.vinogradov_model())
+        assert expected is not None and result is not None
+        # Same gain to 0.1% and the same error to 10%.
+        assert result[0][3] == pytest.approx(expected[0][3], rel=1e-3)
+        assert result[1][3] == pytest.approx(expected[1][3], rel=0.1)
+    f.Close()
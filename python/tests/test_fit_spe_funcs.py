@@ -0,0 +1,27 @@
+"""
+Checks that the compiled vinogradov model gives the same values as the python
+one. Run with `python -m pytest tests/test_fit_spe_funcs.py` from the python
+directory.
+"""
+from __future__ import print_function, division
+import numpy as np
+import pytest
+
+ROOT = pytest.importorskip('ROOT')
+
+from btl.fit_spe_funcs import vinogradov_model, compiled_vinogradov_model, compare_vinogradov_models
+
+def test_compiled_vinogradov_model():
+    compiled = compiled_vinogradov_model()
+    assert compiled is not None
+    assert compare_vinogradov_models(compiled) is None
+
+def test_compiled_vinogradov_model_tf1():
+    # The compiled model is used through a TF1 in the fits.
+    p = [1000, 0.1, 1.2, 3.5, 0.4, 0.05, 0.05]
+    f = ROOT.TF1('f_test_vinogradov', compiled_vinogradov_model(), -2, 40, 7)
+    for i, value in enumerate(p):
+        f.SetParameter(i, value)
+    model = vinogradov_model()
+    for x in np.linspace(-2, 40, 85):
+        assert f.Eval(x) == pytest.approx(model(np.array([x]), np.array(p)), rel=1e-9, abs=1e-300)
@@ -0,0 +1,105 @@
+"""
+Checks that both backends of `pulse_features()` agree with each other and
+with the original `integrate()`, `get_rise_time()`, `get_fall_time()` and
+`get_threshold_crossing()` from the integration scripts on simulated pulses.
+Run with `python -m pytest tests/test_pulses.py` from the python directory.
+"""
+from __future__ import print_function, division
+import numpy as np
+import pytest
+
+from btl.pulses import pulse_features, BACKENDS, CAEN_R
+
+def get_threshold_crossing(x, data, threshold=0.4, rising=True):
+    """
+    The original get_threshold_crossing() from the integration scripts.
+    """
+    data = np.asarray(data)
+    argmin = np.argmin(data,axis=-1)
+    thresholds = threshold*data[np.arange(data.shape[0]),argmin]
+    if rising:
+        il = data.shape[1]-np.argmax(((np.arange(data.shape[1]) < argmin[:,np.newaxis]) & (data > thresholds[:,np.newaxis]))[:,::-1],axis=-1)-1
+        ir = il + 1
+        ir[ir >= data.shape[1]] = data.shape[1]-1
+        i = np.arange(data.shape[0])
+    else:
+        ir = np.argmax(((np.arange(data.shape[1]) > argmin[:,np.newaxis]) & (data > thresholds[:,np.newaxis])),axis=-1)
+        il = ir - 1
+        il[il < 0] = 0
+        i = np.arange(data.shape[0])
+    return x[il] + (thresholds-data[i,il])*(x[ir]-x[il])/(data[i,ir]-data[i,il])
+
+def get_rise_time(x, data):
+    t10 = get_threshold_crossing(x, data, 0.1)
+    t90 = get_threshold_crossing(x, data, 0.9)
+    return t90 - t10
+
+def get_fall_time(x, data):
+    t10 = get_threshold_crossing(x, data, 0.1, rising=False)
+    t90 = get_threshold_crossing(x, data, 0.9, rising=False)
+    return t10 - t90
+
+def integrate(x, data, a, b):
+    """
+    The original integrate() from the integration scripts.
+    """
+    return -np.trapz(data[:,a:b],x=x[a:b])*1000/CAEN_R
+
+def simulate(rng, n=2000, baseline=0.0):
+    """
+    Returns the times and `n` float32 waveforms like the digitizer's with
+    pulses of random heights and times on top of `baseline` and some noise.
+    """
+    x = np.arange(-200, 800, 0.8)
+    t0 = rng.uniform(90, 110, size=n)[:,np.newaxis]
+    amplitude = rng.uniform(0.05, 0.5, size=n)[:,np.newaxis]
+    t = np.clip(x - t0, 0, None)
+    pulse = amplitude*(np.exp(-t/40) - np.exp(-t/3))/0.85
+    y = baseline - pulse + rng.normal(0, 0.0005, size=pulse.shape)
+    return x, y.astype(np.float32)
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_reference(backend):
+    rng = np.random.default_rng(0)
+    x, y = simulate(rng)
+    a, b = np.searchsorted(x, [50, 450])
+
+    features = pulse_features(x, y, window=(a, b), baseline=None, backend=backend)
+
+    np.testing.assert_allclose(features['charge'], integrate(x, y, a, b), rtol=1e-5)
+    np.testing.assert_allclose(features['t40'], get_threshold_crossing(x, y, 0.4), rtol=0, atol=1e-3)
+    np.testing.assert_allclose(features['rise_time'], get_rise_time(x, y), rtol=0, atol=1e-3)
+    np.testing.assert_allclose(features['fall_time'], get_fall_time(x, y), rtol=0, atol=1e-3)
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_baseline(backend):
+    # The baseline is subtracted without changing the waveforms.
+    rng = np.random.default_rng(1)
+    x, y = simulate(rng, baseline=0.8)
+    copy = y.copy()
+    a, b = np.searchsorted(x, [50, 450])
+
+    features = pulse_features(x, y, window=(a, b), backend=backend)
+    np.testing.assert_array_equal(y, copy)
+
+    y -= np.median(y[:,x < x[0] + 100],axis=-1)[:,np.newaxis]
+    np.testing.assert_allclose(features['charge'], integrate(x, y, a, b), rtol=1e-4)
+    np.testing.assert_allclose(features['rise_time'], get_rise_time(x, y), rtol=0, atol=1e-3)
+
+@pytest.mark.skipif(len(BACKENDS) < 2, reason='numba is not installed')
+def test_backends():
+    rng = np.random.default_rng(2)
+    x, y = simulate(rng, baseline=0.8)
+
+    numba_features = pulse_features(x, y, backend='numba')
+    numpy_features = pulse_features(x, y, backend='numpy')
+
+    assert numba_features['window'] == numpy_features['window']
+    for name in ('argmin', 'baseline', 'height', 'saturated'):
+        np.testing.assert_array_equal(numba_features[name], numpy_features[name])
+    # Both integrate in double precision, so only the order of the sums differs.
+    np.testing.assert_allclose(numba_features['charge'], numpy_features['charge'], rtol=1e-12)
+    # The NumPy backend interpolates the crossings in the precision of the
+    # samples, which matters where the waveform is almost flat.
+    for name in ('t10', 't40', 't90', 'fall_t90', 'fall_t10', 'rise_time', 'fall_time'):
+        np.testing.assert_allclose(numba_features[name], numpy_features[name], rtol=0, atol=1e-2)
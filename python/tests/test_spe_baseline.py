@@ -0,0 +1,71 @@
+"""
+Checks `spe_baseline_subtraction()` against the original implementation which
+looped over the samples and events in Python. Run with
+`python -m pytest tests/test_spe_baseline.py` from the python directory.
+"""
+from __future__ import print_function, division
+import numpy as np
+import pytest
+
+# Importing btl imports ROOT.
+pytest.importorskip('ROOT')
+
+from btl.spe_baseline import spe_baseline_subtraction, high_filter_SPE, iqr
+
+START_TIME = 50
+
+def reference(x, y, a, b, method):
+    """
+    The original spe_baseline_subtraction() from integrate-waveforms. Returns
+    the waveforms of the events which aren't cut.
+    """
+    high_filter_y = high_filter_SPE(x, y)
+
+    y -= np.median(y[:,x < START_TIME], axis=-1)[:, np.newaxis]
+    std = np.std(y[:,x < START_TIME])
+
+    if method == 1:
+        y = y[(y[:,a] > -2*std) & (y[:,b] > -2*std)]
+    elif method == 2:
+        s = y.T
+        s_mask = s > -10*iqr(high_filter_y.flatten())
+        good_s = [s[i, s_mask[i]] for i in range(len(s))]
+        sample_medians = np.array([np.median(sub) for sub in good_s])
+        y -= sample_medians
+    elif method == 3:
+        ma = -25
+        mb = 200
+        SPE_trials = np.min(y[:, np.logical_and(x >= ma, x < mb)], axis=-1) < -2 * iqr(high_filter_y[:, np.logical_and(x >= ma, x < mb)].flatten())
+        SPE_trials_idx = [i for i in range(len(y)) if SPE_trials[i]]
+        y = np.delete(y, SPE_trials_idx, axis=0)
+        y -= np.median(y[:, np.logical_and(x >= ma, x < mb)], axis=-1)[:, np.newaxis]
+    elif method == 4:
+        ma = -25
+        mb = 200
+        m_mask = np.logical_and(x>=ma, x<mb)
+        no_SPE_trials_mask = np.min(y[:, m_mask], axis=-1) > -2 * iqr(high_filter_y[:, m_mask].flatten())
+        y -= np.array([np.median(y[i, m_mask]) if no_SPE_trials_mask[i] else np.median((y[no_SPE_trials_mask, :])[:, m_mask]) for i in range(len(y))])[:, np.newaxis]
+    return y
+
+def waveforms(seed=0, n=500):
+    """
+    Returns the times and float32 waveforms of `n` simulated SPE events with
+    noise, a random baseline and one or two PEs at random times in about half
+    of the events.
+    """
+    rng = np.random.default_rng(seed)
+    x = np.arange(-200, 400, 0.8)
+    y = rng.normal(0, 1e-3, (n, len(x))) + rng.normal(0, 2e-3, (n, 1))
+    for i in range(n):
+        for t in rng.uniform(-250, 400, rng.poisson(0.7)):
+            y[i] -= 5e-3*np.exp(-np.maximum(x - t, 0)/20)*(x >= t)
+    return x, y.astype(np.float32)
+
+@pytest.mark.parametrize('method', [0, 1, 2, 3, 4])
+def test_reference(method):
+    x, y = waveforms()
+    a, b = np.searchsorted(x, [START_TIME, START_TIME + 150])
+    expected = reference(x, y.copy(), a, b, method)
+    result, good = spe_baseline_subtraction(x, y.copy(), a, b, method=method, start_time=START_TIME)
+    assert len(result) == len(y)
+    np.testing.assert_array_equal(result[good], expected)